@@ -5,7 +5,7 @@ new Env('bbdb-ARL联动');
 文件名: bbdb_arl.py
 作者: soapffz
 创建日期: 2023年10月1日
-最后修改日期: 2024年3月26日
+最后修改日期: 2026年10月18日
 
 本脚本实现了bbdb和ARL之间的联动，详细步骤以main函数中注释为准
 
@@ -13,18 +13,95 @@ new Env('bbdb-ARL联动');
 
 from pymongo import MongoClient
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import sys
+import time
+import random
+import threading
+import queue
+import asyncio
+import hashlib
+import itertools
+import heapq
+import multiprocessing
+import tempfile
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter, defaultdict, deque, namedtuple
 import urllib3
-from urllib.parse import urlparse
+from urllib.parse import urlsplit, urlunsplit
 import re
 from datetime import datetime, timezone, timedelta
 import os
-from bson.objectid import ObjectId
+import bbdb_tracing as tracing
+from bbdb_indexes import IP_KEY_FIELDS, bulk_upsert, ensure_indexes
+from bbdb_lease import acquire_run_lease
+from bbdb_domain_resolver import (
+    HOSTNAME_DOMAIN,
+    get_root_domain,
+    get_root_domains,
+    iter_normalized_hostnames,
+    normalize_hostname,
+    normalize_hostnames,
+)
+from bbdb_domain_set import DomainSet, DomainSetBuilder
 from typing import List, Dict
 
 urllib3.disable_warnings()
 
+# ARL 列表接口分页参数：首选每页条数、上限和并发数
+ARL_PAGE_SIZE = int(os.environ.get("BBDB_ARL_PAGE_SIZE", 500))
+ARL_MAX_PAGE_SIZE = int(os.environ.get("BBDB_ARL_MAX_PAGE_SIZE", 5000))
+ARL_PAGE_WORKERS = int(os.environ.get("BBDB_ARL_PAGE_WORKERS", 8))
+# 资产分组和策略列表的本地缓存文件及有效期（秒），有效期为 0 时不使用缓存
+ARL_LISTING_CACHE_FILE = os.environ.get("BBDB_ARL_CACHE_FILE", "bbdb_arl_cache.json")
+ARL_LISTING_CACHE_TTL = int(os.environ.get("BBDB_ARL_CACHE_TTL", 3600))
+# 域名同步阶段同时在途的 ARL/Mongo 写入请求数，也是 ARL 导出与写入之间缓冲的批次数；以及 Mongo 每批写入的文档数
+ARL_SYNC_CONCURRENCY = int(os.environ.get("BBDB_ARL_SYNC_CONCURRENCY", 8))
+# 第 6-8 步的分片进程数，大于 1 时按业务把同步分到多个进程并行执行
+ARL_SYNC_SHARDS = int(os.environ.get("BBDB_ARL_SYNC_SHARDS", 1))
+MONGO_BATCH_SIZE = 5000
+# get_bbdb_data 读取各表时只取同步用到的字段，_id 默认返回
+BBDB_PROJECTIONS = {
+    "business": {"name": 1},
+    "root_domain": {"name": 1, "business_id": 1},
+    "sub_domain": {"name": 1, "business_id": 1, "root_domain_id": 1},
+    "site": {"name": 1},
+    "ip": {"address": 1, "root_domain_id": 1, "sub_domain_id": 1, "business_id": 1},
+    "blacklist": {"name": 1, "type": 1},
+}
+# 各表 upsert 时判断文档是否已存在的键字段
+UPSERT_KEYS = {
+    "root_domain": ("name",),
+    "sub_domain": ("name",),
+    "site": ("name",),
+    "ip": IP_KEY_FIELDS,
+}
+# IPv4 地址格式，ip 同步时逐个匹配，预先编译
+IPV4_PATTERN = re.compile(
+    r"^(?:(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.){3}(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)$"
+)
+# ARL 资产范围中单级域名的格式，与 normalize_hostnames 的规则一致，另外不能以连字符开头结尾
+ARL_DOMAIN_LABEL_PATTERN = re.compile(r"^(?!-)[a-z0-9-]{1,63}(?<!-)$")
+# ARL 站点更新监控任务的 scope_type
+SITE_MONITOR_SCOPE_TYPE = "site_update_monitor"
+# 规范化站点 URL 时省略的默认端口，也限定了同步的站点协议
+SITE_DEFAULT_PORTS = {"http": 80, "https": 443}
+# 流式下载 ARL 导出数据时每批交给调用方的条数
+ARL_STREAM_BATCH_SIZE = 5000
+# 并发下载 ARL 导出页面的线程数，以及单个页面失败后的重试次数
+ARL_EXPORT_WORKERS = int(os.environ.get("BBDB_ARL_EXPORT_WORKERS", 4))
+ARL_EXPORT_PAGE_RETRIES = 3
+# 导出页面按块交给调用方的行数，以及每个页面最多缓存的块数
+ARL_EXPORT_CHUNK_LINES = 1000
+ARL_EXPORT_PAGE_CHUNKS = 2
+# 增量同步：距离上次全量对账超过该小时数时强制全量同步；ARL 水位回退的分钟数用于容忍时钟偏差
+SYNC_FULL_INTERVAL_HOURS = int(os.environ.get("BBDB_ARL_FULL_SYNC_HOURS", 24))
+SYNC_WATERMARK_OVERLAP_MINUTES = 30
+# 同步脚本写入 bbdb 的文档的 notes，增量推送 ARL 时据此排除从 ARL 导入的文档
+ARL_SYNC_NOTES = "set by soapffz with arl"
+
 
 def log_message(message, is_positive=True):
     """打印日志信息"""
@@ -53,6 +130,278 @@ def check_env_vars():
     return True
 
 
+class ArlClient:
+    """ARL 接口客户端：复用 keep-alive 连接池，统一超时、带抖动的指数退避重试，并缓存登录 token"""
+
+    # 这些状态码视为 ARL 或反代的临时故障，可以重试
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        arl_url,
+        username,
+        password,
+        pool_size=16,
+        timeout=(10, 60),
+        max_retries=3,
+        backoff_base=1.0,
+        backoff_max=30.0,
+        token_ttl=6 * 3600,
+    ):
+        self.arl_url = arl_url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.token_ttl = token_ttl
+        self.token = None
+        self.token_expire_at = 0
+        self._login_lock = threading.Lock()
+        # 列表缓存，由 login_arl 按环境变量配置
+        self.listing_cache = None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.verify = False
+        self.session.headers.update({"Content-Type": "application/json; charset=UTF-8"})
+
+    def login(self, force=False):
+        # 分页并发时多个线程可能同时发现 token 过期，加锁保证只登录一次
+        with self._login_lock:
+            # token 未过期时直接复用
+            if not force and self.token and time.time() < self.token_expire_at:
+                return self.token
+            return self._login()
+
+    def _login(self):
+        data = {"username": self.username, "password": self.password}
+        response = self._send("POST", "/api/user/login", json=data, auth=False)
+        if response is None:
+            return None
+
+        try:
+            response_data = response.json()
+        except ValueError:
+            log_message("Failed to decode JSON response.", False)
+            return None
+
+        if response_data.get("code") != 200:
+            log_message(
+                f"ARL login failed, error code: {response_data.get('code')}", False
+            )
+            return None
+
+        token = response_data.get("data", {}).get("token")
+        if not token:
+            log_message("Token is missing in the response.", False)
+            return None
+
+        self.token = token
+        self.token_expire_at = time.time() + self.token_ttl
+        self.session.headers["Token"] = token
+        log_message("ARL login successful")
+        return token
+
+    def _backoff(self, attempt):
+        # 指数退避 + full jitter，避免多个请求同时重试
+        delay = min(self.backoff_max, self.backoff_base * (2**attempt))
+        time.sleep(random.uniform(0, delay))
+
+    def _send(self, method, path, auth=True, **kwargs):
+        with tracing.span("arl.http", method=method, path=path):
+            return self._send_with_retries(method, path, auth, **kwargs)
+
+    def _send_with_retries(self, method, path, auth, **kwargs):
+        url = path if path.startswith("http") else self.arl_url + path
+        kwargs.setdefault("timeout", self.timeout)
+        relogin_done = False
+        attempt = 0
+
+        while True:
+            if auth and not self.login():
+                return None
+            try:
+                response = self.session.request(method, url, **kwargs)
+                # 流式响应的响应体在读取时再统计
+                tracing.add(
+                    requests=1,
+                    bytes_sent=len(response.request.body or b""),
+                    bytes_received=0 if kwargs.get("stream") else len(response.content),
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                tracing.add(requests=1, errors=1)
+                # POST 读超时时请求可能已被执行，只在连接阶段失败时重试
+                retryable = method == "GET" or not isinstance(e, requests.ReadTimeout)
+                if not retryable or attempt >= self.max_retries:
+                    log_message(f"请求 {path} 失败: {e}", False)
+                    return None
+                log_message(
+                    f"请求 {path} 失败，尝试次数 {attempt + 1}/{self.max_retries}: {e}",
+                    False,
+                )
+                self._backoff(attempt)
+                attempt += 1
+                continue
+            except requests.RequestException as e:
+                log_message(f"请求 {path} 失败: {e}", False)
+                return None
+
+            # token 失效时重新登录一次
+            if auth and response.status_code == 401 and not relogin_done:
+                relogin_done = True
+                self.login(force=True)
+                continue
+
+            if response.status_code in self.RETRY_STATUS and attempt < self.max_retries:
+                log_message(
+                    f"请求 {path} 返回 {response.status_code}，尝试次数 {attempt + 1}/{self.max_retries}",
+                    False,
+                )
+                self._backoff(attempt)
+                attempt += 1
+                continue
+
+            try:
+                response.raise_for_status()
+            except requests.RequestException as e:
+                log_message(f"请求 {path} 失败: {e}", False)
+                return None
+            return response
+
+    def get(self, path, **kwargs):
+        """发送 GET 请求，返回 Response，失败返回 None"""
+        return self._send("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        """发送 POST 请求，返回 Response，失败返回 None；写接口会让对应的列表缓存失效"""
+        # 请求失败时也可能已经在 ARL 侧执行，发送前就让缓存失效
+        if self.listing_cache is not None:
+            self.listing_cache.invalidate_for(path)
+        return self._send("POST", path, **kwargs)
+
+    def get_json(self, path, **kwargs):
+        """发送 GET 请求并解析 JSON，失败返回 None"""
+        return self._parse_json(self.get(path, **kwargs), path)
+
+    def post_json(self, path, **kwargs):
+        """发送 POST 请求并解析 JSON，失败返回 None"""
+        return self._parse_json(self.post(path, **kwargs), path)
+
+    @staticmethod
+    def _parse_json(response, path):
+        if response is None:
+            return None
+        try:
+            return response.json()
+        except ValueError:
+            log_message(f"无法解析 {path} 的响应内容", False)
+            return None
+
+    def close(self):
+        self.session.close()
+
+
+class ArlListingCache:
+    """
+    ARL 列表接口的本地磁盘缓存，用于资产分组和策略列表，跨定时任务的多次运行复用
+
+    读取时先用 size=1 的请求取 total 和第一条记录的摘要，缓存在有效期内且两者一致才直接返回缓存；
+    ArlClient 发出 MUTATING_PATHS 中的写请求时对应列表立即失效，本脚本自己的新增、删除不会读到旧数据。
+    在 ARL 页面上修改已有分组的内容不一定能被探测到，最多在有效期后重新读取
+    """
+
+    # 写接口 -> 受影响的列表接口
+    MUTATING_PATHS = {
+        "/api/asset_scope/": "/api/asset_scope/",
+        "/api/asset_scope/add/": "/api/asset_scope/",
+        "/api/asset_scope/delete/": "/api/asset_scope/",
+        "/api/policy/add/": "/api/policy/",
+        "/api/policy/edit/": "/api/policy/",
+        "/api/policy/delete/": "/api/policy/",
+    }
+
+    def __init__(self, file_path, ttl, arl_url):
+        self.file_path = file_path
+        self.ttl = ttl
+        # 缓存文件只对同一个 ARL 有效
+        self.arl_url = arl_url
+        self._lock = threading.Lock()
+        self.entries = self._read()
+
+    def _read(self):
+        try:
+            with open(self.file_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get("arl_url") != self.arl_url:
+            return {}
+        return data.get("entries") or {}
+
+    def _write(self):
+        # 先写临时文件再替换，避免中断时留下写了一半的缓存
+        tmp_path = f"{self.file_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {"arl_url": self.arl_url, "entries": self.entries},
+                    f,
+                    ensure_ascii=False,
+                )
+            os.replace(tmp_path, self.file_path)
+        except OSError as e:
+            log_message(f"写入 ARL 列表缓存 {self.file_path} 失败: {e}", False)
+
+    @staticmethod
+    def probe(arl, path):
+        # 返回 [total, 第一条记录的摘要]，请求失败返回 None
+        page = arl.get_json(path, params={"page": 1, "size": 1})
+        if page is None or "items" not in page:
+            return None
+        head = (
+            json.dumps(page["items"][0], sort_keys=True, ensure_ascii=False)
+            if page["items"]
+            else ""
+        )
+        return [
+            page.get("total", 0),
+            hashlib.blake2b(head.encode(), digest_size=8).hexdigest(),
+        ]
+
+    def lookup(self, path, fingerprint):
+        with self._lock:
+            entry = self.entries.get(path)
+        if (
+            entry is None
+            or fingerprint is None
+            or time.time() - entry["fetched_at"] > self.ttl
+            or entry["fingerprint"] != fingerprint
+        ):
+            return None
+        return entry["items"]
+
+    def store(self, path, fingerprint, items):
+        with self._lock:
+            self.entries[path] = {
+                "fetched_at": time.time(),
+                "fingerprint": fingerprint,
+                "items": items,
+            }
+            self._write()
+
+    def invalidate_for(self, mutating_path):
+        path = self.MUTATING_PATHS.get(mutating_path)
+        if path is None:
+            return
+        with self._lock:
+            if self.entries.pop(path, None) is not None:
+                self._write()
+
+
 # 登录ARL
 def login_arl():
     arl_url = os.environ.get("BBDB_ARL_URL")
@@ -63,62 +412,184 @@ def login_arl():
         log_message("ARL URL, username or password is missing.", False)
         return None
 
-    data = {"username": username, "password": password}
-    headers = {"Content-Type": "application/json; charset=UTF-8"}
-
-    try:
-        response = requests.post(
-            arl_url + "/api/user/login", headers=headers, json=data, verify=False
+    arl = ArlClient(arl_url, username, password)
+    if ARL_LISTING_CACHE_TTL > 0:
+        arl.listing_cache = ArlListingCache(
+            ARL_LISTING_CACHE_FILE, ARL_LISTING_CACHE_TTL, arl.arl_url
         )
-        response.raise_for_status()
-    except requests.RequestException as e:
-        log_message(f"Request failed: {e}", False)
-        return None
-
-    try:
-        response_data = response.json()
-    except ValueError:
-        log_message("Failed to decode JSON response.", False)
-        return None
-
-    if response_data.get("code") != 200:
-        log_message(f"ARL login failed, error code: {response_data.get('code')}", False)
+    if not arl.login():
         return None
+    return arl
 
-    token = response_data.get("data", {}).get("token")
-    if not token:
-        log_message("Token is missing in the response.", False)
-        return None
-
-    log_message("ARL login successful")
-    return token
 
+def get_bbdb_data(db, name_keyword: str, business_ids=None) -> tuple:
+    """
+    从数据库中获取同步需要的数据
 
-def get_bbdb_data(db, name_keyword: str) -> tuple:
-    # 从数据库中获取所有的数据
+    有根域名的 business 通过一次 distinct 查询筛出，五张资产表按 BBDB_PROJECTIONS 只取同步用到的字段，
+    并在线程池中并发读取；传入 business_ids 时只读取这些业务（分片模式）
+    """
     # 获取 business 数据
-    businesses = list(db.business.find({"name": {"$regex": name_keyword}}))
+    business_filter = {"name": {"$regex": name_keyword}}
+    if business_ids is not None:
+        business_filter["_id"] = {"$in": list(business_ids)}
+    businesses = list(db.business.find(business_filter, BBDB_PROJECTIONS["business"]))
 
     # 过滤掉没有关联 root_domain 的 business
-    business_with_domains = []
-    for business in businesses:
-        business_id = str(business["_id"])
-        root_domains = list(db.root_domain.find({"business_id": business_id}))
-        if root_domains:
-            business_with_domains.append(business)
+    business_ids_with_domains = set(
+        db.root_domain.distinct(
+            "business_id",
+            {"business_id": {"$in": [str(business["_id"]) for business in businesses]}},
+        )
+    )
+    business_with_domains = [
+        business
+        for business in businesses
+        if str(business["_id"]) in business_ids_with_domains
+    ]
 
     business_ids = [str(business["_id"]) for business in business_with_domains]
 
-    # 一次性获取所有需要的表的数据，基于 business_id 进行筛选
-    root_domains = list(db.root_domain.find({"business_id": {"$in": business_ids}}))
-    sub_domains = list(db.sub_domain.find({"business_id": {"$in": business_ids}}))
-    sites = list(db.site.find({"business_id": {"$in": business_ids}}))
-    ips = list(db.ip.find({"business_id": {"$in": business_ids}}))
-    blacklists = list(db.blacklist.find({"business_id": {"$in": business_ids}}))
+    # 并发获取所有需要的表的数据，基于 business_id 进行筛选
+    def load_collection(collection):
+        return list(
+            db[collection].find(
+                {"business_id": {"$in": business_ids}}, BBDB_PROJECTIONS[collection]
+            )
+        )
+
+    collections = ["root_domain", "sub_domain", "site", "ip", "blacklist"]
+    with ThreadPoolExecutor(max_workers=len(collections)) as executor:
+        root_domains, sub_domains, sites, ips, blacklists = executor.map(
+            load_collection, collections
+        )
 
     return business_with_domains, root_domains, sub_domains, sites, ips, blacklists
 
 
+class BbdbWorkingSet:
+    """
+    main 运行期间的 bbdb 工作集，内容与 get_bbdb_data 的返回一致
+
+    各步骤插入文档后调用 record_inserts，用 insert_many 返回的 _id 原地更新工作集，
+    并同步更新每张表预期的 (文档数, 最大 _id)。refresh 时只探测这两个值，
+    与预期不一致说明有外部写入，才重新完整读取。
+    写入管线的任务在 asyncio.to_thread 的线程中调用 record_inserts，修改工作集时持有锁
+    """
+
+    COLLECTIONS = ("business", "root_domain", "sub_domain", "site", "ip", "blacklist")
+
+    def __init__(self, db, name_keyword, business_ids=None):
+        self.db = db
+        self.name_keyword = name_keyword
+        self.business_filter = business_ids
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        with self._lock:
+            self._reload()
+
+    def _reload(self):
+        (
+            self.businesses,
+            self.root_domains,
+            self.sub_domains,
+            self.sites,
+            self.ips,
+            self.blacklists,
+        ) = get_bbdb_data(self.db, self.name_keyword, self.business_filter)
+        self.business_ids = {str(business["_id"]) for business in self.businesses}
+        # 名称匹配但还没有根域名的 business，插入根域名后才进入工作集
+        self.pending_businesses = {}
+        self.expected = self.probe()
+
+    def probe(self):
+        return {
+            collection: (
+                self.db[collection].estimated_document_count(),
+                get_max_object_id(self.db[collection]),
+            )
+            for collection in self.COLLECTIONS
+        }
+
+    def data(self):
+        return (
+            self.businesses,
+            self.root_domains,
+            self.sub_domains,
+            self.sites,
+            self.ips,
+            self.blacklists,
+        )
+
+    def record_inserts(self, collection, documents, inserted_ids):
+        # 按 get_bbdb_data 的筛选条件把新文档加入工作集，只保留投影中的字段
+        with self._lock:
+            projection = BBDB_PROJECTIONS[collection]
+            target = {
+                "root_domain": self.root_domains,
+                "sub_domain": self.sub_domains,
+                "site": self.sites,
+                "ip": self.ips,
+                "blacklist": self.blacklists,
+            }.get(collection)
+            for document, inserted_id in zip(documents, inserted_ids):
+                # site 和 blacklist 的投影不含 business_id，先从原文档取出再做投影
+                business_id = document.get("business_id")
+                document = {key: document[key] for key in projection if key in document}
+                document["_id"] = inserted_id
+                if collection == "business":
+                    if re.search(self.name_keyword, document.get("name", "")):
+                        self.pending_businesses[str(inserted_id)] = document
+                    continue
+                if (
+                    collection == "root_domain"
+                    and business_id in self.pending_businesses
+                ):
+                    self.businesses.append(self.pending_businesses.pop(business_id))
+                    self.business_ids.add(business_id)
+                if business_id in self.business_ids:
+                    target.append(document)
+
+            count, max_id = self.expected[collection]
+            inserted_ids = list(inserted_ids)
+            if inserted_ids:
+                self.expected[collection] = (
+                    count + len(inserted_ids),
+                    max(
+                        [max_id, *inserted_ids] if max_id is not None else inserted_ids
+                    ),
+                )
+
+    def refresh(self):
+        # 探测到外部写入时重新读取，返回是否发生了重新读取
+        with self._lock:
+            if self.probe() == self.expected:
+                return False
+            log_message("检测到 bbdb 有外部写入，重新读取工作集")
+            self._reload()
+            return True
+
+
+def upsert_documents(db, collection, documents, working_set=None):
+    """
+    按 UPSERT_KEYS 中的键字段批量 upsert，依赖 bbdb_indexes 声明的唯一索引去重，
+    返回实际新插入的文档数，并把新插入的文档记录到工作集
+    """
+    upserted_ids = bulk_upsert(
+        db[collection], documents, UPSERT_KEYS[collection], MONGO_BATCH_SIZE
+    )
+    if working_set is not None and upserted_ids:
+        indexes = sorted(upserted_ids)
+        working_set.record_inserts(
+            collection,
+            [documents[index] for index in indexes],
+            [upserted_ids[index] for index in indexes],
+        )
+    return len(upserted_ids)
+
+
 def compare_business_and_arl(businesses, arl_all_scopes):
     arl_names = [asset_scope["name"] for asset_scope in arl_all_scopes]
     business_names = [business["name"] for business in businesses]
@@ -128,202 +599,502 @@ def compare_business_and_arl(businesses, arl_all_scopes):
 
 
 def insert_new_group_to_arl(
-    token, arl_url, business_only_asset_scopes, businesses, root_domains, sub_domains
+    arl, business_only_asset_scopes, businesses, root_domains, sub_domains
 ):
     # 获取所有的资产分组名称
-    arl_asset_scope_names = fetch_arl_asset_scope_names(token, arl_url)
+    arl_asset_scope_names = fetch_arl_asset_scope_names(arl)
+
+    # 预先按 business_id 分组，每个业务的域名只需一次字典查找；
+    # 历史数据中的 business_id 可能是 ObjectId，统一转为字符串作为键
+    business_ids = {business["name"]: str(business["_id"]) for business in businesses}
+    domain_names_by_business = defaultdict(list)
+    for domain in itertools.chain(root_domains, sub_domains):
+        domain_names_by_business[str(domain["business_id"])].append(domain["name"])
 
     for business_name in business_only_asset_scopes:
         # 检查资产分组是否已经存在
         if business_name in arl_asset_scope_names:
             continue
         # 获取对应的 business_id
-        business_id = next(
-            (
-                business["_id"]
-                for business in businesses
-                if business["name"] == business_name
-            ),
-            None,
-        )
+        business_id = business_ids.get(business_name)
 
         if not business_id:
             log_message(f"无法找到业务 {business_name} 的 ID")
             continue
 
-        # 获取对应的根域名和子域名
-        rootdomain_names = [
-            domain["name"]
-            for domain in root_domains
-            if ObjectId(domain["business_id"]) == business_id
-        ]
-        subdomain_names = [
-            domain["name"]
-            for domain in sub_domains
-            if ObjectId(domain["business_id"]) == business_id
-        ]
-
         # 合并去重，保持原有顺序，根域名在先
-        all_domains = rootdomain_names + subdomain_names
+        all_domains = list(dict.fromkeys(domain_names_by_business.get(business_id, [])))
         if all_domains:
-            scope = ",".join(list(set(all_domains)))
-            # 添加到 ARL 资产分组中
-            add_asset_scope(token, arl_url, business_name, scope)
+            scope = ",".join(all_domains)
+            # 添加到 ARL 资产分组中，复用上面已经获取的分组名称
+            add_asset_scope(arl, business_name, scope, arl_asset_scope_names)
+
+
+# add_asset_scope 的返回值
+AssetScopeResult = namedtuple("AssetScopeResult", ["created", "scope_id"])
+
+
+def is_valid_arl_domain(domain):
+    """
+    本地复现 ARL 对资产范围域名的校验：
+    由字母、数字和连字符组成的多级域名，每级不超过 63 个字符且不以连字符开头结尾，
+    不能是 IP，也不能本身就是公共后缀（例如 com.cn）
+    """
+    if not domain or len(domain) > 253 or "." not in domain:
+        return False
+    labels = domain.split(".")
+    if labels[-1].isdigit() or not all(
+        ARL_DOMAIN_LABEL_PATTERN.match(label) for label in labels
+    ):
+        return False
+    return get_root_domain(domain) is not None
+
+
+def filter_arl_scope_domains(domains):
+    # 提交前在本地去除 ARL 不接受的域名，返回 (有效域名列表, 无效域名列表)
+    normalized = normalize_hostnames(domains)
+    valid_domains, invalid_domains = [], normalized.ips + normalized.rejects
+    for domain in normalized.domains:
+        if is_valid_arl_domain(domain):
+            valid_domains.append(domain)
         else:
-            continue
+            invalid_domains.append(domain)
+    return valid_domains, invalid_domains
 
 
-def add_asset_scope(token, arl_url, name, scope):
-    # 获取所有的资产分组名称
-    arl_asset_scope_names = fetch_arl_asset_scope_names(token, arl_url)
+def add_asset_scope(arl, name, scope, arl_asset_scope_names=None):
+    """
+    新建 ARL 资产分组，返回 AssetScopeResult(created, scope_id)
+
+    created 表示本次调用创建了分组；ARL 创建成功但没有返回 scope_id 时 scope_id 为 None，
+    此时剩余批次无法追加。分组已存在、没有有效域名或创建失败时 created 为 False。
+    域名先在本地按 ARL 规则过滤；ARL 仍然拒绝并指出无效域名时，去掉该域名后把剩余部分作为一批重试，
+    没有指出具体域名时才把批次对半拆分，拆到单个域名仍被拒绝则视为无效域名。
+    第一批成功即创建分组，其余批次通过 /api/asset_scope/add/ 追加到该分组。
+    arl_asset_scope_names 为已经获取的分组名称集合，传入时不再重新读取分组列表，成功后会加入新分组名称
+    """
+    if arl_asset_scope_names is None:
+        arl_asset_scope_names = fetch_arl_asset_scope_names(arl)
 
     # 检查资产分组是否已经存在
     if name in arl_asset_scope_names:
-        return
-
-    scope_domains = scope.split(",")
-    while scope_domains:
-        data = {"scope_type": "domain", "name": name, "scope": ",".join(scope_domains)}
-        headers = {"Token": token, "Content-Type": "application/json; charset=UTF-8"}
-
-        # 发送请求
-        try:
-            response = requests.post(
-                arl_url + "/api/asset_scope/", headers=headers, json=data, verify=False
-            )
-            response.raise_for_status()
-        except requests.RequestException as e:
-            log_message(e, "出错了，请排查")
-            return None
+        return AssetScopeResult(False, None)
 
-        # 解析响应内容
-        try:
-            response_data = response.json()
-        except ValueError:
-            log_message(f"无法解析 {name} 响应内容")
-            return None
+    scope_domains, invalid_domains = filter_arl_scope_domains(scope.split(","))
+    if not scope_domains:
+        log_message(f"{name} 所有域名都是无效的,跳过插入")
+        return AssetScopeResult(False, None)
+
+    created = False
+    scope_id = None
+    pending = [scope_domains]
+    while pending:
+        batch = pending.pop()
+        if not created:
+            data = {"scope_type": "domain", "name": name, "scope": ",".join(batch)}
+            response_data = arl.post_json("/api/asset_scope/", json=data)
+        else:
+            data = {"scope_id": scope_id, "scope": ",".join(batch)}
+            response_data = arl.post_json("/api/asset_scope/add/", json=data)
+        if response_data is None:
+            log_message(f"添加资产分组 {name} 失败，请排查", False)
+            return AssetScopeResult(created, scope_id)
 
         if response_data.get("code") == 200:
-            break  # 插入成功,跳出循环
+            if not created:
+                created = True
+                scope_id = (response_data.get("data") or {}).get("scope_id")
+                arl_asset_scope_names.add(name)
+                if scope_id is None:
+                    if pending:
+                        log_message(
+                            f"资产分组 {name} 已创建但未返回 scope_id，剩余域名未添加"
+                        )
+                    return AssetScopeResult(created, None)
+            continue
+
+        invalid_domain = (response_data.get("data") or {}).get("scope")
+        if invalid_domain in batch:
+            # ARL 只指出第一个无效域名，去掉后剩余部分整批重试
+            invalid_domains.append(invalid_domain)
+            remaining = [domain for domain in batch if domain != invalid_domain]
+            if remaining:
+                pending.append(remaining)
+        elif len(batch) > 1:
+            # 没有指出具体域名，对半拆分找出被拒绝的部分
+            middle = len(batch) // 2
+            pending.extend((batch[middle:], batch[:middle]))
         else:
-            invalid_domain = response_data.get("data", {}).get("scope")
-            if invalid_domain:
-                # log_message(f"无效域名: {invalid_domain}, 将被移除")
-                scope_domains.remove(invalid_domain)
-            else:
-                log_message(f"未知错误: {response_data.get('message')}")
-                return None
+            log_message(f"{batch[0]} 被拒绝: {response_data.get('message')}")
+            invalid_domains.extend(batch)
 
-    if not scope_domains:
+    if invalid_domains:
+        log_message(f"{name} 有 {len(invalid_domains)} 个无效域名未插入")
+    if not created:
         log_message(f"{name} 所有域名都是无效的,跳过插入")
+    return AssetScopeResult(created, scope_id)
 
 
-def fetch_arl_asset_scope_names(token, arl_url):
-    asset_scopes = get_arl_scopes_pages(token, arl_url)
+def fetch_arl_asset_scope_names(arl):
+    asset_scopes = get_arl_scopes_pages(arl)
     return set(asset_scope["name"] for asset_scope in asset_scopes)
 
 
-def get_arl_scopes_pages(token, arl_url):
-    headers = {"Token": token, "Content-Type": "application/json; charset=UTF-8"}
-    size = 10
-    all_asset_scopes = []
-    page = 1
-    total_pages = None  # 初始化总页数为 None
-
-    while total_pages is None or page <= total_pages:
-        try:
-            response = requests.get(
-                arl_url + f"/api/asset_scope/?size={size}&page={page}",
-                headers=headers,
-                verify=False,
-            )
-            response.raise_for_status()
-            response_data = response.json()
-        except requests.RequestException as e:
-            log_message(f"Request failed: {e}")
-            break
-        except ValueError:
-            log_message("Failed to decode JSON response")
-            break
+def get_arl_list_pages(
+    arl, path, params=None, size=ARL_PAGE_SIZE, workers=ARL_PAGE_WORKERS
+):
+    """并发翻页读取 ARL 列表接口，按页码顺序返回所有 items"""
+    items = []
+    for page_items in iter_arl_list_pages(arl, path, params, size, workers):
+        items.extend(page_items)
+    return items
+
+
+def get_arl_complete_list(arl, path, params=None):
+    """
+    读取 ARL 列表接口的全部 items，读取到的条数与 total 不一致时返回 None
+
+    iter_arl_list_pages 会跳过读取失败的页面，结果要用于删除操作时改用这个函数，
+    有页面失败或读取期间列表发生变化都按不完整处理
+    """
+    first_page = arl.get_json(path, params={**(params or {}), "page": 1, "size": 1})
+    if first_page is None or "items" not in first_page:
+        log_message(f"{path} 读取 total 失败", False)
+        return None
+    total = first_page.get("total", 0)
+    items = get_arl_list_pages(arl, path, params)
+    if len(items) != total:
+        log_message(f"{path} 共 {total} 条记录，只读取到 {len(items)} 条", False)
+        return None
+    return items
 
-        if total_pages is None:
-            total = response_data.get("total", 0)
-            total_pages = (total + size - 1) // size  # 计算总页数
 
-        if "items" in response_data:
-            all_asset_scopes.extend(response_data["items"])
-        else:
-            log_message("响应中没有 'items' 键")
+def iter_arl_list_pages(
+    arl, path, params=None, size=ARL_PAGE_SIZE, workers=ARL_PAGE_WORKERS
+):
+    """
+    并发翻页读取 ARL 列表接口，按页码顺序逐页 yield items
+
+    先请求第 1 页拿到 total，再用线程池并发请求剩余页，已下载但还没轮到的页面最多缓存 workers 个。
+    每页条数取 size 和 ARL_MAX_PAGE_SIZE 中较小者，如果第 1 页返回的条数少于请求值
+    说明 ARL 对 size 做了截断，则以实际返回条数作为页大小；第 1 页请求失败时减半重试。
+    """
+    params = dict(params or {})
+    size = max(1, min(size, ARL_MAX_PAGE_SIZE))
+
+    # 读取第 1 页，失败时缩小页大小重试
+    while True:
+        first_page = arl.get_json(path, params={**params, "page": 1, "size": size})
+        if first_page is not None or size <= 10:
             break
+        size = max(10, size // 2)
+        log_message(f"{path} 第 1 页请求失败，页大小调整为 {size} 后重试", False)
 
-        page += 1  # 请求下一页
-
-    return all_asset_scopes
+    if first_page is None:
+        return
+    if "items" not in first_page:
+        log_message(f"{path} 响应中没有 'items' 键")
+        return
 
+    items = first_page["items"]
+    total = first_page.get("total", 0)
+    yield items
+    if len(items) >= total:
+        return
 
-def download_arl_assets(arl_url, token, asset_type):
-    # 可以是 "site", "domain", 或 "ip"
-    headers = {"Token": token}
-    initial_url = f"{arl_url}/api/{asset_type}/?page=1&size=10"
-    export_url_template = f"{arl_url}/api/{asset_type}/export/?size=10000"
+    # ARL 截断了页大小时，以实际返回的条数为准
+    if 0 < len(items) < size:
+        size = len(items)
+    total_pages = (total + size - 1) // size  # 计算总页数
 
-    # 尝试发送请求的函数
-    def try_request(url, max_attempts=3):
-        for attempt in range(max_attempts):
+    def fetch_page(page):
+        response_data = arl.get_json(
+            path, params={**params, "page": page, "size": size}
+        )
+        if response_data is None or "items" not in response_data:
+            log_message(f"{path} 第 {page} 页读取失败，已跳过", False)
+            return []
+        return response_data["items"]
+
+    page_numbers = iter(range(2, total_pages + 1))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # 滑动窗口：按页码顺序取结果，每取走一页再提交下一页
+        pending = deque(
+            executor.submit(fetch_page, page)
+            for page in itertools.islice(page_numbers, max(1, workers))
+        )
+        while pending:
+            future = pending.popleft()
+            next_page = next(page_numbers, None)
+            if next_page is not None:
+                pending.append(executor.submit(fetch_page, next_page))
+            yield future.result()
+
+
+def get_arl_cached_list(arl, path, fresh=False):
+    """
+    读取 ARL 列表接口的全部 items，配置了列表缓存时优先使用探测后仍然有效的本地缓存
+
+    探测只比较 total 和第一条记录，结果会用于删除操作时传 fresh=True，
+    跳过缓存直接读取完整列表，读取结果仍然写回缓存
+    """
+    cache = arl.listing_cache
+    if cache is None:
+        return get_arl_list_pages(arl, path)
+
+    fingerprint = cache.probe(arl, path)
+    items = None if fresh else cache.lookup(path, fingerprint)
+    if items is not None:
+        log_message(f"{path} 列表没有变化，使用本地缓存的 {len(items)} 条记录")
+        return items
+
+    items = get_arl_list_pages(arl, path)
+    # 只缓存完整读取的列表，有页面读取失败时下次重新读取
+    if fingerprint is not None and len(items) == fingerprint[0]:
+        cache.store(path, fingerprint, items)
+    return items
+
+
+def get_arl_scopes_pages(arl, fresh=False):
+    return get_arl_cached_list(arl, "/api/asset_scope/", fresh)
+
+
+def stream_arl_export_page(arl, export_url, params, page, emit):
+    """
+    逐行读取单个导出页面，每攒满 ARL_EXPORT_CHUNK_LINES 行调用一次 emit(lines)，整页读完返回 True
+
+    连接层面的错误已经由 ArlClient 重试，这里额外覆盖读取响应体时断流等情况：
+    还没有交出任何数据时单独重试该页面，最多重试 ARL_EXPORT_PAGE_RETRIES 次；
+    已经交出部分数据后再中断不能重试，返回 False。emit 返回 False 表示调用方不再需要数据，立即返回 False
+    """
+    for attempt in range(ARL_EXPORT_PAGE_RETRIES + 1):
+        export_response = arl.get(
+            export_url, params={**params, "page": page, "size": 10000}, stream=True
+        )
+        emitted = False
+        if export_response:
+            # ARL 导出接口不一定声明编码，未声明时按 utf-8 解码
+            export_response.encoding = export_response.encoding or "utf-8"
             try:
-                response = requests.get(url, headers=headers, timeout=10, verify=False)
-                response.raise_for_status()
-                return response
+                with export_response:
+                    chunk = []
+                    for line in export_response.iter_lines(decode_unicode=True):
+                        chunk.append(line)
+                        if len(chunk) >= ARL_EXPORT_CHUNK_LINES:
+                            emitted = True
+                            if not emit(chunk):
+                                return False
+                            chunk = []
+                    if chunk and not emit(chunk):
+                        return False
+                    tracing.add(bytes_received=export_response.raw.tell())
+                    return True
             except requests.RequestException as e:
-                log_message(f"请求失败，尝试次数 {attempt + 1}/{max_attempts}: {e}")
-                if attempt == max_attempts - 1:
-                    return None  # 最后一次尝试仍然失败，返回None
+                log_message(f"读取页面 {page} 失败: {e}", False)
+                if emitted:
+                    log_message(f"页面 {page} 已经交出部分数据，不再重试", False)
+                    return False
+
+        if attempt < ARL_EXPORT_PAGE_RETRIES:
+            log_message(
+                f"页面 {page} 下载失败，重试次数 {attempt + 1}/{ARL_EXPORT_PAGE_RETRIES}",
+                False,
+            )
+            arl._backoff(attempt)
+    return False
+
+
+class DigestSet:
+    """
+    导出去重用的 64 位摘要集合：开放寻址散列表存放在一个 array("Q") 中，
+    每条摘要约占 16 字节，不为每条摘要创建 Python 对象；0 用作空槽标记，摘要为 0 时按 1 处理
+    """
+
+    def __init__(self, capacity=1 << 16):
+        self._slots = array("Q", bytes(8 * capacity))
+        self._mask = capacity - 1
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, digest):
+        """加入摘要，已经存在时返回 False"""
+        digest = digest or 1
+        if (self._size + 1) * 2 > len(self._slots):
+            self._grow()
+        slots = self._slots
+        mask = self._mask
+        index = digest & mask
+        while True:
+            current = slots[index]
+            if current == 0:
+                slots[index] = digest
+                self._size += 1
+                return True
+            if current == digest:
+                return False
+            index = (index + 1) & mask
+
+    def _grow(self):
+        # 装载率超过一半时容量翻倍并重新放入所有摘要
+        old_slots = self._slots
+        self._slots = array("Q", bytes(16 * len(old_slots)))
+        self._mask = len(self._slots) - 1
+        self._size = 0
+        for digest in old_slots:
+            if digest:
+                self.add(digest)
+
+
+def iter_arl_assets(
+    arl,
+    asset_type,
+    params=None,
+    normalize=None,
+    batch_size=ARL_STREAM_BATCH_SIZE,
+    workers=ARL_EXPORT_WORKERS,
+    failed_pages=None,
+):
+    """
+    并发下载 ARL 导出数据，按页码顺序按批次 yield 去重后的列表
+
+    最多 workers 个页面同时下载，每个页面在自己的线程中边读边放入有界队列，
+    还没轮到的页面最多缓存 ARL_EXPORT_PAGE_CHUNKS 块，读满后暂停读取，整页不会一次读入内存；
+    去重只在 DigestSet 中保存每行 8 字节的摘要，normalize 可以在去重前对每行做规范化，返回空值的行会被丢弃。
+    重试后仍失败的页码会记录到 failed_pages 中，调用方据此判断数据是否完整
+    """
+    params = dict(params or {})
+    initial_url = f"/api/{asset_type}/"
+    export_url = f"/api/{asset_type}/export/"
 
     # 发送初始请求获取总数量
-    response = try_request(initial_url)
-    if not response:
+    data = arl.get_json(initial_url, params={**params, "page": 1, "size": 10})
+    if data is None:
         log_message("无法获取资产总量，终止操作")
-        return []
-    data = response.json()
+        if failed_pages is not None:
+            failed_pages.append(0)
+        return
     total = data.get("total", 0)
 
     # 计算需要请求的页数
     pages = (total + 9999) // 10000  # 每页最多10000条，计算需要请求的页数
 
-    # 收集导出的数据
-    exported_data = set()
-    for page in range(1, pages + 1):
-        export_url = f"{export_url_template}&page={page}"
-        export_response = try_request(export_url)
-        if not export_response:
-            log_message(f"跳过页面 {page}，因为请求失败")
-            continue
+    seen = DigestSet()
+    batch = []
+    page_numbers = iter(range(1, pages + 1))
+    # 调用方提前结束迭代时通知还在读取的页面线程退出
+    stop = threading.Event()
+
+    def start_page(executor, page):
+        # 页面线程把读到的行块放入 chunks，最后放入表示是否完整读取的 True/False
+        chunks = queue.Queue(maxsize=ARL_EXPORT_PAGE_CHUNKS)
+
+        def emit(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def read_page():
+            completed = False
+            try:
+                completed = stream_arl_export_page(arl, export_url, params, page, emit)
+            finally:
+                emit(completed)
+
+        return page, chunks, executor.submit(read_page)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        try:
+            # 滑动窗口：按页码顺序读取，每读完一页再提交下一页
+            pending = deque(
+                start_page(executor, page)
+                for page in itertools.islice(page_numbers, max(1, workers))
+            )
+            while pending:
+                page, chunks, future = pending.popleft()
+                next_page = next(page_numbers, None)
+                if next_page is not None:
+                    pending.append(start_page(executor, next_page))
+
+                while True:
+                    lines = chunks.get()
+                    if isinstance(lines, bool):
+                        break
+                    for line in lines:
+                        if normalize is not None:
+                            line = normalize(line)
+                        if not line:
+                            continue
+                        digest = int.from_bytes(
+                            hashlib.blake2b(line.encode(), digest_size=8).digest(),
+                            "little",
+                        )
+                        if not seen.add(digest):
+                            continue
+                        batch.append(line)
+                        if len(batch) >= batch_size:
+                            yield batch
+                            batch = []
+                future.result()
+
+                if not lines:
+                    log_message(f"页面 {page} 读取失败，数据不完整", False)
+                    if failed_pages is not None:
+                        failed_pages.append(page)
+        finally:
+            stop.set()
+
+    if batch:
+        yield batch
+
+
+def download_arl_assets(arl, asset_type, params=None):
+    # 可以是 "site", "domain", 或 "ip"，params 为附加的 ARL 查询条件
+    return [
+        line for batch in iter_arl_assets(arl, asset_type, params) for line in batch
+    ]
+
 
-        # 将返回的文本内容按行分割，添加到集合中去重
-        lines = export_response.text.splitlines()
-        exported_data.update(lines)
+def find_ids_by_name(db, collection, names):
+    """按 MONGO_BATCH_SIZE 分批用 $in 查询名称，返回 {name: _id 字符串}，不存在的名称不在其中"""
+    names = list(names)
+    ids = {}
+    for start in range(0, len(names), MONGO_BATCH_SIZE):
+        for document in db[collection].find(
+            {"name": {"$in": names[start : start + MONGO_BATCH_SIZE]}}, {"name": 1}
+        ):
+            ids[document["name"]] = str(document["_id"])
+    return ids
 
-    # 将集合转换为列表返回
-    return list(exported_data)
 
+def insert_new_group_to_bbdb(
+    db, arl_only_asset_scopes, arl_all_scopes, working_set=None
+):
+    """
+    把只在 ARL 中存在的分组插入 bbdb，传入 working_set 时同步记录插入的文档
+
+    已存在的分组一次 $in 查询得到，根域名和子域名按名称批量 upsert，
+    每个分组的数据库往返次数与域名数量无关
+    """
+    scopes_by_name = {
+        asset_scope["name"]: asset_scope for asset_scope in arl_all_scopes
+    }
+    existing_businesses = find_ids_by_name(db, "business", arl_only_asset_scopes)
 
-def insert_new_group_to_bbdb(db, arl_only_asset_scopes, arl_all_scopes):
     for arl_name in arl_only_asset_scopes:
         # 找到对应的资产分组
-        asset_scope = next(
-            (
-                asset_scope
-                for asset_scope in arl_all_scopes
-                if asset_scope["name"] == arl_name
-            ),
-            None,
-        )
+        asset_scope = scopes_by_name.get(arl_name)
         if asset_scope is None:
             log_message(f"无法找到资产分组 {arl_name}")
             continue
 
         # 检查 business 是否已存在
-        if db["business"].find_one({"name": arl_name}):
+        if arl_name in existing_businesses:
             continue
 
         # 创建 business
@@ -334,22 +1105,17 @@ def insert_new_group_to_bbdb(db, arl_only_asset_scopes, arl_all_scopes):
             "create_time": datetime.now(),
             "update_time": datetime.now(),
         }
-        business_id = db["business"].insert_one(business).inserted_id
-
-        # 提取所有域名
-        all_domains = asset_scope["scope_array"]
-
-        # 提取每个域名的绝对根域名
-        absolute_root_domains = []
-        pattern = r"[\w-]+\.[\w-]+$"
-        for domain in all_domains:
-            match = re.search(pattern, domain)
-            if match:
-                root_domain = match.group()
-                absolute_root_domains.append(root_domain)
-
-        # 去重
-        absolute_root_domains = list(set(absolute_root_domains))
+        inserted_id = db["business"].insert_one(business).inserted_id
+        if working_set is not None:
+            working_set.record_inserts("business", [business], [inserted_id])
+        business_id = str(inserted_id)
+
+        # 提取所有域名，每个域名只解析一次绝对根域名
+        all_domains = list(dict.fromkeys(asset_scope["scope_array"]))
+        root_by_domain = dict(zip(all_domains, get_root_domains(all_domains)))
+        absolute_root_domains = sorted(
+            {root_domain for root_domain in root_by_domain.values() if root_domain}
+        )
 
         # 如果绝对根域名列表为空，则全部视为子域名
         if not absolute_root_domains:
@@ -364,107 +1130,140 @@ def insert_new_group_to_bbdb(db, arl_only_asset_scopes, arl_all_scopes):
                     "update_time": datetime.now(),
                 }
                 for domain in all_domains
-                if not db["sub_domain"].find_one({"name": domain})
-            ]
-            if sub_domains_to_insert:
-                db["sub_domain"].insert_many(sub_domains_to_insert)
-        else:
-            # 将原有读取的域名中的剩下的域名作为子域名
-            remaining_domains = list(set(all_domains) - set(absolute_root_domains))
-
-            # 插入根域名
-            root_domains_to_insert = [
-                {
-                    "name": domain,
-                    "icpregnum": "",
-                    "business_id": business_id,
-                    "notes": "from arl",
-                    "create_time": datetime.now(),
-                    "update_time": datetime.now(),
-                }
-                for domain in absolute_root_domains
-                if not db["root_domain"].find_one({"name": domain})
             ]
-            if root_domains_to_insert:
-                root_domain_insert_result = db["root_domain"].insert_many(
-                    root_domains_to_insert
-                )
-                root_domain_ids = root_domain_insert_result.inserted_ids
-
-            # 插入子域名
-            sub_domains_to_insert = []
-            for domain in remaining_domains:
-                # 获取对应的 root_domain_id
-                root_domain_id = next(
-                    (
-                        _id
-                        for _id, root_domain in zip(
-                            root_domain_ids, absolute_root_domains
-                        )
-                        if root_domain == re.search(pattern, domain).group()
-                    ),
-                    None,
-                )
-                if root_domain_id is not None and not db["sub_domain"].find_one(
-                    {"name": domain}
-                ):
-                    sub_domain_data = {
-                        "name": domain,
-                        "icpregnum": "",
-                        "root_domain_id": root_domain_id,
-                        "business_id": business_id,
-                        "notes": "from arl",
-                        "create_time": datetime.now(),
-                        "update_time": datetime.now(),
-                    }
-                    sub_domains_to_insert.append(sub_domain_data)
-
-            if sub_domains_to_insert:
-                db["sub_domain"].insert_many(sub_domains_to_insert)
-
+            upsert_documents(db, "sub_domain", sub_domains_to_insert, working_set)
+            continue
 
-def delete_policy(arl_url, token, policy_id):
-    # 删除arl中某个指定策略
-    delete_url = f"{arl_url}/api/policy/delete/"
-    headers = {"Content-Type": "application/json; charset=UTF-8", "token": token}
+        # 插入根域名
+        root_domains_to_insert = [
+            {
+                "name": domain,
+                "icpregnum": "",
+                "business_id": business_id,
+                "notes": "from arl",
+                "create_time": datetime.now(),
+                "update_time": datetime.now(),
+            }
+            for domain in absolute_root_domains
+        ]
+        upsert_documents(db, "root_domain", root_domains_to_insert, working_set)
+        # 新插入的和原本已存在的根域名一起按名称查出 _id
+        root_domain_ids = find_ids_by_name(db, "root_domain", absolute_root_domains)
+
+        # 将原有读取的域名中的剩下的域名作为子域名，通过字典找到对应的 root_domain_id
+        sub_domains_to_insert = [
+            {
+                "name": domain,
+                "icpregnum": "",
+                "root_domain_id": root_domain_ids[root_domain],
+                "business_id": business_id,
+                "notes": "from arl",
+                "create_time": datetime.now(),
+                "update_time": datetime.now(),
+            }
+            for domain, root_domain in root_by_domain.items()
+            if domain != root_domain and root_domain in root_domain_ids
+        ]
+        upsert_documents(db, "sub_domain", sub_domains_to_insert, working_set)
+
+
+class PolicyCache:
+    """
+    ARL 策略的内存缓存，按策略 _id、名称和 scope_id 建立索引
+
+    每次运行只从 ARL 读取一次策略列表，之后通过 add_policy/delete_policy 原地更新，
+    查找某个分组的策略不再需要遍历列表或者重新请求 ARL
+    """
+
+    def __init__(self, policies=()):
+        self.by_id = {}
+        self.by_name = {}
+        self.by_scope_id = {}
+        for policy in policies:
+            self.add(policy)
+
+    @classmethod
+    def load(cls, arl):
+        return cls(get_arl_all_policies(arl))
+
+    @staticmethod
+    def scope_id_of(policy):
+        return (policy.get("policy") or {}).get("scope_config", {}).get("scope_id")
+
+    def add(self, policy):
+        # 同名或同 _id 的旧策略先移除，保证三个索引一致
+        for stale in (self.by_id.get(policy["_id"]), self.by_name.get(policy["name"])):
+            if stale is not None:
+                self.remove(stale["_id"])
+        self.by_id[policy["_id"]] = policy
+        self.by_name[policy["name"]] = policy
+        scope_id = self.scope_id_of(policy)
+        if scope_id is not None:
+            self.by_scope_id[scope_id] = policy
+
+    def remove(self, policy_id):
+        policy = self.by_id.pop(policy_id, None)
+        if policy is None:
+            return
+        if self.by_name.get(policy["name"]) is policy:
+            del self.by_name[policy["name"]]
+        scope_id = self.scope_id_of(policy)
+        if self.by_scope_id.get(scope_id) is policy:
+            del self.by_scope_id[scope_id]
+
+    def get_by_name(self, name):
+        return self.by_name.get(name)
+
+    def get_by_scope_id(self, scope_id):
+        return self.by_scope_id.get(scope_id)
+
+    def policy_id_for_scope(self, scope_id):
+        policy = self.by_scope_id.get(scope_id)
+        return policy["_id"] if policy is not None else None
+
+    def scope_ids(self):
+        return self.by_scope_id.keys()
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+def delete_policy(arl, policy_id, policy_cache=None):
+    # 删除arl中某个指定策略，成功后同步更新策略缓存
     data = {"policy_id": [policy_id]}
 
-    try:
-        response = requests.post(delete_url, headers=headers, json=data, verify=False)
-        response.raise_for_status()
-        if response.json().get("code") == 200:
-            log_message(f"策略 {policy_id} 删除成功")
-        else:
-            log_message(
-                f"策略 {policy_id} 删除失败: {response.json().get('message')}", False
-            )
-    except requests.RequestException as e:
-        log_message(f"删除策略请求失败: {e}", False)
+    response_data = arl.post_json("/api/policy/delete/", json=data)
+    if response_data is None:
+        log_message(f"删除策略 {policy_id} 请求失败", False)
+    elif response_data.get("code") == 200:
+        log_message(f"策略 {policy_id} 删除成功")
+        if policy_cache is not None:
+            policy_cache.remove(policy_id)
+        return True
+    else:
+        log_message(f"策略 {policy_id} 删除失败: {response_data.get('message')}", False)
+    return False
 
 
-def add_policy(arl_url, token, policy_name, scope_id):
-    # 添加策略，并返回新添加的策略的policy_id
+def add_policy(arl, policy_name, scope_id, policy_cache=None):
+    # 添加策略，并返回新添加的策略的policy_id；传入策略缓存时不再重新读取全部策略
 
-    # 获取所有的策略
-    arl_all_policies = get_arl_all_policies(arl_url, token)
+    if policy_cache is None:
+        policy_cache = PolicyCache.load(arl)
 
     # 检查策略是否已经存在
-    policy_to_delete = None
-
-    for policy in arl_all_policies:
-        if policy["name"] == policy_name:
-            if policy["policy"]["scope_config"]["scope_id"] == scope_id:
-                log_message(f"策略 {policy_name} 已存在且 scope_id 匹配，跳过添加")
-                return
-            else:
-                policy_to_delete = policy["_id"]
-                break
-
-    if policy_to_delete:
+    policy = policy_cache.get_by_name(policy_name)
+    if policy is not None:
+        if PolicyCache.scope_id_of(policy) == scope_id:
+            log_message(f"策略 {policy_name} 已存在且 scope_id 匹配，跳过添加")
+            return
         log_message(
             f"策略 {policy_name} 存在但是与 scope_id 不对应，尝试删除后重新添加"
         )
-        delete_policy(arl_url, token, policy_to_delete)
+        delete_policy(arl, policy["_id"], policy_cache)
 
     # 准备请求参数
     payload = {
@@ -945,100 +1744,49 @@ def add_policy(arl_url, token, policy_name, scope_id):
         },
     }
 
-    # 准备请求参数
-    headers = {"Token": token, "Content-Type": "application/json; charset=UTF-8"}
-
     # 发送请求
-    try:
-        response = requests.post(
-            arl_url + "/api/policy/add/", headers=headers, json=payload, verify=False
-        )
-        response.raise_for_status()
-    except requests.RequestException as e:
-        log_message(e, "出错了，请排查")
-        return None
-
-    # 检查响应是否有效
-    try:
-        response_data = response.json()
-    except ValueError:
-        log_message(f"无法解析ADD {policy_name} 策略的响应内容")
+    response_data = arl.post_json("/api/policy/add/", json=payload)
+    if response_data is None:
+        log_message(f"添加 {policy_name} 策略失败，请排查", False)
         return None
 
     policy_id = response_data.get("data", {}).get("policy_id")
+    if policy_id:
+        # 用提交的内容更新缓存，后续查找不用再请求 ARL
+        policy_cache.add(
+            {
+                "_id": policy_id,
+                "name": policy_name,
+                "desc": payload["desc"],
+                "policy": payload["policy"],
+            }
+        )
     # 返回策略ID
     return policy_id
 
 
-def get_arl_all_policies(arl_url, token):
-    headers = {"Token": token, "Content-Type": "application/json; charset=UTF-8"}
-    size = 10
-    all_policies = []
-    page = 1
-    total_pages = None  # 初始化总页数为 None
-
-    while total_pages is None or page <= total_pages:
-        try:
-            response = requests.get(
-                arl_url + f"/api/policy/?size={size}&page={page}",
-                headers=headers,
-                verify=False,
-            )
-            response.raise_for_status()
-            response_data = response.json()
-        except requests.RequestException as e:
-            log_message(e, "出错了，请排查")
-            break
-        except ValueError:
-            log_message("无法解析响应内容")
-            break
-
-        if total_pages is None:
-            total = response_data.get("total", 0)
-            total_pages = (total + size - 1) // size  # 计算总页数
-
-        if "items" in response_data:
-            all_policies.extend(response_data["items"])
-        else:
-            log_message("响应中没有 'items' 键")
-            break
-
-        page += 1  # 请求下一页
-
-    return all_policies
-
+def get_arl_all_policies(arl):
+    return get_arl_cached_list(arl, "/api/policy/")
 
-def configure_scanning_policies(arl_url, token, arl_scope_ids, arl_all_scopes):
-    # 为没有配置策略的资产组添加策略
-
-    # 获取所有的策略
-    arl_all_policies = get_arl_all_policies(arl_url, token)
 
-    # 从策略中提取所有的 scope_id
-    policy_scope_ids = [
-        policy["policy"]["scope_config"]["scope_id"]
-        for policy in arl_all_policies
-        if "scope_config" in policy["policy"]
-        and "scope_id" in policy["policy"]["scope_config"]
-    ]
+def configure_scanning_policies(arl, arl_scope_ids, arl_all_scopes, policy_cache):
+    # 为没有配置策略的资产组添加策略，新增和删除的策略会同步更新到 policy_cache
 
     # 找出没有配置策略的资产组
-    unconfigured_asset_group_ids = list(set(arl_scope_ids) - set(policy_scope_ids))
+    unconfigured_asset_group_ids = get_unconfigured_asset_group_ids(
+        arl_scope_ids, policy_cache
+    )
+    scope_names = {
+        asset_scope["_id"]: asset_scope["name"] for asset_scope in arl_all_scopes
+    }
 
     # 为没有配置策略的资产组添加策略
     for scope_id in unconfigured_asset_group_ids:
         # 找到对应的资产分组名称
-        asset_group_name = next(
-            (
-                asset_scope["name"]
-                for asset_scope in arl_all_scopes
-                if asset_scope["_id"] == scope_id
-            ),
-            None,
-        )
+        asset_group_name = scope_names.get(scope_id)
         if asset_group_name is not None:
             try:
-                policy_id = add_policy(arl_url, token, asset_group_name, scope_id)
+                policy_id = add_policy(arl, asset_group_name, scope_id, policy_cache)
                 if policy_id:
                     log_message(f"新的分组策略已添加：{asset_group_name}")
             except Exception as e:
@@ -1049,25 +1797,12 @@ def configure_scanning_policies(arl_url, token, arl_scope_ids, arl_all_scopes):
     return unconfigured_asset_group_ids
 
 
-def get_unconfigured_asset_group_ids(arl_url, token, arl_scope_ids):
-    # 获取所有的策略
-    arl_all_policies = get_arl_all_policies(arl_url, token)
-
-    # 从策略中提取所有的 scope_id
-    policy_scope_ids = [
-        policy["policy"]["scope_config"]["scope_id"]
-        for policy in arl_all_policies
-        if "scope_config" in policy["policy"]
-        and "scope_id" in policy["policy"]["scope_config"]
-    ]
-
-    # 找出没有配置策略的资产组
-    unconfigured_asset_group_ids = list(set(arl_scope_ids) - set(policy_scope_ids))
-
-    return unconfigured_asset_group_ids
+def get_unconfigured_asset_group_ids(arl_scope_ids, policy_cache):
+    # 找出没有配置策略的资产组
+    return list(set(arl_scope_ids) - set(policy_cache.scope_ids()))
 
 
-def add_scheduler(token, arl_url, scope_id, domain, policy_id):
+def add_scheduler(arl, scope_id, domain, policy_id):
     # 准备请求数据
     data = {
         "scope_id": scope_id,
@@ -1076,55 +1811,152 @@ def add_scheduler(token, arl_url, scope_id, domain, policy_id):
         "policy_id": policy_id,
         "name": "",
     }
-    headers = {"Token": token, "Content-Type": "application/json; charset=UTF-8"}
 
     # 发送请求
-    try:
-        response = requests.post(
-            arl_url + "/api/scheduler/add/", headers=headers, json=data, verify=False
-        )
-        response.raise_for_status()
-    except requests.RequestException as e:
-        return
+    response_data = arl.post_json("/api/scheduler/add/", json=data)
+    if response_data is None or response_data.get("code") != 200:
+        log_message(f"分组 {scope_id} 添加监控任务失败，请排查", False)
+        return False
+    return True
 
 
-def check_scheduler_exists(token, arl_url, domain):
-    headers = {"Token": token, "Content-Type": "application/json; charset=UTF-8"}
-    try:
-        response = requests.get(
-            arl_url + f"/api/scheduler/?domain={domain}", headers=headers, verify=False
-        )
-        response.raise_for_status()
-    except requests.RequestException as e:
-        log_message(e, "出错了，请排查")
-        return False
+def get_arl_all_schedulers(arl):
+    # 读取不完整时返回 None
+    return get_arl_complete_list(arl, "/api/scheduler/")
 
-    response_data = response.json()
-    if response_data and response_data.get("total", 0) > 0:
-        return True
-    else:
+
+def delete_schedulers(arl, job_ids):
+    # 批量删除arl中的监控任务
+    response_data = arl.post_json("/api/scheduler/delete/", json={"job_id": job_ids})
+    if response_data is None or response_data.get("code") != 200:
+        log_message(f"删除 {len(job_ids)} 个监控任务失败，请排查", False)
         return False
+    return True
 
 
-def add_site_monitor(token, arl_url, scope_id):
+def add_site_monitor(arl, scope_id):
     # 准备请求数据
     data = {
         "scope_id": scope_id,
         "interval": 86400,
     }
-    headers = {"Token": token, "Content-Type": "application/json; charset=UTF-8"}
 
     # 发送请求
-    try:
-        response = requests.post(
-            arl_url + "/api/scheduler/add/site_monitor/",
-            headers=headers,
-            json=data,
-            verify=False,
-        )
-        response.raise_for_status()
-    except requests.RequestException as e:
-        log_message(e, "出错了，请排查")
+    response_data = arl.post_json("/api/scheduler/add/site_monitor/", json=data)
+    if response_data is None or response_data.get("code") != 200:
+        log_message(f"分组 {scope_id} 添加站点监控失败，请排查", False)
+        return False
+    return True
+
+
+def is_site_monitor_scheduler(scheduler):
+    # 站点更新监控任务和域名监控任务在同一个列表中，用 scope_type 区分
+    return scheduler.get("scope_type") == SITE_MONITOR_SCOPE_TYPE
+
+
+def reconcile_schedulers(arl, arl_all_scopes, policy_cache):
+    """
+    对账 ARL 中的监控任务，只补齐缺失的、删除重复或过期的任务
+
+    期望状态：每个有策略的资产分组，其 scope_array 中的每个域名都被一个使用该分组策略的域名监控任务覆盖，
+    并且有且只有一个站点更新监控任务。
+    已有任务的策略与分组策略不一致、包含已不在分组中的域名或者与其他任务重复时删除，
+    其中仍需监控的域名会和缺失的域名合并成一个任务重新添加。
+    不属于任何已知资产分组的任务只记录数量，不做删除，避免分组列表读取不完整时误删。
+    监控任务列表读取不完整时放弃本次对账，否则漏读的任务会被重复添加或者误判为重复删除。
+    """
+    stats = {"added": 0, "removed": 0, "site_monitors_added": 0}
+
+    all_schedulers = get_arl_all_schedulers(arl)
+    if all_schedulers is None:
+        log_message("监控任务列表读取不完整，跳过本次对账", False)
+        return stats
+
+    domain_jobs = defaultdict(list)
+    site_jobs = defaultdict(list)
+    for scheduler in all_schedulers:
+        jobs = site_jobs if is_site_monitor_scheduler(scheduler) else domain_jobs
+        jobs[scheduler.get("scope_id")].append(scheduler)
+
+    job_ids_to_delete = []
+    for asset_scope in arl_all_scopes:
+        scope_id = asset_scope["_id"]
+        policy_id = policy_cache.policy_id_for_scope(scope_id)
+        if policy_id is None:
+            log_message(f"No policy found for scope_id {scope_id}")
+            continue
+
+        desired_domains = set(asset_scope.get("scope_array") or [])
+        covered_domains = set()
+        for job in domain_jobs.get(scope_id, []):
+            job_domains = set(filter(None, job.get("domain", "").split(",")))
+            if (
+                job.get("policy_id") not in (None, policy_id)
+                or not job_domains <= desired_domains
+                or job_domains <= covered_domains
+            ):
+                job_ids_to_delete.append(job["_id"])
+            else:
+                covered_domains |= job_domains
+
+        missing_domains = desired_domains - covered_domains
+        if missing_domains and add_scheduler(
+            arl, scope_id, ",".join(sorted(missing_domains)), policy_id
+        ):
+            stats["added"] += len(missing_domains)
+
+        # 站点更新监控任务每个分组保留一个
+        scope_site_jobs = site_jobs.get(scope_id, [])
+        if not scope_site_jobs:
+            if add_site_monitor(arl, scope_id):
+                stats["site_monitors_added"] += 1
+        else:
+            job_ids_to_delete.extend(job["_id"] for job in scope_site_jobs[1:])
+
+    known_scope_ids = {asset_scope["_id"] for asset_scope in arl_all_scopes}
+    orphan_jobs = sum(
+        len(jobs)
+        for jobs_by_scope in (domain_jobs, site_jobs)
+        for scope_id, jobs in jobs_by_scope.items()
+        if scope_id not in known_scope_ids
+    )
+    if orphan_jobs:
+        log_message(f"有 {orphan_jobs} 个监控任务不属于已知的资产分组，未做处理")
+
+    if job_ids_to_delete and delete_schedulers(arl, job_ids_to_delete):
+        stats["removed"] = len(job_ids_to_delete)
+
+    return stats
+
+
+def build_domain_suffix_index(domain_map):
+    """
+    把 {域名: 文档} 构造成按反转标签组织的后缀树，例如 example.com 存放在 ["com"]["example"] 下，
+    叶子节点用空字符串键保存对应文档
+    """
+    suffix_index = {}
+    for name, document in domain_map.items():
+        node = suffix_index
+        for label in reversed(name.split(".")):
+            node = node.setdefault(label, {})
+        node[""] = document
+    return suffix_index
+
+
+def iter_domain_suffix_matches(suffix_index, domain, min_labels=2):
+    """
+    从右往左逐个标签查找后缀树，按后缀从短到长依次 yield (匹配到的后缀, 文档)
+    """
+    labels = domain.split(".")
+    node = suffix_index
+    depth = 0
+    for label in reversed(labels):
+        node = node.get(label)
+        if node is None:
+            return
+        depth += 1
+        if depth >= min_labels and "" in node:
+            yield ".".join(labels[-depth:]), node[""]
 
 
 def prepare_domains_for_arl_insertion(
@@ -1132,53 +1964,36 @@ def prepare_domains_for_arl_insertion(
 ):
     # 准备从bbdb插入arl域名中的数据结构
     businesses_ids = {str(business["_id"]): business for business in businesses}
+    # 资产分组名称 -> scope_id，名称重复时保留第一个，与原来的顺序查找一致
+    scope_ids = {}
+    for scope in arl_all_scopes:
+        scope_ids.setdefault(scope["name"], scope["_id"])
+    # 根域名按反转标签建立后缀索引，每个域名只需从右往左走一遍
+    root_suffix_index = build_domain_suffix_index(root_domains_set)
     # 使用字典来确保每个资产分组只处理一次
     insertion_data = {}
 
     # 遍历需要插入ARL的域名
-    for domain in list(domains_to_arl):  # 创建一个副本以避免在迭代中修改原始列表
-        parts = domain.split(".")
-        for i in range(2, min(4, len(parts) + 1)):
-            root_domain_candidate = ".".join(parts[-i:])
-            if root_domain_candidate in root_domains_set:
-                root_domain = root_domains_set[root_domain_candidate]
-                business_id = str(root_domain["business_id"])
-                business = businesses_ids.get(business_id)
-                if business:
-                    business_name = business["name"]
-                    # 查找对应的ARL资产分组ID
-                    scope_id = next(
-                        (
-                            scope["_id"]
-                            for scope in arl_all_scopes
-                            if scope["name"] == business_name
-                        ),
-                        None,
-                    )
-                    if scope_id:
-                        # 如果资产分组已存在于insertion_data中，则直接添加域名到对应的scope中
-                        if scope_id in insertion_data:
-                            insertion_data[scope_id]["scope"].add(domain)
-                        else:
-                            # 收集同一资产分组下的所有域名
-                            related_domains = set(
-                                [
-                                    d
-                                    for d in domains_to_arl
-                                    if d.endswith(root_domain_candidate)
-                                ]
-                            )
-                            # 初始化资产分组条目
-                            insertion_data[scope_id] = {
-                                "scope_id": scope_id,
-                                "business_name": business_name,
-                                "scope": related_domains,
-                            }
-                        # 从domains_to_arl中删除已处理的域名
-                        domains_to_arl = [
-                            d for d in domains_to_arl if d not in related_domains
-                        ]
-                        break
+    for domain in domains_to_arl:
+        # 从短到长尝试候选根域名，直到找到对应的业务和资产分组
+        for _, root_domain in iter_domain_suffix_matches(root_suffix_index, domain):
+            business = businesses_ids.get(str(root_domain["business_id"]))
+            if not business:
+                continue
+            business_name = business["name"]
+            # 查找对应的ARL资产分组ID
+            scope_id = scope_ids.get(business_name)
+            if not scope_id:
+                continue
+            # 同一资产分组下的域名归到一起
+            if scope_id not in insertion_data:
+                insertion_data[scope_id] = {
+                    "scope_id": scope_id,
+                    "business_name": business_name,
+                    "scope": set(),
+                }
+            insertion_data[scope_id]["scope"].add(domain)
+            break
 
     # 将insertion_data字典转换为所需的列表格式，并将scope集合转换为字符串
     final_data = [
@@ -1193,366 +2008,745 @@ def prepare_domains_for_arl_insertion(
     return final_data
 
 
+def load_sync_state(db, asset_type):
+    # 读取 sync_state 集合中某类资产的同步水位，不存在时返回 None
+    return db.sync_state.find_one({"name": f"arl_{asset_type}"})
+
+
+def save_sync_state(db, asset_type, fields):
+    # 更新某类资产的同步水位，不存在时创建
+    now = datetime.now()
+    db.sync_state.update_one(
+        {"name": f"arl_{asset_type}"},
+        {
+            "$set": {**fields, "update_time": now},
+            "$setOnInsert": {"notes": ARL_SYNC_NOTES, "create_time": now},
+        },
+        upsert=True,
+    )
+
+
+def is_full_sync_due(sync_state, now):
+    # 没有水位或者距离上次全量对账超过 SYNC_FULL_INTERVAL_HOURS 时进行全量同步
+    if not sync_state or not sync_state.get("arl_watermark"):
+        return True
+    last_full_sync = sync_state.get("last_full_sync")
+    if not last_full_sync:
+        return True
+    return now - last_full_sync >= timedelta(hours=SYNC_FULL_INTERVAL_HOURS)
+
+
+def get_max_object_id(collection):
+    # 获取集合中最大的 _id，用于记录 bbdb 侧的同步水位
+    document = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    return document["_id"] if document else None
+
+
+def filter_domain_names(domains, blacklist_domains=frozenset()):
+    # 统一小写并去除首尾的点，排除IP、无效值和黑名单域名，结果直接写入紧凑集合
+    return DomainSet(
+        value
+        for kind, value in iter_normalized_hostnames(domains, blacklist_domains)
+        if kind == HOSTNAME_DOMAIN
+    )
+
+
+def build_sub_domain_documents(new_domains_to_bbdb, root_domains_set):
+    # 为需要插入bbdb的新域名匹配根域名，构造sub_domain文档
+    sub_domains_to_add = []
+    # bbdb中有些根域名并不是公共后缀意义上的根域名，按后缀索引兜底匹配
+    root_suffix_index = None
+    new_domains_to_bbdb = list(new_domains_to_bbdb)
+    for domain, root_domain_name in zip(
+        new_domains_to_bbdb, get_root_domains(new_domains_to_bbdb)
+    ):
+        if (
+            root_domain_name is None
+            or root_domain_name == domain
+            or domain in root_domains_set
+        ):
+            # 根域名，理论上不应该出现需要插入的情况，因为已经同步过根域名
+            log_message(f"出现了意料之外的根域名：{domain}")
+            continue
+        else:
+            # 子域名，先按公共后缀列表取根域名，找不到时再从短到长匹配bbdb已有的根域名
+            root_domain_obj = root_domains_set.get(root_domain_name)
+            if root_domain_obj is None:
+                if root_suffix_index is None:
+                    root_suffix_index = build_domain_suffix_index(root_domains_set)
+                root_domain_obj = next(
+                    (
+                        document
+                        for _, document in iter_domain_suffix_matches(
+                            root_suffix_index, domain
+                        )
+                    ),
+                    None,
+                )
+
+            if root_domain_obj:
+                root_domain_id = str(root_domain_obj["_id"])
+                business_id = str(root_domain_obj["business_id"])
+                sub_domains_to_add.append(
+                    {
+                        "name": domain,
+                        "icpregnum": "",
+                        "company": "",
+                        "company_type": "",
+                        "root_domain_id": root_domain_id,
+                        "business_id": business_id,
+                        "notes": ARL_SYNC_NOTES,
+                        "create_time": datetime.now(),
+                        "update_time": datetime.now(),
+                    }
+                )
+    return sub_domains_to_add
+
+
 def sync_domain_assets(
-    arl_url,
-    token,
+    arl,
     db,
     arl_all_scopes,
-    arl_all_policies,
     businesses,
     root_domains,
     sub_domains,
     blacklists,
+    concurrency=ARL_SYNC_CONCURRENCY,
+    working_set=None,
+    plan=None,
+    arl_domain_batches=None,
+    save_state=True,
 ):
-    global new_domains_to_arl, new_domains_to_bbdb
-    # 加载bbdb数据到内存
+    # 同步入口，实际工作由 asyncio 流水线完成，返回 DomainSyncResult
+    return asyncio.run(
+        sync_domain_assets_async(
+            arl,
+            db,
+            arl_all_scopes,
+            businesses,
+            root_domains,
+            sub_domains,
+            blacklists,
+            concurrency,
+            working_set,
+            plan,
+            arl_domain_batches,
+            save_state,
+        )
+    )
 
-    businesses_ids = {business["_id"]: business for business in businesses}
-    root_domains_set = {
-        root_domain["name"]: root_domain for root_domain in root_domains
-    }
-    sub_domains_set = {sub_domain["name"]: sub_domain for sub_domain in sub_domains}
-    blacklist_domains = {
-        domain["name"].lower()
-        for domain in blacklists
-        if domain["type"] == "sub_domain"
+
+def plan_domain_sync(db):
+    # 读取上次同步的水位，决定本次是全量对账还是增量同步
+    run_started = datetime.now()
+    sync_state = load_sync_state(db, "domain")
+    full_sync = is_full_sync_due(sync_state, run_started)
+    if full_sync:
+        log_message("5-本次进行域名全量对账")
+        arl_params = None
+    else:
+        log_message(f"5-本次增量同步 {sync_state['arl_watermark']} 之后更新的域名")
+        arl_params = {"update_date__dgt": sync_state["arl_watermark"]}
+    return {
+        "run_started": run_started,
+        "sync_state": sync_state,
+        "full_sync": full_sync,
+        "arl_params": arl_params,
     }
 
-    # arl域名处理部分
-    arl_domains = set()
-    # 从arl_all_scopes中提取并处理域名
-    for asset_scope in arl_all_scopes:
-        if "scope_array" in asset_scope and asset_scope["scope_array"]:
-            # 直接处理列表中的每个域名，转换为小写并去除末尾的点
-            for domain in asset_scope["scope_array"]:
-                processed_domain = domain.lower().rstrip(".")
-                arl_domains.add(processed_domain)
-    # 下载arl_domain_data并添加到一起
-    arl_domain_data = download_arl_assets(arl_url, token, "domain")
-    for domain in arl_domain_data:
-        processed_domain = domain.lower().rstrip(".")
-        arl_domains.add(processed_domain)
-
-    if arl_domains:
-        # 数据处理
-        bbdb_domains = set(root_domains_set.keys()).union(sub_domains_set)
-        bbdb_domains = set(
-            [
-                domain.lower().strip(".")
-                for domain in bbdb_domains
-                if not re.match(r"\d+\.\d+\.\d+\.\d+", domain)  # 排除IPv4地址
-                and ":" not in domain  # 排除IPv6地址
-                and domain not in blacklist_domains  # 排除黑名单中的域名
+
+def get_arl_watermark(plan):
+    # ARL 的 update_date 是 ARL 服务器本地时间，回退一段时间以容忍两边的时钟偏差
+    arl_watermark = plan["run_started"] - timedelta(
+        minutes=SYNC_WATERMARK_OVERLAP_MINUTES
+    )
+    return arl_watermark.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def get_snapshot_watermark(documents):
+    # 本次运行比较过的文档中最大的 _id，运行期间其他脚本插入的文档留给下次同步
+    return max((document["_id"] for document in documents), default=None)
+
+
+def find_new_bbdb_domain_documents(db, sync_state, root_domains, sub_domains):
+    """
+    增量模式下返回上次水位之后新增的根域名和子域名文档，
+    同步脚本自己从 ARL 导入的文档（notes 为 ARL_SYNC_NOTES）本来就在 ARL 中，不再推回
+    """
+    bbdb_watermark = sync_state.get("bbdb_watermark") or {}
+    new_documents = []
+    for collection, documents in (
+        ("root_domain", root_domains),
+        ("sub_domain", sub_domains),
+    ):
+        watermark = bbdb_watermark.get(collection)
+        candidates = [
+            document
+            for document in documents
+            if watermark is None or document["_id"] > watermark
+        ]
+        imported_ids = set()
+        for start in range(0, len(candidates), MONGO_BATCH_SIZE):
+            batch_ids = [
+                document["_id"]
+                for document in candidates[start : start + MONGO_BATCH_SIZE]
             ]
+            imported_ids.update(
+                document["_id"]
+                for document in db[collection].find(
+                    {"_id": {"$in": batch_ids}, "notes": ARL_SYNC_NOTES}, {"_id": 1}
+                )
+            )
+        new_documents.extend(
+            document for document in candidates if document["_id"] not in imported_ids
+        )
+    return new_documents
+
+
+def save_domain_sync_state(db, plan, root_domains, sub_domains):
+    # 写入完成后记录水位，bbdb 侧水位取本次比较时读取的文档，而不是结束时集合中最大的 _id
+    state_fields = {
+        "arl_watermark": get_arl_watermark(plan),
+        "bbdb_watermark": {
+            "root_domain": get_snapshot_watermark(root_domains),
+            "sub_domain": get_snapshot_watermark(sub_domains),
+        },
+    }
+    if plan["full_sync"]:
+        state_fields["last_full_sync"] = plan["run_started"]
+    save_sync_state(db, "domain", state_fields)
+
+
+class WritePipeline:
+    """
+    有界的写入流水线：submit 在在途任务达到 concurrency 个时等待空位，生产者因此不会跑到写入前面太多；
+    任务是返回协程的函数，抛出异常或返回 False 视为失败，drain 等待全部任务完成并返回失败的任务数
+    """
+
+    def __init__(self, concurrency):
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._tasks = set()
+        self.failed = 0
+
+    async def submit(self, job):
+        await self._slots.acquire()
+        task = asyncio.create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job):
+        try:
+            if await job() is False:
+                self.failed += 1
+        except Exception as e:
+            log_message(f"写入任务执行失败: {e}", False)
+            self.failed += 1
+        finally:
+            self._slots.release()
+
+    async def drain(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks))
+        return self.failed
+
+
+# sync_domain_assets 的返回值：是否完整同步，以及双向新增的域名个数
+DomainSyncResult = namedtuple(
+    "DomainSyncResult", ["synced", "new_domains_to_arl", "new_domains_to_bbdb"]
+)
+
+
+async def sync_domain_assets_async(
+    arl,
+    db,
+    arl_all_scopes,
+    businesses,
+    root_domains,
+    sub_domains,
+    blacklists,
+    concurrency=ARL_SYNC_CONCURRENCY,
+    working_set=None,
+    plan=None,
+    arl_domain_batches=None,
+    save_state=True,
+):
+    """
+    域名双向同步，plan 为空时自行读取同步水位，返回 DomainSyncResult
+
+    ARL 域名导出在线程中逐批下载，经过最多 concurrency 批的有界队列交给事件循环：
+    每批到达后立即与 bbdb 域名集合比较，新域名攒满 MONGO_BATCH_SIZE 条就提交到写入流水线，
+    Mongo 写入与后续页面的下载重叠。需要推送到 ARL 的域名要和完整的 ARL 域名集合比较，
+    只能在导出结束后提交，这部分 ARL 写入不与下载重叠。
+    分片模式下由协调进程传入 plan，arl_domain_batches 为本分片落盘的 ARL 域名批次，
+    水位由协调进程在所有分片完成后统一更新（save_state=False）。
+    ARL 导出和所有写入都成功时 synced 为 True，调用方据此决定能否推进水位
+    """
+    if plan is None:
+        plan = plan_domain_sync(db)
+    full_sync = plan["full_sync"]
+    sync_state = plan["sync_state"]
+    arl_failed_pages = []
+    if arl_domain_batches is None:
+        arl_domain_batches = iter_arl_assets(
+            arl,
+            "domain",
+            plan["arl_params"],
+            normalize=normalize_hostname,
+            failed_pages=arl_failed_pages,
+        )
+
+    # 生产者：在线程中下载 ARL 域名，放入有界队列，消费者异常退出时通过 stop 通知生产者停止
+    pending_batches = queue.Queue(maxsize=max(1, concurrency))
+    stop = threading.Event()
+
+    def put_batch(batch):
+        while not stop.is_set():
+            try:
+                pending_batches.put(batch, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def download_batches():
+        try:
+            for batch in arl_domain_batches:
+                if not put_batch(batch):
+                    return
+        finally:
+            put_batch(None)
+
+    arl_download = asyncio.create_task(asyncio.to_thread(download_batches))
+
+    def prepare_bbdb_domains():
+        # 加载bbdb数据到内存，根域名需要按名称找回文档，子域名只参与集合运算；
+        # 名称规范化为 punycode，与 get_root_domains 解析出的根域名一致
+        root_domains_set = {
+            normalize_hostname(root_domain["name"]): root_domain
+            for root_domain in root_domains
+        }
+        blacklist_domains = {
+            domain["name"].lower()
+            for domain in blacklists
+            if domain["type"] == "sub_domain"
+        }
+        bbdb_domains = filter_domain_names(
+            itertools.chain(
+                root_domains_set, (sub_domain["name"] for sub_domain in sub_domains)
+            ),
+            blacklist_domains,
         )  # 去除IP、特殊字符和黑名单域名
-        arl_domains = set(
-            [
-                line.lower().strip(".")
-                for line in arl_domains
-                if not re.match(r"\d+\.\d+\.\d+\.\d+", line)  # 排除IPv4地址
-                and ":" not in line  # 排除IPv6地址
-            ]
-        )  # 去除IP和特殊字符
-
-        # 需要插入bbdb的域名
-        new_domains_to_bbdb = arl_domains - bbdb_domains
-        # 需要插入ARL的域名
-        new_domains_to_arl = bbdb_domains - arl_domains
-
-        # 先插入bbdb
-        if new_domains_to_bbdb:
-            # 准备批量插入的列表
-            sub_domains_to_add = []
-            for domain in new_domains_to_bbdb:
-                if (
-                    domain.count(".") == 0
-                    or domain.count(".") == 1
-                    or (domain.count(".") == 2 and domain in root_domains_set)
-                ):
-                    # 根域名，理论上不应该出现需要插入的情况，因为已经同步过根域名
-                    log_message(f"出现了意料之外的根域名：{domain}")
-                    continue
-                else:
-                    # 子域名
-                    parts = domain.split(".")
-                    root_domain_obj = None
-
-                    # 从右到左尝试匹配根域名，先尝试二级域名，然后是三级域名
-                    for i in range(2, 4):
-                        if len(parts) >= i:
-                            candidate = ".".join(parts[-i:])
-                            if candidate in root_domains_set:
-                                root_domain_obj = root_domains_set[candidate]
-                                break
-
-                    if root_domain_obj:
-                        root_domain_id = str(root_domain_obj["_id"])
-                        business_id = str(root_domain_obj["business_id"])
-                        sub_domains_to_add.append(
-                            {
-                                "name": domain,
-                                "icpregnum": "",
-                                "company": "",
-                                "company_type": "",
-                                "root_domain_id": root_domain_id,
-                                "business_id": business_id,
-                                "notes": "set by soapffz with arl",
-                                "create_time": datetime.now(),
-                                "update_time": datetime.now(),
-                            }
-                        )
-            # 批量插入子域名到bbdb
-            if sub_domains_to_add:
-                log_message(f"有 {len(sub_domains_to_add)} 个新域名待插入 bbdb，请稍等")
-                db.sub_domain.insert_many(sub_domains_to_add)
-            else:
-                log_message("5-没有找到需要插入 bbdb 的新域名")
+
+        # 增量模式下只有上次水位之后新增的 bbdb 域名才需要推送到 ARL
+        if full_sync:
+            bbdb_candidates = bbdb_domains
         else:
-            log_message("5-没有需要插入到 bbdb 的新域名")
+            bbdb_candidates = filter_domain_names(
+                (
+                    document["name"]
+                    for document in find_new_bbdb_domain_documents(
+                        db, sync_state, root_domains, sub_domains
+                    )
+                ),
+                blacklist_domains,
+            )
+        return root_domains_set, bbdb_domains, bbdb_candidates
+
+    pipeline = WritePipeline(concurrency)
+    pending_documents = []
 
-        # 再插入arl
-        if new_domains_to_arl:
-            log_message(f"5-需要插入 arl 的域名个数{len(new_domains_to_arl)}")
-            insertion_data = prepare_domains_for_arl_insertion(
-                new_domains_to_arl, businesses, root_domains_set, arl_all_scopes
+    async def flush_documents():
+        nonlocal pending_documents
+        if not pending_documents:
+            return
+        batch, pending_documents = pending_documents, []
+
+        async def insert_batch():
+            await asyncio.to_thread(
+                upsert_documents, db, "sub_domain", batch, working_set
             )
-            if insertion_data:
-                headers = {
-                    "Token": token,
-                    "Content-Type": "application/json; charset=UTF-8",
-                }
 
-                for item in insertion_data:
-                    scope_id = item["scope_id"]
-                    business_name = item["business_name"]
-                    domains = item["scope"].split(",")  # 将scope字符串分割成域名列表
+        await pipeline.submit(insert_batch)
 
-                    # 添加到ARL的资产分组中
-                    data = {
-                        "scope_id": scope_id,
-                        "scope": item["scope"],
-                    }
+    arl_domain_builder = DomainSetBuilder()
+    new_domain_builder = DomainSetBuilder()
+    downloaded_count = 0
 
-                    try:
-                        response = requests.post(
-                            arl_url + "/api/asset_scope/add/",
-                            headers=headers,
-                            json=data,
-                            verify=False,
-                        )
-                        response.raise_for_status()
-                        # 检查响应状态码
-                        if response.status_code == 200:
-                            log_message(
-                                f"5-成功添加 {len(domains)} 个域名到 ARL 资产分组 {business_name}"
-                            )
-                        else:
-                            log_message(
-                                f"Failed to add domains to ARL asset scope {scope_id}"
-                            )
-                    except requests.RequestException as e:
-                        log_message(e, "出错了，请排查")
-
-                    # 找到对应的策略并触发监控任务
-                    policy = next(
-                        (
-                            policy
-                            for policy in arl_all_policies
-                            if policy["policy"]["scope_config"]["scope_id"] == scope_id
-                        ),
-                        None,
-                    )
-                    if policy is not None:
-                        policy_id = policy["_id"]
-                        for domain in domains:
-                            # 假设 add_scheduler 是一个已定义的函数，用于添加监控任务
-                            add_scheduler(token, arl_url, scope_id, domain, policy_id)
-        else:
-            log_message("5-没有需要插入到 arl 的新域名")
-    else:
+    async def consume(domains):
+        # 一批 ARL 域名：去除IP和特殊字符后与 bbdb 比较，新域名构造文档后进入写入流水线
+        names = [
+            value
+            for kind, value in iter_normalized_hostnames(domains)
+            if kind == HOSTNAME_DOMAIN
+        ]
+        arl_domain_builder.update(names)
+        new_names = [name for name in names if name not in bbdb_domains]
+        if not new_names:
+            return
+        new_domain_builder.update(new_names)
+        pending_documents.extend(
+            build_sub_domain_documents(new_names, root_domains_set)
+        )
+        if len(pending_documents) >= MONGO_BATCH_SIZE:
+            await flush_documents()
+
+    try:
+        # bbdb 侧的集合在线程中准备，与第一批 ARL 数据的下载重叠
+        root_domains_set, bbdb_domains, bbdb_candidates = await asyncio.to_thread(
+            prepare_bbdb_domains
+        )
+
+        # arl域名处理部分，资产分组的 scope_array 作为第一批
+        await consume(
+            domain
+            for asset_scope in arl_all_scopes
+            for domain in asset_scope.get("scope_array") or []
+        )
+        while True:
+            batch = await asyncio.to_thread(pending_batches.get)
+            if batch is None:
+                break
+            downloaded_count += len(batch)
+            await consume(batch)
+        await flush_documents()
+    finally:
+        stop.set()
+    await arl_download
+
+    arl_domains = arl_domain_builder.build()
+    new_domains_to_bbdb = new_domain_builder.build()
+    if not arl_domains:
+        await pipeline.drain()
         log_message("5-下载 arl 域名数据失败或者为空")
+        return DomainSyncResult(False, 0, 0)
+    if not full_sync:
+        log_message(f"5-ARL 水位之后更新的域名个数{downloaded_count}")
+    if new_domains_to_bbdb:
+        log_message(f"5-需要插入 bbdb 的域名个数{len(new_domains_to_bbdb)}")
+    else:
+        log_message("5-没有需要插入到 bbdb 的新域名")
 
+    # 需要插入ARL的域名，依赖完整的 ARL 域名集合，导出结束后才能计算
+    new_domains_to_arl = bbdb_candidates - arl_domains
+    del arl_domains
 
-# 从ARL获取域名数据
-def get_arl_domainpages_data_for_ip(arl_url, token):
-    headers = {"Token": token, "Content-Type": "application/json; charset=UTF-8"}
-    size = 100
-    all_domain_data = []
-    page = 1
-    total_pages = None  # 初始化总页数为 None
-
-    while total_pages is None or page <= total_pages:
-        try:
-            response = requests.get(
-                arl_url
-                + f"/api/domain/?page={page}&size={size}&tabIndex=1&ts=1711335367525",
-                headers=headers,
-                verify=False,
-            )
-            response.raise_for_status()
-            response_data = response.json()
-        except requests.RequestException as e:
-            log_message(f"Request failed: {e}")
-            break
-        except ValueError:
-            log_message("Failed to decode JSON response")
-            break
+    # ARL 写入任务，新域名的监控任务在第 9 步统一对账添加
+    if new_domains_to_arl:
+        log_message(f"5-需要插入 arl 的域名个数{len(new_domains_to_arl)}")
+        insertion_data = prepare_domains_for_arl_insertion(
+            new_domains_to_arl, businesses, root_domains_set, arl_all_scopes
+        )
+        for item in insertion_data:
 
-        if total_pages is None:
-            total = response_data.get("total", 0)
-            total_pages = (total + size - 1) // size  # 计算总页数
+            async def add_scope_domains(item=item):
+                scope_id = item["scope_id"]
+                business_name = item["business_name"]
+                domains = item["scope"].split(",")  # 将scope字符串分割成域名列表
 
-        if "items" in response_data:
-            all_domain_data.extend(response_data["items"])
-        else:
-            log_message("响应中没有 'items' 键")
-            break
+                # 添加到ARL的资产分组中
+                data = {
+                    "scope_id": scope_id,
+                    "scope": item["scope"],
+                }
+                response_data = await asyncio.to_thread(
+                    arl.post_json, "/api/asset_scope/add/", json=data
+                )
+                if response_data is None or response_data.get("code") != 200:
+                    log_message(
+                        f"Failed to add domains to ARL asset scope {scope_id}", False
+                    )
+                    return False
+                log_message(
+                    f"5-成功添加 {len(domains)} 个域名到 ARL 资产分组 {business_name}"
+                )
 
-        page += 1  # 请求下一页
+            await pipeline.submit(add_scope_domains)
+    else:
+        log_message("5-没有需要插入到 arl 的新域名")
 
-    return all_domain_data
+    failed_writes = await pipeline.drain()
+    result = DomainSyncResult(False, len(new_domains_to_arl), len(new_domains_to_bbdb))
 
+    # ARL 导出不完整或有写入失败时不推进水位，下次运行重新处理这段时间的数据
+    if arl_failed_pages:
+        log_message("5-ARL 域名导出不完整，本次不更新同步水位", False)
+        return result
+    if failed_writes:
+        log_message(f"5-有 {failed_writes} 个写入任务失败，本次不更新同步水位", False)
+        return result
+    if save_state:
+        save_domain_sync_state(db, plan, root_domains, sub_domains)
+    return result._replace(synced=True)
 
-def arl_ip_to_bbdb(
-    db, arl_url, token, businesses, root_domains, sub_domains, blacklists, ips
-):
-    global new_ips_to_bbdb
 
-    # 将root_domains和sub_domains列表转换为字典
-    root_domains = {root_domain["name"]: root_domain for root_domain in root_domains}
-    sub_domains = {sub_domain["name"]: sub_domain for sub_domain in sub_domains}
+# 从ARL获取域名数据
+def iter_arl_domainpages_for_ip(arl):
+    # 逐页读取资产总览页面的域名解析数据
+    return iter_arl_list_pages(arl, "/api/domain/", params={"tabIndex": 1})
 
-    # 构建黑名单IP集合
-    blacklist_ips = {ip["name"].lower() for ip in blacklists if ip["type"] == "ip"}
 
-    # 构建已存在IP的集合
-    existing_ips = {ip["address"].lower() for ip in ips}
+def build_ip_document(ip_address, root_domain_id, sub_domain_id, business_id):
+    # 构造IP文档
+    now = datetime.now()
+    ip_document = {
+        "name": "",
+        "address": ip_address,
+        "port": "",
+        "service_name": "",
+        "service_type": "",
+        "service_desc": "",
+        "province_cn": "",
+        "city_cn": "",
+        "country_cn": "",
+        "districts_and_counties_en": "",
+        "districts_and_counties_cn": "",
+        "province_en": "",
+        "city_en": "",
+        "country_en": "",
+        "operators": "",
+        "is_real": True,
+        "is_cdn": False,
+        "cname": "",
+        "root_domain_id": root_domain_id,
+        "business_id": business_id,
+        "notes": ARL_SYNC_NOTES,
+        "create_time": now,
+        "update_time": now,
+    }
+    if sub_domain_id:
+        ip_document["sub_domain_id"] = sub_domain_id
+    return ip_document
 
-    # 准备插入的IP数据列表
-    new_ips_to_bbdb = []
 
-    # 获取ARL的域名数据
-    arl_domainpages_data_for_ip = get_arl_domainpages_data_for_ip(arl_url, token)
+def arl_ip_to_bbdb(
+    db,
+    arl,
+    businesses,
+    root_domains,
+    sub_domains,
+    blacklists,
+    ips,
+    working_set=None,
+    domain_pages=None,
+):
+    """
+    逐页读取 ARL 域名解析记录，把新的 IPv4 写入 bbdb 的 ip 表
+
+    每页到达后立即过滤和匹配域名，新文档攒满 MONGO_BATCH_SIZE 条就写入一次，
+    内存中只保留当前页、待写入的一批文档和已存在 IP 的元组键集合；
+    分片模式下 domain_pages 为协调进程落盘的本分片解析记录，返回新插入的 IP 数量
+    """
+    # 将root_domains和sub_domains列表转换为字典，名称与 get_root_domain 的结果一样规范化为 punycode
+    root_domains = {
+        normalize_hostname(root_domain["name"]): root_domain
+        for root_domain in root_domains
+    }
+    sub_domains = {
+        normalize_hostname(sub_domain["name"]): sub_domain for sub_domain in sub_domains
+    }
 
-    # 定义IPv4地址的正则表达式
-    ipv4_pattern = r"^(?:(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.){3}(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)$"
-    # 从数据中去除黑名单IP
-    for item in arl_domainpages_data_for_ip:
-        if item.get("type") == "A" and item.get("ips"):
-            newips = []
-            for ip_address in item["ips"]:
-                if (
-                    bool(re.match(ipv4_pattern, ip_address.lower()))
-                    and ip_address.lower() not in blacklist_ips
-                ):
-                    newips.append(ip_address.lower())
-            if newips:
-                item["ips"] = newips
-            else:
-                arl_domainpages_data_for_ip.remove(item)
+    # 构建黑名单IP集合
+    blacklist_ips = {ip["name"].lower() for ip in blacklists if ip["type"] == "ip"}
 
-    # 把当前ips的内容组合起来，用来判断新插入的内容是否已存在
-    existing_ips_identifiers = set(
-        f"{ip['address']}_{ip['root_domain_id']}"
-        + (f"_{ip['sub_domain_id']}" if ip.get("sub_domain_id") else "")
-        + f"_{ip['business_id']}"
+    # 已存在IP的键：(地址, root_domain_id, sub_domain_id, business_id)，没有子域名时为空字符串
+    existing_ip_keys = {
+        (
+            ip["address"],
+            str(ip["root_domain_id"]),
+            str(ip.get("sub_domain_id") or ""),
+            str(ip["business_id"]),
+        )
         for ip in ips
-    )
-    # 查找对应域名并构造bbdb插入文档
-    for item in arl_domainpages_data_for_ip:
-        # 先在sub_domain表中查询对应的域名
-        sub_domain_id = ""
-
-        item_domain = item.get("domain")
-        sub_domain_obj = sub_domains.get(item_domain)
-        if sub_domain_obj:
-            # 当前item域名在sub_domain表中
-            sub_domain_id = str(sub_domain_obj["_id"])
-            root_domain_id = str(sub_domain_obj["root_domain_id"])
-            business_id = str(sub_domain_obj["business_id"])
-        else:
-            root_domain_obj = root_domains.get(item_domain)
-            if root_domain_obj:
-                root_domain_id = str(root_domain_obj["_id"])
-                business_id = str(root_domain_obj["business_id"])
-            else:
-                log_message(f"无法找到与 IP 地址 {ip_address} 对应的域名")
-                continue
+    }
 
-        for ip_address in item["ips"]:
-            # 检查组成的文档是否已存在
-            current_ip_identifier = (
-                f"{ip_address}_{root_domain_id}"
-                + (f"_{sub_domain_id}" if sub_domain_id != "" else "")
-                + f"_{business_id}"
-            )
+    pending_documents = []
+    new_ips_count = 0
+
+    def flush():
+        nonlocal new_ips_count
+        if not pending_documents:
+            return
+        new_ips_count += upsert_documents(db, "ip", pending_documents, working_set)
+        pending_documents.clear()
+
+    unmatched_domains = 0
+    if domain_pages is None:
+        domain_pages = iter_arl_domainpages_for_ip(arl)
+    for page_items in domain_pages:
+        with tracing.span("7-filter_and_build", items=len(page_items)):
+            for item in page_items:
+                if item.get("type") != "A" or not item.get("ips"):
+                    continue
+                # 去除非IPv4和黑名单IP
+                ip_addresses = [
+                    ip_address
+                    for ip_address in map(str.lower, item["ips"])
+                    if IPV4_PATTERN.match(ip_address)
+                    and ip_address not in blacklist_ips
+                ]
+                if not ip_addresses:
+                    continue
 
-            if current_ip_identifier not in existing_ips_identifiers:
-                # 构造IP文档
-                ip_document = {
-                    "name": "",
-                    "address": ip_address,
-                    "port": "",
-                    "service_name": "",
-                    "service_type": "",
-                    "service_desc": "",
-                    "province_cn": "",
-                    "city_cn": "",
-                    "country_cn": "",
-                    "districts_and_counties_en": "",
-                    "districts_and_counties_cn": "",
-                    "province_en": "",
-                    "city_en": "",
-                    "country_en": "",
-                    "operators": "",
-                    "is_real": True,
-                    "is_cdn": False,
-                    "cname": "",
-                    "root_domain_id": root_domain_id,
-                    "business_id": business_id,
-                    "notes": "set by soapffz with arl",
-                    "create_time": datetime.now(),
-                    "update_time": datetime.now(),
-                }
-                if sub_domain_id:
-                    ip_document["sub_domain_id"] = sub_domain_id
+                # 先在sub_domain表中查询对应的域名
+                item_domain = normalize_hostname(item.get("domain"))
+                sub_domain_obj = sub_domains.get(item_domain)
+                if sub_domain_obj:
+                    # 当前item域名在sub_domain表中
+                    sub_domain_id = str(sub_domain_obj["_id"])
+                    root_domain_id = str(sub_domain_obj["root_domain_id"])
+                    business_id = str(sub_domain_obj["business_id"])
+                else:
+                    root_domain_obj = root_domains.get(item_domain)
+                    if not root_domain_obj:
+                        unmatched_domains += 1
+                        continue
+                    sub_domain_id = ""
+                    root_domain_id = str(root_domain_obj["_id"])
+                    business_id = str(root_domain_obj["business_id"])
+
+                for ip_address in ip_addresses:
+                    # 检查组成的文档是否已存在
+                    key = (ip_address, root_domain_id, sub_domain_id, business_id)
+                    if key in existing_ip_keys:
+                        continue
+                    existing_ip_keys.add(key)
+                    pending_documents.append(
+                        build_ip_document(
+                            ip_address, root_domain_id, sub_domain_id, business_id
+                        )
+                    )
 
-                new_ips_to_bbdb.append(ip_document)
+        # 批量插入IP到bbdb的ip表，每批不超过 MONGO_BATCH_SIZE 条
+        if len(pending_documents) >= MONGO_BATCH_SIZE:
+            flush()
+    flush()
 
-    # 批量插入IP到bbdb的ip表
-    if new_ips_to_bbdb:
-        db.ip.insert_many(new_ips_to_bbdb)
-        log_message(f"7-成功插入{len(new_ips_to_bbdb)}个新IP到bbdb")
+    if unmatched_domains:
+        log_message(f"7-有 {unmatched_domains} 个域名在 bbdb 中找不到，对应 IP 已跳过")
+    if new_ips_count:
+        log_message(f"7-成功插入{new_ips_count}个新IP到bbdb")
+    else:
+        log_message("7-没有需要插入bbdb的新ip")
+    return new_ips_count
+
+
+def canonical_site_url(site_url):
+    """
+    站点 URL 的规范形式，作为 site 表 upsert 的键：协议和主机名小写，去除主机名末尾的点、
+    默认端口和单独的 /，路径和参数保持原样，不是 http/https URL 或无法解析时返回 None
+    """
+    parsed = urlsplit(site_url.strip())
+    scheme = parsed.scheme.lower()
+    if scheme not in SITE_DEFAULT_PORTS:
+        return None
+    try:
+        port = parsed.port
+    except ValueError:
+        return None
+    hostname = (parsed.hostname or "").rstrip(".")
+    if not hostname:
+        return None
+    if ":" in hostname:
+        hostname = f"[{hostname}]"
+    if port is not None and port != SITE_DEFAULT_PORTS[scheme]:
+        hostname = f"{hostname}:{port}"
+    path = "" if parsed.path == "/" else parsed.path
+    return urlunsplit((scheme, hostname, path, parsed.query, ""))
+
+
+def plan_site_sync(db):
+    # 站点同步与域名同步使用相同的水位规则，ARL 侧只拉取上次水位之后更新的站点
+    run_started = datetime.now()
+    sync_state = load_sync_state(db, "site")
+    full_sync = is_full_sync_due(sync_state, run_started)
+    if full_sync:
+        log_message("8-本次进行站点全量同步")
+        arl_params = None
     else:
-        log_message(f"7-没有需要插入bbdb的新ip")
+        log_message(f"8-本次增量同步 {sync_state['arl_watermark']} 之后更新的站点")
+        arl_params = {"update_date__dgt": sync_state["arl_watermark"]}
+    return {
+        "run_started": run_started,
+        "sync_state": sync_state,
+        "full_sync": full_sync,
+        "arl_params": arl_params,
+    }
+
+
+def save_site_sync_state(db, plan):
+    state_fields = {"arl_watermark": get_arl_watermark(plan)}
+    if plan["full_sync"]:
+        state_fields["last_full_sync"] = plan["run_started"]
+    save_sync_state(db, "site", state_fields)
 
 
 def arl_site_to_bbdb(
-    db, arl_url, token, businesses, root_domains, sub_domains, blacklists, sites
+    db,
+    arl,
+    businesses,
+    root_domains,
+    sub_domains,
+    blacklists,
+    sites,
+    working_set=None,
+    site_urls=None,
+    plan=None,
+    save_state=True,
 ):
+    """
+    站点同步，plan 为空时自行读取同步水位，增量模式下只拉取水位之后更新的站点
+
+    站点按规范化 URL 批量 upsert，先用 bbdb 已有站点名称的规范形式过滤，
+    其他脚本写入的 https://a.com/ 这类名称与 https://a.com 视为同一个站点。
+    分片模式下 site_urls 为协调进程落盘的本分片站点，水位由协调进程统一更新（save_state=False）
+    """
     global new_sites_to_bbdb
-    # 将root_domains和sub_domains列表转换为字典
-    root_domains = {root_domain["name"]: root_domain for root_domain in root_domains}
-    sub_domains = {sub_domain["name"]: sub_domain for sub_domain in sub_domains}
 
-    # 使用download_arl_assets下载类型为site的数据并去重
-    arl_sites_data = set(download_arl_assets(arl_url, token, "site"))
+    if plan is None:
+        plan = plan_site_sync(db)
+    # 将root_domains和sub_domains列表转换为字典，名称与 get_root_domain 的结果一样规范化为 punycode
+    root_domains = {
+        normalize_hostname(root_domain["name"]): root_domain
+        for root_domain in root_domains
+    }
+    sub_domains = {
+        normalize_hostname(sub_domain["name"]): sub_domain for sub_domain in sub_domains
+    }
+
+    # 使用iter_arl_assets流式下载类型为site的数据，按规范化 URL 去重；分片模式下读取协调进程落盘的本分片站点
+    failed_pages = []
+    if site_urls is None:
+        site_urls = itertools.chain.from_iterable(
+            iter_arl_assets(
+                arl,
+                "site",
+                plan["arl_params"],
+                normalize=canonical_site_url,
+                failed_pages=failed_pages,
+            )
+        )
+    else:
+        save_state = False
 
-    # 构建黑名单URL集合
+    # 构建黑名单URL集合，与站点一样按规范形式比较
     blacklist_urls = {
-        blacklist["name"].lower()
+        (canonical_site_url(blacklist["name"]) or blacklist["name"]).lower()
         for blacklist in blacklists
         if blacklist["type"] == "url"
     }
 
-    # 构建已存在站点的URL集合
-    existing_sites_urls = {site["name"].lower() for site in sites}
+    # 已有站点不一定是规范形式写入的，统一规范化后再比较，无法解析的名称按原样比较
+    existing_sites_urls = {
+        (canonical_site_url(site["name"]) or site["name"]).lower() for site in sites
+    }
 
-    # 准备插入的站点数据列表
+    # 新站点的 URL 列表，文档攒满 MONGO_BATCH_SIZE 条就写入一次
     new_sites_to_bbdb = []
+    pending_documents = []
     inserted_sites_count = 0
 
-    for site_url in arl_sites_data:
+    # 两种来源的站点 URL 都已经是规范形式
+    for site_url in site_urls:
         # 去除黑名单中的URL和已存在的站点URL
         if (
             site_url.lower() in blacklist_urls
@@ -1560,17 +2754,10 @@ def arl_site_to_bbdb(
         ):
             continue
 
+        # 规范化 URL 中的主机名已经是小写且去除了末尾的点和端口，国际化域名再转为 punycode
+        hostname = normalize_hostname(urlsplit(site_url).hostname)
         # 提取根域名
-        parsed_url = urlparse(site_url)
-        hostname = parsed_url.hostname
-        if hostname is None:
-            continue
-        hostname = hostname.lower().rstrip(".")
-        # 去除端口号
-        hostname = re.sub(r":\d+$", "", hostname)
-        # 提取根域名
-        parts = hostname.split(".")
-        root_domain_name = ".".join(parts[-2:]) if len(parts) > 1 else hostname
+        root_domain_name = get_root_domain(hostname) or hostname
 
         # 在root_domains中查找
         root_domain_obj = root_domains.get(root_domain_name)
@@ -1585,41 +2772,415 @@ def arl_site_to_bbdb(
                 # log_message(f"发现了意料之外的子域名：{site_url}")
                 continue
 
-            # 构造站点文档并添加到列表
-            site_document = {
-                "name": site_url,
-                "status": "",
-                "title": "",
-                "hostname": hostname,
-                "ip": "",
-                "http_server": "",
-                "body_length": "",
-                "headers": "",
-                "keywords": "",
-                "applications": [],
-                "applications_categories": [],
-                "applications_types": [],
-                "applications_levels": [],
-                "application_manufacturer": [],
-                "fingerprint": [],
-                "root_domain_id": root_domain_id,
-                "sub_domain_id": sub_domain_id,
-                "business_id": business_id,
-                "notes": "set by soapffz with arl",
-                "create_time": datetime.now(),
-                "update_time": datetime.now(),
-            }
-            new_sites_to_bbdb.append(site_document)
+            # 构造站点文档并添加到待写入列表
+            pending_documents.append(
+                {
+                    "name": site_url,
+                    "status": "",
+                    "title": "",
+                    "hostname": hostname,
+                    "ip": "",
+                    "http_server": "",
+                    "body_length": "",
+                    "headers": "",
+                    "keywords": "",
+                    "applications": [],
+                    "applications_categories": [],
+                    "applications_types": [],
+                    "applications_levels": [],
+                    "application_manufacturer": [],
+                    "fingerprint": [],
+                    "root_domain_id": root_domain_id,
+                    "sub_domain_id": sub_domain_id,
+                    "business_id": business_id,
+                    "notes": ARL_SYNC_NOTES,
+                    "create_time": datetime.now(),
+                    "update_time": datetime.now(),
+                }
+            )
+            new_sites_to_bbdb.append(site_url)
+            if len(pending_documents) >= MONGO_BATCH_SIZE:
+                inserted_sites_count += upsert_documents(
+                    db, "site", pending_documents, working_set
+                )
+                pending_documents = []
 
-    # 批量插入站点到bbdb的site表
-    if new_sites_to_bbdb:
-        db.site.insert_many(new_sites_to_bbdb)
-        inserted_sites_count = len(new_sites_to_bbdb)
+    # 批量写入剩余的站点
+    if pending_documents:
+        inserted_sites_count += upsert_documents(
+            db, "site", pending_documents, working_set
+        )
 
     # 打印成功插入的站点数量
     if inserted_sites_count > 0:
         log_message(f"成功插入{inserted_sites_count}个站点到bbdb")
 
+    if not save_state:
+        return
+    if failed_pages:
+        log_message("8-ARL 站点导出不完整，本次不更新站点同步水位", False)
+    else:
+        save_site_sync_state(db, plan)
+
+
+def partition_businesses(businesses, root_domains, sub_domains, shards):
+    """
+    按域名数量把业务分到最多 shards 个分片，每次把剩下最大的业务放到当前最轻的分片，
+    返回非空分片的业务列表
+    """
+    weights = Counter(
+        str(domain["business_id"])
+        for domain in itertools.chain(root_domains, sub_domains)
+    )
+    groups = [[] for _ in range(max(1, shards))]
+    heap = [(0, index) for index in range(len(groups))]
+    for business in sorted(
+        businesses, key=lambda business: weights[str(business["_id"])], reverse=True
+    ):
+        load, index = heapq.heappop(heap)
+        groups[index].append(business)
+        heapq.heappush(heap, (load + weights[str(business["_id"])] + 1, index))
+    return [group for group in groups if group]
+
+
+class ShardRouter:
+    """
+    按 bbdb 中域名所属的业务把 ARL 数据路由到分片：
+    先精确匹配根域名和子域名，找不到时再按根域名后缀从短到长匹配，都匹配不到返回 None
+    """
+
+    def __init__(self, shard_businesses, root_domains, sub_domains):
+        shard_of_business = {
+            str(business["_id"]): index
+            for index, group in enumerate(shard_businesses)
+            for business in group
+        }
+        self.by_name = {}
+        root_shards = {}
+        for domain in itertools.chain(root_domains, sub_domains):
+            shard = shard_of_business.get(str(domain["business_id"]))
+            if shard is not None:
+                self.by_name.setdefault(normalize_hostname(domain["name"]), shard)
+        for root_domain in root_domains:
+            shard = shard_of_business.get(str(root_domain["business_id"]))
+            if shard is not None:
+                root_shards.setdefault(normalize_hostname(root_domain["name"]), shard)
+        self.root_index = build_domain_suffix_index(root_shards)
+
+    def shard_of(self, hostname):
+        if not hostname:
+            return None
+        shard = self.by_name.get(hostname)
+        if shard is None:
+            shard = next(
+                (
+                    shard
+                    for _, shard in iter_domain_suffix_matches(
+                        self.root_index, hostname
+                    )
+                ),
+                None,
+            )
+        return shard
+
+
+def shard_spool_path(spool_dir, shard_index, kind):
+    return os.path.join(spool_dir, f"shard{shard_index}.{kind}")
+
+
+def spool_arl_assets_for_shards(
+    arl, router, spool_dir, shards, domain_params, site_params=None
+):
+    """
+    协调进程把域名导出、域名解析记录和站点导出各下载一次，按 router 写入每个分片的临时文件，
+    分片进程只读取自己的文件，不重复请求 ARL；三类数据在线程中并发下载，
+    返回 (域名导出失败的页码, 站点导出失败的页码)
+    """
+    failed_pages = []
+    failed_site_pages = []
+
+    def domain_rows():
+        for batch in iter_arl_assets(
+            arl,
+            "domain",
+            domain_params,
+            normalize=normalize_hostname,
+            failed_pages=failed_pages,
+        ):
+            for domain in batch:
+                yield router.shard_of(domain), domain
+
+    def ip_rows():
+        # 第 7 步只使用有解析记录的 A 记录，落盘时只保留用到的字段
+        for page_items in iter_arl_domainpages_for_ip(arl):
+            for item in page_items:
+                if item.get("type") != "A" or not item.get("ips"):
+                    continue
+                domain = item.get("domain") or ""
+                yield router.shard_of(normalize_hostname(domain)), json.dumps(
+                    {"domain": domain, "type": "A", "ips": item["ips"]},
+                    ensure_ascii=False,
+                )
+
+    def site_rows():
+        for batch in iter_arl_assets(
+            arl,
+            "site",
+            site_params,
+            normalize=canonical_site_url,
+            failed_pages=failed_site_pages,
+        ):
+            for site_url in batch:
+                yield router.shard_of(
+                    normalize_hostname(urlsplit(site_url).hostname)
+                ), site_url
+
+    def spool(kind, rows):
+        files = [
+            open(shard_spool_path(spool_dir, index, kind), "w", encoding="utf-8")
+            for index in range(shards)
+        ]
+        try:
+            for shard, line in rows:
+                if shard is not None:
+                    files[shard].write(line + "\n")
+        finally:
+            for f in files:
+                f.close()
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(spool, kind, rows)
+            for kind, rows in (
+                ("domain", domain_rows()),
+                ("ip", ip_rows()),
+                ("site", site_rows()),
+            )
+        ]
+        for future in futures:
+            future.result()
+    return failed_pages, failed_site_pages
+
+
+def iter_spooled_lines(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line:
+                yield line
+
+
+def iter_spooled_batches(path, batch_size=ARL_STREAM_BATCH_SIZE):
+    # 按与 ARL 导出相同的批次大小读取落盘文件
+    lines = iter_spooled_lines(path)
+    while True:
+        batch = list(itertools.islice(lines, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_spooled_pages(path, page_size=ARL_PAGE_SIZE):
+    # 按页 yield 落盘的域名解析记录，与 iter_arl_domainpages_for_ip 的格式一致
+    page = []
+    for line in iter_spooled_lines(path):
+        page.append(json.loads(line))
+        if len(page) >= page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def run_sync_shard(
+    shard_index, business_ids, scopes, spool_dir, plan, site_plan, name_keyword
+):
+    """
+    分片进程入口：使用自己的 ARL 会话和 Mongo 连接，对本分片的业务执行第 6-8 步，
+    ARL 数据从协调进程落盘的文件读取，返回本分片的统计数据和各步骤耗时
+    """
+    global new_sites_to_bbdb
+    new_sites_to_bbdb = []
+
+    # Prometheus 文件只由协调进程写出
+    os.environ.pop("BBDB_TRACE_PROM", None)
+    tracer = tracing.configure(f"bbdb_arl-shard{shard_index}")
+    client = MongoClient(
+        os.environ.get("BBDB_MONGOURI"),
+        event_listeners=[tracing.MongoCommandTracer(tracer)],
+    )
+    db = client[os.environ.get("BBDB_MONGO_DB") or "bbdb"]
+    arl = login_arl()
+    if arl is None:
+        client.close()
+        raise RuntimeError("ARL 登录失败")
+    # 列表缓存只由协调进程维护
+    arl.listing_cache = None
+
+    try:
+        working_set = BbdbWorkingSet(db, name_keyword, business_ids)
+        businesses, root_domains, sub_domains, sites, ips, blacklists = (
+            working_set.data()
+        )
+
+        tracing.begin_stage("6-domain_sync")
+        domain_path = shard_spool_path(spool_dir, shard_index, "domain")
+        domain_result = sync_domain_assets(
+            arl,
+            db,
+            scopes,
+            businesses,
+            root_domains,
+            sub_domains,
+            blacklists,
+            working_set=working_set,
+            plan=plan,
+            arl_domain_batches=iter_spooled_batches(domain_path),
+            save_state=False,
+        )
+        # 其他分片只写入自己的业务，直接使用原地更新后的工作集，不需要探测外部写入
+        businesses, root_domains, sub_domains, sites, ips, blacklists = (
+            working_set.data()
+        )
+
+        tracing.begin_stage("7-ip_sync")
+        new_ips_count = arl_ip_to_bbdb(
+            db,
+            arl,
+            businesses,
+            root_domains,
+            sub_domains,
+            blacklists,
+            ips,
+            working_set,
+            domain_pages=iter_spooled_pages(
+                shard_spool_path(spool_dir, shard_index, "ip")
+            ),
+        )
+
+        tracing.begin_stage("8-site_sync")
+        arl_site_to_bbdb(
+            db,
+            arl,
+            businesses,
+            root_domains,
+            sub_domains,
+            blacklists,
+            sites,
+            working_set,
+            site_urls=iter_spooled_lines(
+                shard_spool_path(spool_dir, shard_index, "site")
+            ),
+            plan=site_plan,
+            save_state=False,
+        )
+        tracing.end_stage()
+
+        return {
+            "new_domains_to_arl": domain_result.new_domains_to_arl,
+            "new_domains_to_bbdb": domain_result.new_domains_to_bbdb,
+            "new_ips_count": new_ips_count,
+            "new_sites_to_bbdb": new_sites_to_bbdb,
+            "domain_synced": domain_result.synced,
+            "summary": tracer.summary_lines(),
+        }
+    finally:
+        tracer.close()
+        arl.close()
+        client.close()
+
+
+def run_sharded_sync(
+    arl, db, name_keyword, arl_all_scopes, businesses, root_domains, sub_domains, shards
+):
+    """
+    分片模式下的第 6-8 步
+
+    协调进程按域名数量把业务分到 shards 个分片，ARL 数据只下载一次并按分片落盘，
+    各分片进程（spawn 启动，不继承协调进程的连接和线程）并行同步，最后合并统计数据，
+    所有分片成功且 ARL 导出完整时才更新域名同步水位
+    """
+    stats = {
+        "new_domains_to_arl": 0,
+        "new_domains_to_bbdb": 0,
+        "new_ips_count": 0,
+        "new_sites_to_bbdb": [],
+    }
+    shard_businesses = partition_businesses(
+        businesses, root_domains, sub_domains, shards
+    )
+    if not shard_businesses:
+        log_message("6-没有需要同步的业务")
+        return stats
+
+    plan = plan_domain_sync(db)
+    site_plan = plan_site_sync(db)
+    router = ShardRouter(shard_businesses, root_domains, sub_domains)
+    failed_shards = []
+    # 域名同步不完整（导出失败或有写入失败）的分片
+    unsynced_shards = []
+    with tempfile.TemporaryDirectory(prefix="bbdb_arl_shards_") as spool_dir:
+        with tracing.span("6-spool_arl_assets"):
+            failed_pages, failed_site_pages = spool_arl_assets_for_shards(
+                arl,
+                router,
+                spool_dir,
+                len(shard_businesses),
+                plan["arl_params"],
+                site_plan["arl_params"],
+            )
+        log_message(f"6-ARL 数据已按 {len(shard_businesses)} 个分片落盘，开始并行同步")
+
+        executor = ProcessPoolExecutor(
+            max_workers=len(shard_businesses),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        with executor:
+            futures = []
+            for index, group in enumerate(shard_businesses):
+                names = {business["name"] for business in group}
+                futures.append(
+                    executor.submit(
+                        run_sync_shard,
+                        index,
+                        [business["_id"] for business in group],
+                        [scope for scope in arl_all_scopes if scope["name"] in names],
+                        spool_dir,
+                        plan,
+                        site_plan,
+                        name_keyword,
+                    )
+                )
+            for index, future in enumerate(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    log_message(f"分片 {index} 执行失败: {e}", False)
+                    failed_shards.append(index)
+                    continue
+                if not result["domain_synced"]:
+                    unsynced_shards.append(index)
+                stats["new_domains_to_arl"] += result["new_domains_to_arl"]
+                stats["new_domains_to_bbdb"] += result["new_domains_to_bbdb"]
+                stats["new_ips_count"] += result["new_ips_count"]
+                stats["new_sites_to_bbdb"].extend(result["new_sites_to_bbdb"])
+                for line in result["summary"]:
+                    log_message(f"分片 {index} {line}")
+
+    # 分片进程向资产分组添加了域名，协调进程的分组列表缓存随之失效
+    if stats["new_domains_to_arl"] and arl.listing_cache is not None:
+        arl.listing_cache.invalidate_for("/api/asset_scope/add/")
+
+    if failed_pages or failed_shards or unsynced_shards:
+        log_message("6-ARL 域名导出不完整或有分片失败，本次不更新同步水位", False)
+    else:
+        save_domain_sync_state(db, plan, root_domains, sub_domains)
+    if failed_site_pages or failed_shards:
+        log_message("8-ARL 站点导出不完整或有分片失败，本次不更新站点同步水位", False)
+    else:
+        save_site_sync_state(db, site_plan)
+    return stats
+
 
 def main():
     # 检查环境变量
@@ -1627,9 +3188,6 @@ def main():
         sys.exit("环境变量检查失败")
 
     # 从环境变量获取参数
-    arl_url = os.environ.get("BBDB_ARL_URL")
-    username = os.environ.get("BBDB_ARL_USERNAME")
-    password = os.environ.get("BBDB_ARL_PASSWORD")
     mongodb_uri = os.environ.get("BBDB_MONGOURI")
     name_keyword = "国内-雷神众测-"
 
@@ -1638,139 +3196,178 @@ def main():
         sys.exit(1)
 
     # 连接到MongoDB
-    client = MongoClient(mongodb_uri)
-    db = client["bbdb"]
+    # 每个 HTTP 请求和 Mongo 命令都记录到当前步骤，运行结束输出汇总
+    tracer = tracing.configure("bbdb_arl")
+    client = MongoClient(
+        mongodb_uri, event_listeners=[tracing.MongoCommandTracer(tracer)]
+    )
+    # 数据库名默认为 bbdb，压测时指向单独的数据库
+    db = client[os.environ.get("BBDB_MONGO_DB") or "bbdb"]
+    ensure_indexes(db, lambda message: log_message(message, False))
+    # 上一次运行还没结束时直接退出，避免重复下载 ARL 数据和重复写入 bbdb
+    lease = acquire_run_lease(
+        db, "bbdb_arl", lambda message: log_message(message, False)
+    )
+    if lease is None:
+        return
 
-    global new_domains_to_arl, new_domains_to_bbdb, new_ips_to_bbdb, new_sites_to_bbdb
-    new_domains_to_arl = set()
-    new_domains_to_bbdb = set()
-    new_ips_to_bbdb = set()
+    global new_sites_to_bbdb
 
     # 1. 从bbdb全量读取"国内-"开头的business，root_domain,sub_domain数据，并登录ARL获取token。
-    token = login_arl()
+    tracing.begin_stage("1-load_bbdb")
+    arl = login_arl()
+    if arl is None:
+        sys.exit("ARL 登录失败")
     log_message("1-bbdb读取中")
-    businesses, root_domains, sub_domains, sites, ips, blacklists = get_bbdb_data(
-        db, name_keyword
-    )
+    # 工作集在各步骤插入后原地更新，只有检测到外部写入时才重新读取
+    working_set = BbdbWorkingSet(db, name_keyword)
+    businesses, root_domains, sub_domains, sites, ips, blacklists = working_set.data()
     log_message("1-读取bbdb完成，准备获取arl资产分组")
 
     # 2. 获取ARL中资产分组的名称，并与business中的name进行比较，确定需要互相插入的资产分组。
-    arl_all_scopes = get_arl_scopes_pages(token, arl_url)
+    tracing.begin_stage("2-compare_groups")
+    arl_all_scopes = get_arl_scopes_pages(arl)
     business_only_asset_scopes, arl_only_asset_scopes = compare_business_and_arl(
         businesses, arl_all_scopes
     )
     log_message("2-arl和bbdb分组信息确认完成，准备arl插入")
 
     # 3. 首先进行bbdb向ARL进行新分组的插入，插入根域名和子域名（合并去重，保持原有顺序，根域名在先），scope_type为domain。
+    tracing.begin_stage("3-groups_to_arl")
     if business_only_asset_scopes:
         insert_new_group_to_arl(
-            token,
-            arl_url,
+            arl,
             business_only_asset_scopes,
             businesses,
             root_domains,
             sub_domains,
         )
-        # 刷新bbdb
-        businesses, root_domains, sub_domains, sites, ips, blacklists = get_bbdb_data(
-            db, name_keyword
-        )
-        # 重新获取ARL中资产分组的scope_id
-        arl_all_scopes = get_arl_scopes_pages(token, arl_url)
+        # 这一步只写入 ARL，bbdb 工作集不变，重新获取ARL中资产分组的scope_id
+        arl_all_scopes = get_arl_scopes_pages(arl)
         log_message("3-arl新分组插入完成，准备检测扫描策略")
     else:
         log_message("3-没有需要插入到 arl 的新分组")
 
     # 4. 完成后，再进行ARL向bbdb的插入。对于每一个只在 ARL 资产分组中的 name，添加到 bbdb 中
+    tracing.begin_stage("4-groups_to_bbdb")
     if arl_only_asset_scopes:
-        insert_new_group_to_bbdb(db, arl_only_asset_scopes, arl_all_scopes)
-        # 刷新bbdb
-        businesses, root_domains, sub_domains, sites, ips, blacklists = get_bbdb_data(
-            db, name_keyword
+        insert_new_group_to_bbdb(db, arl_only_asset_scopes, arl_all_scopes, working_set)
+        # 刷新bbdb，新插入的文档已经记录在工作集中
+        working_set.refresh()
+        businesses, root_domains, sub_domains, sites, ips, blacklists = (
+            working_set.data()
         )
         log_message("4-bbdb分组插入完成，等待检测分组扫描策略是否完整")
     else:
         log_message("4-没有需要插入到 bbdb 的新分组，准备检测扫描策略")
 
     # 5.扫描策略配置。为ARL中没有对应扫描策略的资产分组，添加与其资产分组名称相同的扫描策略.
+    tracing.begin_stage("5-policies")
+    # 策略列表只读取一次，之后的新增、删除和查找都在缓存上进行
+    policy_cache = PolicyCache.load(arl)
     arl_scope_ids = [asset_scope["_id"] for asset_scope in arl_all_scopes]
     unconfigured_asset_group_ids = configure_scanning_policies(
-        arl_url, token, arl_scope_ids, arl_all_scopes
+        arl, arl_scope_ids, arl_all_scopes, policy_cache
     )
     if unconfigured_asset_group_ids:
         log_message("5-策略更新完成，开始双向域名资产同步")
     else:
         log_message("5-没有需要更新的策略，开始双向域名资产同步")
 
-    # 6. 域名资产同步。对双向相同的分组中的域名资产进行双向同步，bbdb侧从内存中读取比较后，提取绝对根域名并对比root_domain表，子域名对比sub_domain表，ARL侧则将新增子域名直接插入资产分组的资产范围中后，将新增的域名也启动监控任务。
-    arl_all_policies = get_arl_all_policies(arl_url, token)
-    sync_domain_assets(
-        arl_url,
-        token,
-        db,
-        arl_all_scopes,
-        arl_all_policies,
-        businesses,
-        root_domains,
-        sub_domains,
-        blacklists,
-    )
-    log_message("6-域名资产双向同步完成")
-
-    # 刷新bbdb和arl资产
-    businesses, root_domains, sub_domains, sites, ips, blacklists = get_bbdb_data(
-        db, name_keyword
-    )
-    arl_all_scopes = get_arl_scopes_pages(token, arl_url)
-
-    # 7. IP资产同步。原始arl版本在请求资产页面能直接得到部分ip，现在资产页面只有初始设置时的域名字段，且不会更新，只能访问资产总览页面，翻页实现读取所有内容并解析，会导致大量网络请求。
-    log_message("7-准备ip导入bbdb任务，注意会造成大量对arl的请求，酌情使用")
-    arl_ip_to_bbdb(
-        db, arl_url, token, businesses, root_domains, sub_domains, blacklists, ips
-    )
-    log_message("7-ip导入bbdb任务处理完毕")
-
-    # 8. 站点site资产同步，下载全部数据后解析找到对应资产分组
-    log_message("8-准备url导入bbdb任务")
-    arl_site_to_bbdb(
-        db, arl_url, token, businesses, root_domains, sub_domains, blacklists, sites
-    )
-    log_message("8-url导入bbdb任务处理完毕")
+    # 6. 域名资产同步。对双向相同的分组中的域名资产进行双向同步，bbdb侧从内存中读取比较后，提取绝对根域名并对比root_domain表，子域名对比sub_domain表，ARL侧则将新增子域名直接插入资产分组的资产范围中后，新增域名的监控任务在第 9 步统一对账。
+    if ARL_SYNC_SHARDS > 1:
+        # 分片模式：第 6-8 步按业务分到 BBDB_ARL_SYNC_SHARDS 个进程并行执行，ARL 数据只下载一次
+        tracing.begin_stage("6-8-sharded_sync", shards=ARL_SYNC_SHARDS)
+        stats = run_sharded_sync(
+            arl,
+            db,
+            name_keyword,
+            arl_all_scopes,
+            businesses,
+            root_domains,
+            sub_domains,
+            ARL_SYNC_SHARDS,
+        )
+        new_domains_to_arl = stats["new_domains_to_arl"]
+        new_domains_to_bbdb = stats["new_domains_to_bbdb"]
+        new_ips_count = stats["new_ips_count"]
+        new_sites_to_bbdb = stats["new_sites_to_bbdb"]
+        log_message("6-8-分片同步完成")
+    else:
+        tracing.begin_stage("6-domain_sync")
+        domain_result = sync_domain_assets(
+            arl,
+            db,
+            arl_all_scopes,
+            businesses,
+            root_domains,
+            sub_domains,
+            blacklists,
+            working_set=working_set,
+        )
+        new_domains_to_arl = domain_result.new_domains_to_arl
+        new_domains_to_bbdb = domain_result.new_domains_to_bbdb
+        log_message("6-域名资产双向同步完成")
+
+        # 刷新bbdb，第 7、8 步不使用 ARL 资产分组，第 9 步再刷新
+        working_set.refresh()
+        businesses, root_domains, sub_domains, sites, ips, blacklists = (
+            working_set.data()
+        )
 
-    # 9.监控任务触发。配置好资产分组和对应的策略后，批量为新增的策略和资产分组触发监控和站点监控任务。
-    log_message("9-刷新arl资产，准备批量添加监控任务")
-    # 重新获取策略列表
-    arl_all_policies = get_arl_all_policies(arl_url, token)
-    arl_all_scopes = get_arl_scopes_pages(token, arl_url)
-    for asset_scope in arl_all_scopes:
-        scope_id = asset_scope["_id"]
-        domain = ",".join(asset_scope["scope_array"])
-        # 找到对应的策略
-        policy = next(
-            (
-                policy
-                for policy in arl_all_policies
-                if policy["policy"]["scope_config"]["scope_id"] == scope_id
-            ),
-            None,
+        # 7. IP资产同步。原始arl版本在请求资产页面能直接得到部分ip，现在资产页面只有初始设置时的域名字段，且不会更新，只能访问资产总览页面，翻页实现读取所有内容并解析，会导致大量网络请求。
+        tracing.begin_stage("7-ip_sync")
+        log_message("7-准备ip导入bbdb任务，注意会造成大量对arl的请求，酌情使用")
+        new_ips_count = arl_ip_to_bbdb(
+            db, arl, businesses, root_domains, sub_domains, blacklists, ips, working_set
         )
-        if policy is not None:
-            policy_id = policy["_id"]
-            add_scheduler(token, arl_url, scope_id, domain, policy_id)
-            add_site_monitor(token, arl_url, scope_id)  # 添加站点更新监控周期任务
-        else:
-            log_message(f"No policy found for scope_id {scope_id}")
-    log_message("9-arl监控任务添加完毕,统计数据，脚本结束")
+        log_message("7-ip导入bbdb任务处理完毕")
+
+        # 8. 站点site资产同步，增量模式下只拉取上次水位之后更新的站点，解析找到对应资产分组后按规范化 URL 批量 upsert
+        tracing.begin_stage("8-site_sync")
+        log_message("8-准备url导入bbdb任务")
+        arl_site_to_bbdb(
+            db,
+            arl,
+            businesses,
+            root_domains,
+            sub_domains,
+            blacklists,
+            sites,
+            working_set,
+        )
+        log_message("8-url导入bbdb任务处理完毕")
+
+    # 9.监控任务对账。配置好资产分组和对应的策略后，一次性读取已有的监控任务，只补齐缺失的域名监控和站点监控任务，删除重复或过期的任务。
+    tracing.begin_stage("9-schedulers")
+    log_message("9-刷新arl资产，准备对账监控任务")
+    # 策略直接使用第 5 步维护的缓存，资产分组决定要删除哪些任务，跳过列表缓存重新读取
+    arl_all_scopes = get_arl_scopes_pages(arl, fresh=True)
+    scheduler_stats = reconcile_schedulers(arl, arl_all_scopes, policy_cache)
+    log_message(
+        f"9-arl监控任务对账完毕，新增监控域名 {scheduler_stats['added']} 个，"
+        f"新增站点监控 {scheduler_stats['site_monitors_added']} 个，"
+        f"删除任务 {scheduler_stats['removed']} 个，统计数据，脚本结束"
+    )
 
     # 10. 在每次脚本运行结束后，统计双方互相同步的新资产分组数量，新同步的子域名数量、IP数量。
     log_message(f"以下为统计信息\n{'-'*70}")
     log_message(f"arl 添加的新分组数量： {len(business_only_asset_scopes)}")
     log_message(f"bbdb 添加的新分组数量： {len(arl_only_asset_scopes)}")
-    log_message(f"arl 添加的新域名数量：{len(new_domains_to_arl)}")
-    log_message(f"bbdb 添加的新域名数量：{len(new_domains_to_bbdb)}")
-    log_message(f"bbdb 添加的新 ip 数量：{len(new_ips_to_bbdb)}")
+    log_message(f"arl 添加的新域名数量：{new_domains_to_arl}")
+    log_message(f"bbdb 添加的新域名数量：{new_domains_to_bbdb}")
+    log_message(f"bbdb 添加的新 ip 数量：{new_ips_count}")
     log_message(f"bbdb 添加的新 url 数量：{len(new_sites_to_bbdb)}")
 
+    tracing.end_stage()
+    log_message(f"以下为各步骤耗时\n{'-'*70}")
+    for line in tracer.summary_lines():
+        log_message(line)
+    tracer.close()
+
+    arl.close()
+    lease.release()
+
 
 if __name__ == "__main__":
     main()
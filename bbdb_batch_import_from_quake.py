@@ -5,16 +5,18 @@ new Env('Quake数据导入bbdb');
 文件名: bbdb_batch_import_from_quake.py
 作者: soapffz
 创建日期: 2023年10月15日
-最后修改日期: 2023年3月26日
+最后修改日期: 2026年10月18日
 
-这个脚本用于从Excel文件中读取数据，并将数据导入到MongoDB数据库中。它首先会连接到MongoDB，然后查询business表。如果找不到指定的business，脚本会停止运行。然后，脚本会读取Excel文件，并处理文件中的数据。它会移除单元格值开头的单引号，并提取绝对根域名和子域名。如果在数据库中找不到对应的root_domain或sub_domain，脚本会创建新的记录。然后，脚本会准备site表和ip表的数据，并插入到数据库中。在处理数据的过程中，脚本会处理URL，移除:443和:80，并将'keywords', 'applications', 'applications_categories', 'applications_types', 'applications_levels', 'application_manufacturer'这些字段的值转换为列表，并将嵌套的列表展平为一级列表。如果在处理过程中遇到错误，脚本会打印错误信息并跳过当前列。
+这个脚本用于从Excel文件中读取数据，并将数据导入到MongoDB数据库中。它首先会连接到MongoDB，然后查询business表。如果找不到指定的business，脚本会停止运行。然后，脚本会读取Excel文件，并处理文件中的数据。它会移除单元格值开头的单引号，并提取绝对根域名和子域名。root_domain和sub_domain按name做upsert，找不到时创建新的记录，已存在时沿用原记录。然后，脚本会准备site表和ip表的数据，并插入到数据库中。在处理数据的过程中，脚本会处理URL，移除:443和:80，并将'keywords', 'applications', 'applications_categories', 'applications_types', 'applications_levels', 'application_manufacturer'这些字段的值转换为列表，并将嵌套的列表展平为一级列表。如果在处理过程中遇到错误，脚本会打印错误信息并跳过当前列。
 """
 import os
 import pandas as pd
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 import ast
 import re
 from datetime import datetime, timedelta, timezone
+from bbdb_domain_resolver import get_root_domain
+from bbdb_indexes import ensure_indexes
 
 def log_message(message, is_positive=True):
     """打印日志信息"""
@@ -33,29 +35,30 @@ def flatten(lst):
 
 def process_domain(domain, icpregnum, company, db):
     """处理域名相关数据"""
-    pattern = r"[\w-]+\.[\w-]+$"
-    match = re.search(pattern, domain)
-    if match:
-        root_domain_name = match.group()
-        root_domain = db.root_domain.find_one({"name": root_domain_name})
-        if root_domain is None:
-            root_domain_id = db.root_domain.insert_one(
-                {
+    root_domain_name = get_root_domain(domain)
+    if root_domain_name:
+        # 按 name upsert，已存在时直接返回原文档，由 name 唯一索引保证并发导入不会重复插入
+        root_domain_id = db.root_domain.find_one_and_update(
+            {"name": root_domain_name},
+            {
+                "$setOnInsert": {
                     "name": root_domain_name,
                     "icpregnum": icpregnum,
                     "company": company,
                     "create_time": datetime.now(),
                     "update_time": datetime.now(),
                 }
-            ).inserted_id
-        else:
-            root_domain_id = root_domain["_id"]
+            },
+            projection={"_id": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )["_id"]
 
         if root_domain_name != domain:
-            sub_domain = db.sub_domain.find_one({"name": domain})
-            if sub_domain is None:
-                sub_domain_id = db.sub_domain.insert_one(
-                    {
+            sub_domain_id = db.sub_domain.find_one_and_update(
+                {"name": domain},
+                {
+                    "$setOnInsert": {
                         "name": domain,
                         "root_domain_id": root_domain_id,
                         "icpregnum": icpregnum,
@@ -63,9 +66,11 @@ def process_domain(domain, icpregnum, company, db):
                         "create_time": datetime.now(),
                         "update_time": datetime.now(),
                     }
-                ).inserted_id
-            else:
-                sub_domain_id = sub_domain["_id"]
+                },
+                projection={"_id": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )["_id"]
         else:
             sub_domain_id = None
 
@@ -139,6 +144,7 @@ def batch_import_from_quake_to_bbdb(xlsx_name, business_name):
     mongodb_uri = os.getenv("BBDB_MONGOURI")
     client = MongoClient(mongodb_uri)
     db = client["bbdb"]
+    ensure_indexes(db, lambda message: log_message(message, False))
 
     # 查询business表
     log_message("Looking for business in the database...")
@@ -5,7 +5,7 @@ new Env('bbdb清洗');
 文件名: bbdb_clean.py
 作者: soapffz
 创建日期: 2023年10月1日
-最后修改日期: 2024年3月21日
+最后修改日期: 2026年10月18日
 
 以下清洗步骤建议不要调换顺序
 
@@ -13,7 +13,7 @@ new Env('bbdb清洗');
 2.将所有表中有business_id、root_domain_id、sub_domain_id字段，但是格式不是为string类型，而是ObjectId类型的地方转化为string类型。
 3.所有表中notes字段为空的文档，都将其设置为"set by soapffz"。
 4.每个表都必须有create_time和update_time字段，如果没有则创建，如果为空也将两个字段都设置为当前时间的北京时间。
-5.所有表中的name字段都应保持唯一，删除所有name字段重复的较老文档。
+5.所有表中的name字段都应保持唯一，删除所有name字段重复的较老文档；ip表按(address, root_domain_id, sub_domain_id, business_id)去重，同样保留最新的文档，去重后补建 bbdb_indexes.py 中声明的唯一索引。
 6.使用business_id、root_domain_id、sub_domain_id去相应表中查找，但是没有查找到对应文档的文档，查找逻辑为business_id为business表中的_id，root_domain_id为root_domain表中的_id，sub_domain_id为sub_domain的_id。
 7.删除所有root_domain和sub_domain表中name字段为ipv4地址的文档。(新增功能)
 8.将所有表中包含{"$numberDouble":"NaN"}这种空内容的文档，替换为"set by soapffz by clean"。(新增功能)
@@ -23,6 +23,8 @@ from pymongo import MongoClient, UpdateOne
 import os
 from datetime import datetime, timedelta
 from bson.objectid import ObjectId
+from bbdb_indexes import IP_KEY_FIELDS, NON_EMPTY_ADDRESS, ensure_indexes
+from bbdb_lease import acquire_run_lease
 
 # 初始化MongoDB连接
 mongodb_uri = os.getenv("BBDB_MONGOURI")
@@ -185,6 +187,38 @@ def ensure_unique_name():
     else:
         log(f"步骤5运行耗时：{int(elapsed_time)} s，未发现需要处理的文档。")
 
+def ensure_unique_ip():
+    # 实现需求5中ip表的部分，去重规则与 bbdb_indexes.py 中ip表的唯一索引一致
+    start_time = datetime.now()
+    total_deleted = 0
+
+    # 唯一索引中缺失的字段和null视为相同的值，分组时统一转为null
+    pipeline = [
+        {"$match": NON_EMPTY_ADDRESS},
+        {"$sort": {"_id": 1}},
+        {"$group": {
+            "_id": {field: {"$ifNull": [f"${field}", None]} for field in IP_KEY_FIELDS},
+            "uniqueIds": {"$push": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {
+            "count": {"$gt": 1}
+        }}
+    ]
+    for duplicate in db.ip.aggregate(pipeline, allowDiskUse=True):
+        # 按_id排序后保留最后一个，即最新的文档
+        ids_to_delete = duplicate["uniqueIds"][:-1]
+        result = db.ip.delete_many({"_id": {"$in": ids_to_delete}})
+        total_deleted += result.deleted_count
+
+    end_time = datetime.now()
+    elapsed_time = (end_time - start_time).total_seconds()
+
+    if total_deleted > 0:
+        log(f"步骤5(ip)运行耗时：{int(elapsed_time)} s，共处理文档个数：{total_deleted}")
+    else:
+        log(f"步骤5(ip)运行耗时：{int(elapsed_time)} s，未发现需要处理的文档。")
+
 def validate_references():
     # 实现需求6
     start_time = datetime.now()
@@ -274,13 +308,20 @@ def replace_nan_content():
     elapsed_time = (end_time - start_time).total_seconds()
 
 if __name__ == "__main__":
+    # 上一次清洗还没结束时直接退出
+    lease = acquire_run_lease(db, "bbdb_clean", lambda message: log(message, False))
+    if lease is None:
+        raise SystemExit(0)
     log("开始执行数据库清洗...")
     clean_empty_fields()
     convert_id_to_string()
     set_default_notes()
     ensure_time_fields()
     ensure_unique_name()
+    ensure_unique_ip()
+    ensure_indexes(db, lambda message: log(message, False))
     validate_references()
     remove_ipv4_names()
     replace_nan_content()
     log("数据库清洗完成。")
+    lease.release()
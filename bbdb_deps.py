@@ -11,7 +11,7 @@ import subprocess
 from datetime import datetime, timedelta, timezone
 
 # 系统级别的库白名单
-WHITELISTED_LIBS = {'os', 're', 'subprocess', 'datetime', 'timedelta', 'timezone', 'sys', 'math', 'collections', 'functools', 'itertools', 'json'}
+WHITELISTED_LIBS = {'os', 're', 'subprocess', 'datetime', 'timedelta', 'timezone', 'sys', 'math', 'collections', 'functools', 'itertools', 'json', 'time', 'random', 'threading', 'asyncio', 'hashlib', 'contextvars', 'contextlib', 'resource', 'atexit', 'socket', 'uuid', 'heapq', 'multiprocessing', 'tempfile', 'array', 'bisect', 'ipaddress'}
 
 def get_deps_from_file(file_path):
     """从 Python 文件中提取依赖项"""
@@ -51,4 +51,6 @@ if __name__ == '__main__':
             if file.endswith('.py'):
                 file_path = os.path.join(root, file)
                 all_deps.update(get_deps_from_file(file_path))
-    install_deps(all_deps - WHITELISTED_LIBS)
+    # 仓库内的公共模块（如 bbdb_domain_resolver）不需要安装
+    local_modules = {file[:-3] for file in os.listdir('.') if file.endswith('.py')}
+    install_deps(all_deps - WHITELISTED_LIBS - local_modules)
@@ -0,0 +1,315 @@
+"""
+文件名: bbdb_domain_resolver.py
+作者: soapffz
+创建日期: 2026年10月18日
+最后修改日期: 2026年10月18日
+
+根域名解析模块，供各个导入脚本共用，本身不是定时任务
+
+1. 使用仓库内置的 public_suffix_list.dat（Public Suffix List 快照，离线可用），
+   正确处理 .com.cn、.edu.cn、.gov.cn 这类多级公共后缀
+2. 后缀规则编译为按反转标签组织的字典树，单个域名只需从右往左走一遍
+3. 绝大多数主机名的根域名只取决于最右边三个标签，按这段尾部做 LRU 缓存，
+   只有命中三级及以上公共后缀时才完整解析；get_root_domains 为批量接口
+4. 默认只使用 ICANN 部分的规则，github.io 这类私有后缀不视为公共后缀
+5. 更新快照：从 https://publicsuffix.org/list/public_suffix_list.dat 下载覆盖同名文件即可
+6. normalize_hostnames 批量规范化主机名，一次遍历分出域名、IP 和无效值，
+   iter_normalized_hostnames 为流式版本，适合直接写入 bbdb_domain_set.DomainSet
+"""
+
+import ipaddress
+import itertools
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+PSL_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "public_suffix_list.dat"
+)
+
+# 字典树中标记规则类型的键，域名标签里不会出现这两个字符
+_RULE = "\0"
+_EXCEPTION = "!"
+
+_psl_tries = {}
+
+# 缓存按主机名最右边几个标签做键，标记需要完整解析的情况
+_TAIL_LABELS = 3
+_NEED_FULL = object()
+
+# 批量规范化时每次拼接在一起处理的主机名个数
+_NORMALIZE_CHUNK = 4096
+_MAX_HOSTNAME_LENGTH = 253
+# 以四段数字开头的主机名（例如 1.2.3.4.nip.io）沿用原来的过滤规则，不作为域名
+_IPV4_PREFIX = re.compile(r"\d+\.\d+\.\d+\.\d+")
+# IDN 转换后每一级只能由小写字母、数字和连字符组成，不超过 63 个字符
+_DOMAIN_PATTERN = re.compile(r"[a-z0-9-]{1,63}(?:\.[a-z0-9-]{1,63})*")
+
+HOSTNAME_DOMAIN = "domain"
+HOSTNAME_IP = "ip"
+HOSTNAME_REJECT = "reject"
+
+NormalizedHostnames = namedtuple("NormalizedHostnames", ["domains", "ips", "rejects"])
+
+
+def _to_ascii(label):
+    # 后缀表中的中文等国际化标签同时以 punycode 形式入树，兼容 xn-- 开头的域名
+    try:
+        return label.encode("idna").decode("ascii")
+    except UnicodeError:
+        return label
+
+
+def _add_rule(trie, rule):
+    is_exception = rule.startswith("!")
+    labels = rule.lstrip("!").split(".")
+    for variant in {tuple(labels), tuple(_to_ascii(label) for label in labels)}:
+        node = trie
+        for label in reversed(variant):
+            node = node.setdefault(label, {})
+        node[_EXCEPTION if is_exception else _RULE] = True
+
+
+def load_public_suffix_trie(include_private=False, psl_file=PSL_FILE):
+    """读取后缀表并编译为字典树，结果按参数缓存"""
+    key = (include_private, psl_file)
+    if key in _psl_tries:
+        return _psl_tries[key]
+
+    trie = {}
+    with open(psl_file, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if (
+                line.startswith("// ===BEGIN PRIVATE DOMAINS===")
+                and not include_private
+            ):
+                break
+            if not line or line.startswith("//"):
+                continue
+            # 规则以第一个空白字符结束
+            _add_rule(trie, line.split()[0].lower())
+
+    _psl_tries[key] = trie
+    return trie
+
+
+def _hostname_to_ascii(hostname):
+    # 中文等国际化域名转为 punycode，与 normalize_hostnames 输出的形式一致，转换失败时原样返回
+    try:
+        return hostname.encode("idna").decode("ascii")
+    except UnicodeError:
+        return hostname
+
+
+def normalize_hostname(hostname):
+    """统一小写并去除首尾的点和空白，国际化域名转为 punycode，空值返回空字符串"""
+    if not hostname:
+        return ""
+    hostname = hostname.strip().strip(".").lower()
+    if not hostname.isascii():
+        hostname = _hostname_to_ascii(hostname)
+    return hostname
+
+
+def is_ip_address(hostname):
+    """粗略判断是否为 IP 地址：IPv6 含冒号，IPv4 最后一段为纯数字"""
+    return ":" in hostname or hostname.rsplit(".", 1)[-1].isdigit()
+
+
+def _classify_ip(hostname):
+    # 合法 IP 返回标准写法（IPv6 为压缩形式），否则返回 None
+    try:
+        return str(ipaddress.ip_address(hostname.strip("[]")))
+    except ValueError:
+        return None
+
+
+def _classify_hostname(hostname, blacklist, check_idna):
+    # hostname 已经小写并去除首尾的点和空白，且不为空
+    if ":" in hostname or hostname.rpartition(".")[2].isdigit():
+        ip = _classify_ip(hostname)
+        if ip is None or ip in blacklist:
+            return HOSTNAME_REJECT, None
+        return HOSTNAME_IP, ip
+    if check_idna and not hostname.isascii():
+        try:
+            hostname = hostname.encode("idna").decode("ascii")
+        except UnicodeError:
+            return HOSTNAME_REJECT, None
+    if (
+        len(hostname) > _MAX_HOSTNAME_LENGTH
+        or not _DOMAIN_PATTERN.fullmatch(hostname)
+        or (hostname[0].isdigit() and _IPV4_PREFIX.match(hostname))
+        or hostname in blacklist
+    ):
+        return HOSTNAME_REJECT, None
+    return HOSTNAME_DOMAIN, hostname
+
+
+def iter_normalized_hostnames(hostnames, blacklist=frozenset()):
+    """
+    流式规范化主机名，按输入顺序 yield (类型, 值)，类型为 HOSTNAME_DOMAIN/HOSTNAME_IP/HOSTNAME_REJECT
+
+    每 _NORMALIZE_CHUNK 个主机名拼成一个字符串统一 lower() 和判断是否纯 ASCII，
+    纯 ASCII 的批次跳过 IDN 转换；域名和 IP 返回规范化后的值，无效值返回原始值，空值直接跳过
+    """
+    iterator = iter(hostnames)
+    while True:
+        chunk = list(itertools.islice(iterator, _NORMALIZE_CHUNK))
+        if not chunk:
+            return
+        chunk = [hostname for hostname in chunk if hostname]
+        text = "\n".join(chunk)
+        lowered = text.lower().split("\n")
+        if len(lowered) != len(chunk):
+            # 主机名中含有换行符，退回逐个处理
+            lowered = [hostname.lower() for hostname in chunk]
+        check_idna = not text.isascii()
+        for raw, hostname in zip(chunk, lowered):
+            hostname = hostname.strip().strip(".")
+            if not hostname:
+                continue
+            kind, value = _classify_hostname(hostname, blacklist, check_idna)
+            yield kind, raw if value is None else value
+
+
+def normalize_hostnames(hostnames, blacklist=frozenset()):
+    """
+    批量规范化主机名，一次遍历分为域名、IP 和无效值三类，返回 NormalizedHostnames
+
+    1. 域名统一小写并去除首尾的点和空白，中文等国际化域名转为 punycode
+    2. 含冒号或最后一段为纯数字的按 ipaddress 判断，合法的归入 ips，否则归入 rejects
+    3. 含有字母、数字、连字符以外的字符（包括 *、_、/、@ 和空白）、连续的点、超长、IDN 转换失败、
+       以 IPv4 开头以及在 blacklist 中的归入 rejects
+    三个列表各自去重并保持输入顺序，rejects 中是原始值
+    """
+    groups = {HOSTNAME_DOMAIN: {}, HOSTNAME_IP: {}, HOSTNAME_REJECT: {}}
+    for kind, value in iter_normalized_hostnames(hostnames, blacklist):
+        groups[kind][value] = None
+    return NormalizedHostnames(
+        list(groups[HOSTNAME_DOMAIN]),
+        list(groups[HOSTNAME_IP]),
+        list(groups[HOSTNAME_REJECT]),
+    )
+
+
+def _tail(hostname, labels):
+    # 取主机名最右边 labels 个标签，不足时返回整个主机名
+    index = len(hostname)
+    for _ in range(labels):
+        index = hostname.rfind(".", 0, index)
+        if index < 0:
+            return hostname
+    return hostname[index + 1 :]
+
+
+def _public_suffix_length(labels, trie):
+    """
+    返回 (公共后缀占用的标签个数, 是否走完了所有标签)，
+    没有规则匹配时按默认规则 "*" 取最后一个标签；走完所有标签说明更左边的标签可能影响结果
+    """
+    length = 1
+    node = trie
+    depth = len(labels)
+    for i in range(depth - 1, -1, -1):
+        child = node.get(labels[i])
+        matched = depth - i
+        if child is not None and _EXCEPTION in child:
+            # 例外规则：公共后缀是它的上一级
+            return matched - 1, False
+        if "*" in node:
+            length = max(length, matched)
+        if child is None:
+            return length, False
+        if _RULE in child:
+            length = max(length, matched)
+        node = child
+    return length, True
+
+
+def _root_domain_of_labels(labels, include_private):
+    length, _ = _public_suffix_length(labels, load_public_suffix_trie(include_private))
+    if len(labels) <= length:
+        return None
+    return ".".join(labels[-length - 1 :])
+
+
+@lru_cache(maxsize=1 << 16)
+def _root_domain_of_tail(tail, include_private):
+    labels = tail.split(".")
+    length, exhausted = _public_suffix_length(
+        labels, load_public_suffix_trie(include_private)
+    )
+    # 尾部全部是公共后缀或者还可能匹配更长的规则时，交给完整解析
+    if exhausted or len(labels) <= length:
+        return _NEED_FULL
+    return ".".join(labels[-length - 1 :])
+
+
+def _resolve(hostname, include_private):
+    # hostname 已经规范化且不是 IP
+    root_domain = _root_domain_of_tail(_tail(hostname, _TAIL_LABELS), include_private)
+    if root_domain is _NEED_FULL:
+        root_domain = _root_domain_of_labels(hostname.split("."), include_private)
+    return root_domain
+
+
+def get_public_suffix(hostname, include_private=False):
+    """返回主机名的公共后缀，例如 a.b.com.cn 返回 com.cn，IP 或空值返回 None"""
+    hostname = normalize_hostname(hostname)
+    if not hostname or is_ip_address(hostname):
+        return None
+    labels = hostname.split(".")
+    length, _ = _public_suffix_length(labels, load_public_suffix_trie(include_private))
+    return ".".join(labels[-length:])
+
+
+def get_root_domain(hostname, include_private=False):
+    """
+    返回主机名的根域名（公共后缀再加一级），例如 www.example.edu.cn 返回 example.edu.cn
+
+    国际化域名按 punycode 返回；主机名本身就是公共后缀、是 IP 地址或为空时返回 None
+    """
+    hostname = normalize_hostname(hostname)
+    if not hostname or is_ip_address(hostname):
+        return None
+    return _resolve(hostname, include_private)
+
+
+def get_root_domains(hostnames, include_private=False):
+    """
+    批量解析根域名，返回与输入一一对应的列表
+
+    与逐个调用 get_root_domain 结果一致，循环内联了规范化和取尾部的步骤，
+    并用本次调用内的字典代替 LRU 缓存，适合一次处理大量主机名
+    """
+    tail_cache = {}
+    results = []
+    append = results.append
+    for hostname in hostnames:
+        if not hostname:
+            append(None)
+            continue
+        hostname = hostname.strip().strip(".").lower()
+        if not hostname.isascii():
+            hostname = _hostname_to_ascii(hostname)
+        parts = hostname.rsplit(".", _TAIL_LABELS)
+        if not hostname or ":" in hostname or parts[-1].isdigit():
+            append(None)
+            continue
+        tail = hostname if len(parts) <= _TAIL_LABELS else hostname[len(parts[0]) + 1 :]
+        root_domain = tail_cache.get(tail)
+        if root_domain is None:
+            root_domain = _root_domain_of_tail(tail, include_private)
+            tail_cache[tail] = root_domain
+        if root_domain is _NEED_FULL:
+            root_domain = _root_domain_of_labels(hostname.split("."), include_private)
+        append(root_domain)
+    return results
+
+
+def is_root_domain(hostname, include_private=False):
+    """判断主机名本身是否就是根域名"""
+    return get_root_domain(hostname, include_private) == normalize_hostname(hostname)
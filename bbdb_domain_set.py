@@ -0,0 +1,277 @@
+"""
+文件名: bbdb_domain_set.py
+作者: soapffz
+创建日期: 2026年10月18日
+最后修改日期: 2026年10月18日
+
+紧凑的域名集合模块，供各个脚本共用，本身不是定时任务
+
+1. 每个域名按标签反转后编码为一个键，例如 www.example.com 编码为 com\0example\0www，
+   所有键排序后存放在一段连续的 bytes 中，同一个根域名下的子域名在排序后相邻
+2. 每 BLOCK_SIZE 个键为一块，块内的键只保存与上一个键不同的部分（前缀压缩），
+   com\0example 这样重复的后缀标签只存一次，块首的键单独保存，用于二分查找
+3. 支持 in、迭代（按反转标签顺序）、并集、差集、交集和后缀查询，集合运算对两个有序序列做归并，
+   不需要把域名还原成 Python 字符串集合
+4. 集合内容创建后不可修改，构造时分批排序再归并，峰值内存只比结果多一个批次
+5. 集合不做规范化，调用方需要先统一大小写并去除首尾的点
+"""
+
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+
+# 每块的键数量，越大越省内存，单次查找需要解码的键越多
+BLOCK_SIZE = 32
+# 构造时每批排序的键数量
+RUN_SIZE = 1 << 18
+# 差集/交集时对方集合大于自身这么多倍，改为逐个二分查找而不是归并
+PROBE_RATIO = 16
+
+SEPARATOR = "\x00"
+
+
+def encode_domain(domain):
+    return SEPARATOR.join(reversed(domain.split("."))).encode()
+
+
+def decode_domain(key):
+    return ".".join(reversed(key.decode().split(SEPARATOR)))
+
+
+def _write_varint(buffer, value):
+    # 域名不超过 253 字节，绝大多数长度一个字节就够
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _common_prefix_length(left, right):
+    # 两个键按大端整数异或，最高的非零位所在的字节就是第一个不同的字节
+    width = max(len(left), len(right))
+    if len(left) == len(right):
+        diff = int.from_bytes(left, "big") ^ int.from_bytes(right, "big")
+        return width - (diff.bit_length() + 7) // 8
+    diff = int.from_bytes(left.ljust(width, b"\0"), "big") ^ int.from_bytes(
+        right.ljust(width, b"\0"), "big"
+    )
+    return min(width - (diff.bit_length() + 7) // 8, len(left), len(right))
+
+
+class DomainSet:
+    """不可变的紧凑域名集合，可以由任意域名可迭代对象构造"""
+
+    __slots__ = ("_blob", "_block_offsets", "_block_heads", "_length")
+
+    def __init__(self, domains=()):
+        if isinstance(domains, DomainSet):
+            source = domains
+        else:
+            builder = DomainSetBuilder()
+            builder.update(domains)
+            source = builder.build()
+        self._blob = source._blob
+        self._block_offsets = source._block_offsets
+        self._block_heads = source._block_heads
+        self._length = source._length
+
+    @classmethod
+    def _from_sorted_keys(cls, keys):
+        # keys 必须已经按字节序排好，相邻的重复键只保留一个
+        blob = bytearray()
+        block_offsets = array("Q")
+        block_heads = []
+        length = 0
+        previous = None
+        for key in keys:
+            if key == previous:
+                continue
+            if length % BLOCK_SIZE == 0:
+                block_offsets.append(len(blob))
+                block_heads.append(key)
+                shared = 0
+            else:
+                shared = _common_prefix_length(previous, key)
+            suffix_length = len(key) - shared
+            if shared < 0x80 and suffix_length < 0x80:
+                blob.append(shared)
+                blob.append(suffix_length)
+            else:
+                _write_varint(blob, shared)
+                _write_varint(blob, suffix_length)
+            blob += key[shared:]
+            previous = key
+            length += 1
+
+        domain_set = cls.__new__(cls)
+        domain_set._blob = bytes(blob)
+        domain_set._block_offsets = block_offsets
+        domain_set._block_heads = block_heads
+        domain_set._length = length
+        return domain_set
+
+    def _iter_block_keys(self, block):
+        blob = self._blob
+        pos = self._block_offsets[block]
+        end = (
+            self._block_offsets[block + 1]
+            if block + 1 < len(self._block_offsets)
+            else len(blob)
+        )
+        key = b""
+        while pos < end:
+            shared = blob[pos]
+            pos += 1
+            if shared & 0x80:
+                shared = (shared & 0x7F) | (blob[pos] << 7)
+                pos += 1
+            length = blob[pos]
+            pos += 1
+            if length & 0x80:
+                length = (length & 0x7F) | (blob[pos] << 7)
+                pos += 1
+            key = key[:shared] + blob[pos : pos + length]
+            pos += length
+            yield key
+
+    def _iter_keys(self, start_block=0):
+        for block in range(start_block, len(self._block_heads)):
+            yield from self._iter_block_keys(block)
+
+    def _contains_key(self, key):
+        block = bisect_right(self._block_heads, key) - 1
+        if block < 0:
+            return False
+        for candidate in self._iter_block_keys(block):
+            if candidate >= key:
+                return candidate == key
+        return False
+
+    def __contains__(self, domain):
+        return isinstance(domain, str) and self._contains_key(encode_domain(domain))
+
+    def __iter__(self):
+        return map(decode_domain, self._iter_keys())
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return f"DomainSet({self._length} domains, {self.nbytes} bytes)"
+
+    @property
+    def nbytes(self):
+        # 键数据和块索引占用的字节数（不含 Python 对象本身的开销）
+        return (
+            len(self._blob)
+            + self._block_offsets.itemsize * len(self._block_offsets)
+            + sum(len(head) for head in self._block_heads)
+        )
+
+    @staticmethod
+    def _coerce(other):
+        return other if isinstance(other, DomainSet) else DomainSet(other)
+
+    def union(self, other):
+        other = self._coerce(other)
+        if not other:
+            return self
+        if not self:
+            return other
+        return DomainSet._from_sorted_keys(
+            heapq.merge(self._iter_keys(), other._iter_keys())
+        )
+
+    def difference(self, other):
+        other = self._coerce(other)
+        if not self or not other:
+            return self
+        if len(other) > len(self) * PROBE_RATIO:
+            keys = (key for key in self._iter_keys() if not other._contains_key(key))
+        else:
+            keys = _merge_difference(self._iter_keys(), other._iter_keys())
+        return DomainSet._from_sorted_keys(keys)
+
+    def intersection(self, other):
+        other = self._coerce(other)
+        if not self or not other:
+            return DomainSet()
+        small, large = (self, other) if len(self) <= len(other) else (other, self)
+        return DomainSet._from_sorted_keys(
+            key for key in small._iter_keys() if large._contains_key(key)
+        )
+
+    __or__ = union
+    __sub__ = difference
+    __and__ = intersection
+
+    def iter_suffix(self, suffix):
+        """按顺序 yield 集合中等于 suffix 或者是 suffix 子域名的域名"""
+        prefix = encode_domain(suffix)
+        child_prefix = prefix + SEPARATOR.encode()
+        start_block = max(0, bisect_left(self._block_heads, prefix) - 1)
+        for key in self._iter_keys(start_block):
+            if key < prefix:
+                continue
+            # 反转标签排序后，suffix 本身和它的所有子域名是连续的一段
+            if key != prefix and not key.startswith(child_prefix):
+                return
+            yield decode_domain(key)
+
+    def matching_suffixes(self, domain, min_labels=2):
+        """按从短到长 yield domain 在集合中的后缀（包括 domain 本身），至少 min_labels 级"""
+        labels = domain.split(".")
+        for depth in range(min_labels, len(labels) + 1):
+            suffix = ".".join(labels[-depth:])
+            if suffix in self:
+                yield suffix
+
+
+def _merge_difference(left, right):
+    # 两个有序键序列的差集
+    right_key = next(right, None)
+    for key in left:
+        while right_key is not None and right_key < key:
+            right_key = next(right, None)
+        if key != right_key:
+            yield key
+
+
+class DomainSetBuilder:
+    """
+    逐个或按批添加域名，最后生成 DomainSet
+
+    每攒满 RUN_SIZE 个键就排序压缩成一个有序段，build 时把各段归并为一个集合
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._runs = []
+
+    def add(self, domain):
+        self._pending.append(encode_domain(domain))
+        if len(self._pending) >= RUN_SIZE:
+            self._flush()
+
+    def update(self, domains):
+        if isinstance(domains, DomainSet):
+            self._flush()
+            self._runs.append(domains)
+            return
+        for domain in domains:
+            self.add(domain)
+
+    def _flush(self):
+        if self._pending:
+            self._pending.sort()
+            self._runs.append(DomainSet._from_sorted_keys(self._pending))
+            self._pending = []
+
+    def build(self):
+        self._flush()
+        runs, self._runs = self._runs, []
+        if len(runs) == 1:
+            return runs[0]
+        return DomainSet._from_sorted_keys(
+            heapq.merge(*(run._iter_keys() for run in runs))
+        )
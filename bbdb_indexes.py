@@ -0,0 +1,141 @@
+"""
+文件名: bbdb_indexes.py
+作者: soapffz
+创建日期: 2026年10月18日
+最后修改日期: 2026年10月18日
+
+bbdb 索引声明和基于索引的批量写入模块，供各个脚本共用，本身不是定时任务
+
+1. INDEXES 声明各表的唯一索引和二级索引，ensure_indexes 在脚本启动时调用，索引已存在时 MongoDB 直接返回，开销很小
+2. 各表 name 非空时唯一（与 bbdb_clean.py 的 name 去重规则一致），ip 表的 name 通常为空，
+   唯一索引只覆盖 name 为非空字符串的文档；ip 表另外按 (address, root_domain_id, sub_domain_id, business_id)
+   唯一，与 bbdb_arl.py 的 upsert 键一致，只覆盖 address 为非空字符串的文档
+3. 已有重复数据时唯一索引会创建失败，只记录日志不中断脚本，运行 bbdb_clean.py 去重后下次启动会自动补上
+4. bulk_upsert 按键字段做无序批量 upsert（$setOnInsert），已存在的文档不会被修改，
+   多个定时任务同时写入时由唯一索引兜底，并发插入同一个键产生的重复键错误会被忽略
+"""
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+# 只对 name 为非空字符串的文档做唯一约束
+NON_EMPTY_NAME = {"name": {"$gt": ""}}
+NON_EMPTY_ADDRESS = {"address": {"$gt": ""}}
+# ip 表判断是否为同一条记录的字段，bbdb_arl.py 按这些字段 upsert，bbdb_clean.py 按这些字段去重
+IP_KEY_FIELDS = ("address", "root_domain_id", "sub_domain_id", "business_id")
+
+DUPLICATE_KEY_ERROR = 11000
+
+INDEXES = {
+    "business": [
+        {"keys": [("name", ASCENDING)], "unique": True, "partial": NON_EMPTY_NAME},
+    ],
+    "root_domain": [
+        {"keys": [("name", ASCENDING)], "unique": True, "partial": NON_EMPTY_NAME},
+        {"keys": [("business_id", ASCENDING)]},
+    ],
+    "sub_domain": [
+        {"keys": [("name", ASCENDING)], "unique": True, "partial": NON_EMPTY_NAME},
+        {"keys": [("business_id", ASCENDING)]},
+        {"keys": [("root_domain_id", ASCENDING)]},
+    ],
+    "site": [
+        {"keys": [("name", ASCENDING)], "unique": True, "partial": NON_EMPTY_NAME},
+        {"keys": [("business_id", ASCENDING)]},
+        {"keys": [("root_domain_id", ASCENDING)]},
+        {"keys": [("sub_domain_id", ASCENDING)]},
+    ],
+    "ip": [
+        {"keys": [("name", ASCENDING)], "unique": True, "partial": NON_EMPTY_NAME},
+        # bbdb_arl.py 按 (地址, 根域名, 子域名, 分组) upsert，并发写入同一个 IP 时由唯一索引兜底
+        {
+            "keys": [(field, ASCENDING) for field in IP_KEY_FIELDS],
+            "unique": True,
+            "partial": NON_EMPTY_ADDRESS,
+        },
+        {"keys": [("business_id", ASCENDING)]},
+        {"keys": [("root_domain_id", ASCENDING)]},
+        {"keys": [("sub_domain_id", ASCENDING)]},
+    ],
+    "blacklist": [
+        {
+            "keys": [("name", ASCENDING), ("type", ASCENDING)],
+            "unique": True,
+            "partial": NON_EMPTY_NAME,
+        },
+        {"keys": [("type", ASCENDING)]},
+        {"keys": [("business_id", ASCENDING)]},
+    ],
+    "sync_state": [
+        {"keys": [("name", ASCENDING)], "unique": True},
+    ],
+    # bbdb_lease.py 的运行租约，过期后由 TTL 索引自动删除
+    "run_lease": [
+        {"keys": [("expires_at", ASCENDING)], "expire_after": 0},
+    ],
+}
+
+
+def ensure_indexes(db, log=print):
+    """创建 INDEXES 中声明的索引，返回创建失败的 (表名, 索引名) 列表"""
+    failed = []
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            options = {"unique": index.get("unique", False)}
+            if "partial" in index:
+                options["partialFilterExpression"] = index["partial"]
+            if "expire_after" in index:
+                options["expireAfterSeconds"] = index["expire_after"]
+            try:
+                db[collection].create_index(index["keys"], **options)
+            except OperationFailure as e:
+                name = "_".join(f"{field}_{order}" for field, order in index["keys"])
+                failed.append((collection, name))
+                log(
+                    f"{collection} 表创建索引 {name} 失败，请先运行 bbdb_clean.py 去重: {e}"
+                )
+    return failed
+
+
+def upsert_filter(document, key_fields):
+    # 文档中没有的键字段用 $exists 匹配，避免 upsert 把 null 值写进新文档
+    return {
+        field: document[field] if field in document else {"$exists": False}
+        for field in key_fields
+    }
+
+
+def bulk_upsert(collection, documents, key_fields, batch_size=5000):
+    """
+    按 key_fields 无序批量 upsert，文档只在不存在时插入
+
+    返回 {documents 中的下标: 新插入文档的 _id}，已存在的文档不在其中
+    """
+    upserted_ids = {}
+    for start in range(0, len(documents), batch_size):
+        batch = documents[start : start + batch_size]
+        operations = [
+            UpdateOne(
+                upsert_filter(document, key_fields),
+                {"$setOnInsert": document},
+                upsert=True,
+            )
+            for document in batch
+        ]
+        try:
+            upserted = collection.bulk_write(operations, ordered=False).upserted_ids
+        except BulkWriteError as e:
+            # 其他任务先插入了同一个键时会报重复键错误，此时文档已经存在，忽略即可
+            errors = [
+                error
+                for error in e.details.get("writeErrors", [])
+                if error.get("code") != DUPLICATE_KEY_ERROR
+            ]
+            if errors:
+                raise
+            upserted = {
+                item["index"]: item["_id"] for item in e.details.get("upserted", [])
+            }
+        for index, _id in upserted.items():
+            upserted_ids[start + index] = _id
+    return upserted_ids
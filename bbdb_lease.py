@@ -0,0 +1,139 @@
+"""
+文件名: bbdb_lease.py
+作者: soapffz
+创建日期: 2026年10月18日
+最后修改日期: 2026年10月18日
+
+定时任务的运行租约模块，供各个脚本共用，本身不是定时任务
+
+1. 每个定时任务在 run_lease 表中对应一个以任务名为 _id 的文档，记录持有者和过期时间，
+   上一次运行还没结束时下一次运行拿不到租约，默认直接退出，不再重复请求 ARL 和写入 bbdb
+2. 持有期间后台线程每隔 TTL 的三分之一续期一次，进程崩溃或被杀掉后租约最多 TTL 秒后自动失效，
+   过期的文档由 bbdb_indexes.py 声明的 TTL 索引清理
+3. 进程退出时（包括 sys.exit 和未捕获的异常）自动释放租约，只会删除自己持有的租约
+
+环境变量：
+BBDB_LEASE_TTL   租约有效期（秒），默认 300
+BBDB_LEASE_WAIT  拿不到租约时排队等待的最长时间（秒），默认 0，即直接退出
+"""
+
+import atexit
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+LEASE_COLLECTION = "run_lease"
+# 排队等待时两次尝试之间的间隔（秒）
+LEASE_POLL_INTERVAL = 10
+
+
+class RunLease:
+    def __init__(self, db, name, ttl=None, log=print):
+        self.collection = db[LEASE_COLLECTION]
+        self.name = name
+        self.ttl = int(ttl or os.environ.get("BBDB_LEASE_TTL") or 300)
+        self.log = log
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.held = False
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _expires_at(self):
+        return datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+
+    def try_acquire(self):
+        """尝试获取租约，租约不存在、已过期或本来就是自己持有时成功"""
+        now = datetime.now(timezone.utc)
+        try:
+            self.collection.find_one_and_update(
+                {
+                    "_id": self.name,
+                    "$or": [{"expires_at": {"$lt": now}}, {"owner": self.owner}],
+                },
+                {
+                    "$set": {
+                        "owner": self.owner,
+                        "acquired_at": now,
+                        "heartbeat_at": now,
+                        "expires_at": self._expires_at(),
+                    }
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # 文档存在且未过期，说明租约由其他进程持有
+            return False
+        return True
+
+    def holder(self):
+        document = self.collection.find_one({"_id": self.name}) or {}
+        return document.get("owner"), document.get("expires_at")
+
+    def acquire(self, wait=None):
+        """获取租约，最多排队等待 wait 秒，成功后启动续期线程并注册退出时释放"""
+        wait = float(
+            wait if wait is not None else os.environ.get("BBDB_LEASE_WAIT") or 0
+        )
+        deadline = time.monotonic() + wait
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                owner, expires_at = self.holder()
+                self.log(
+                    f"{self.name} 正在由 {owner} 运行（租约到期时间 {expires_at}），本次运行退出"
+                )
+                return False
+            time.sleep(min(LEASE_POLL_INTERVAL, max(0.0, deadline - time.monotonic())))
+
+        self.held = True
+        self._heartbeat = threading.Thread(
+            target=self._renew_loop, name=f"lease-{self.name}", daemon=True
+        )
+        self._heartbeat.start()
+        atexit.register(self.release)
+        return True
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                result = self.collection.update_one(
+                    {"_id": self.name, "owner": self.owner},
+                    {
+                        "$set": {
+                            "heartbeat_at": datetime.now(timezone.utc),
+                            "expires_at": self._expires_at(),
+                        }
+                    },
+                )
+            except PyMongoError as e:
+                # 续期失败时保留租约，下次再试，连续失败超过 TTL 后租约才会失效
+                self.log(f"{self.name} 租约续期失败: {e}")
+                continue
+            if result.matched_count == 0:
+                self.held = False
+                self.log(f"{self.name} 租约已失效，可能已有其他进程在运行")
+                return
+
+    def release(self):
+        if self._heartbeat is not None:
+            self._stop.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+        if self.held:
+            self.held = False
+            try:
+                self.collection.delete_one({"_id": self.name, "owner": self.owner})
+            except PyMongoError as e:
+                self.log(f"{self.name} 释放租约失败，将在 {self.ttl} 秒后自动过期: {e}")
+
+
+def acquire_run_lease(db, name, log=print, ttl=None, wait=None):
+    """获取名为 name 的运行租约，成功返回 RunLease，已有其他进程在运行时返回 None"""
+    lease = RunLease(db, name, ttl, log)
+    return lease if lease.acquire(wait) else None
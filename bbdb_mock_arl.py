@@ -0,0 +1,381 @@
+"""
+文件名: bbdb_mock_arl.py
+作者: soapffz
+创建日期: 2026年10月18日
+最后修改日期: 2026年10月18日
+
+本地 ARL 替身服务和测试数据生成模块，供压测脚本 debug_bbdb_arl_benchmark.py 使用，本身不是定时任务
+
+1. MockArlState 在内存中保存资产分组、策略、监控任务和域名/站点/IP 资产，并按接口统计请求次数
+2. start_mock_arl 在本地端口启动多线程 HTTP 服务，实现 bbdb_arl.py 用到的接口：
+   登录、资产分组列表/新建/添加域名、策略列表/新增/删除、监控任务列表/新增/删除、
+   域名/站点/IP 的列表和导出，返回格式与 ARL 一致，未登录返回 401
+3. generate_dataset 按域名总量生成一份 bbdb 数据和一份 ARL 数据，两边部分重叠，
+   seed_bbdb 把 bbdb 数据批量写入指定数据库
+"""
+
+import json
+import random
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from bson.objectid import ObjectId
+
+MOCK_TOKEN = "mock-arl-token"
+
+# ARL 对资产范围域名的校验，和 ARL 一样只指出第一个无效域名
+MOCK_DOMAIN_PATTERN = re.compile(
+    r"^(?!-)[a-z0-9_-]{1,63}(?<!-)(\.(?!-)[a-z0-9_-]{1,63}(?<!-))*\.[a-z][a-z0-9-]+$"
+)
+
+# 导出接口按页返回纯文本，每种资产导出的字段
+EXPORT_FIELDS = {"domain": "domain", "site": "site", "ip": "ip"}
+
+
+class MockArlState:
+    def __init__(self):
+        self.scopes = {}
+        self.policies = {}
+        self.schedulers = {}
+        self.assets = {"domain": [], "site": [], "ip": []}
+        self.request_counts = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, method, path):
+        with self.lock:
+            self.request_counts[f"{method} {path}"] += 1
+
+    def reset_counts(self):
+        with self.lock:
+            self.request_counts.clear()
+
+    def add_scope(self, name, domains, scope_id=None):
+        scope_id = scope_id or str(ObjectId())
+        self.scopes[scope_id] = {
+            "_id": scope_id,
+            "name": name,
+            "scope_type": "domain",
+            "scope": ",".join(domains),
+            "scope_array": list(domains),
+        }
+        return scope_id
+
+    def filtered_assets(self, asset_type, query):
+        assets = self.assets.get(asset_type, [])
+        update_after = query.get("update_date__dgt")
+        if update_after:
+            assets = [asset for asset in assets if asset["update_date"] > update_after]
+        if asset_type == "domain" and query.get("tabIndex") == "1":
+            # 资产总览页面只列出有解析记录的域名
+            assets = [asset for asset in assets if asset.get("ips")]
+        return assets
+
+
+def invalid_scope_domain(domains):
+    return next(
+        (domain for domain in domains if not MOCK_DOMAIN_PATTERN.match(domain)), None
+    )
+
+
+class MockArlHandler(BaseHTTPRequestHandler):
+    # 使用 HTTP/1.1 以支持 keep-alive，和 ARL 前面的 nginx 表现一致
+    protocol_version = "HTTP/1.1"
+    # 响应头和响应体分两次写出，关闭 Nagle 避免 keep-alive 下每个请求多等 40ms
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, status=200, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, message, data=None, code=400):
+        self._send({"code": code, "message": message, "data": data or {}})
+
+    def _authorized(self, path):
+        if path == "/api/user/login" or self.headers.get("Token") == MOCK_TOKEN:
+            return True
+        self._send({"code": 401, "message": "not login"}, status=401)
+        return False
+
+    def _page(self, items, query):
+        page = max(1, int(query.get("page", 1)))
+        size = max(1, int(query.get("size", 10)))
+        start = (page - 1) * size
+        self._send(
+            {
+                "code": 200,
+                "page": page,
+                "size": size,
+                "total": len(items),
+                "items": items[start : start + size],
+            }
+        )
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.state.count("GET", url.path)
+        if not self._authorized(url.path):
+            return
+
+        if url.path == "/api/asset_scope/":
+            return self._page(list(self.state.scopes.values()), query)
+        if url.path == "/api/policy/":
+            return self._page(list(self.state.policies.values()), query)
+        if url.path == "/api/scheduler/":
+            return self._page(list(self.state.schedulers.values()), query)
+
+        parts = url.path.strip("/").split("/")
+        if len(parts) >= 2 and parts[1] in EXPORT_FIELDS:
+            asset_type = parts[1]
+            assets = self.state.filtered_assets(asset_type, query)
+            if len(parts) == 3 and parts[2] == "export":
+                page = max(1, int(query.get("page", 1)))
+                size = max(1, int(query.get("size", 10000)))
+                field = EXPORT_FIELDS[asset_type]
+                lines = (
+                    asset[field] for asset in assets[(page - 1) * size : page * size]
+                )
+                return self._send("\n".join(lines).encode(), content_type="text/plain")
+            if len(parts) == 2:
+                return self._page(assets, query)
+
+        self._send({"code": 404, "message": "not found"}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        self.state.count("POST", url.path)
+        if not self._authorized(url.path):
+            return
+
+        handler = {
+            "/api/user/login": self._login,
+            "/api/asset_scope/": self._add_scope,
+            "/api/asset_scope/add/": self._add_scope_domains,
+            "/api/policy/add/": self._add_policy,
+            "/api/policy/delete/": self._delete_policies,
+            "/api/scheduler/add/": self._add_scheduler,
+            "/api/scheduler/add/site_monitor/": self._add_site_monitor,
+            "/api/scheduler/delete/": self._delete_schedulers,
+        }.get(url.path)
+        if handler is None:
+            return self._send({"code": 404, "message": "not found"}, status=404)
+        with self.state.lock:
+            handler(body)
+
+    def _login(self, body):
+        self._send({"code": 200, "data": {"token": MOCK_TOKEN}})
+
+    def _add_scope(self, body):
+        name = body.get("name")
+        if any(scope["name"] == name for scope in self.state.scopes.values()):
+            return self._error("资产组名称已经存在")
+        domains = [domain for domain in body.get("scope", "").split(",") if domain]
+        invalid_domain = invalid_scope_domain(domains)
+        if invalid_domain or not domains:
+            return self._error("范围无效", {"scope": invalid_domain or ""})
+        scope_id = self.state.add_scope(name, domains)
+        self._send(
+            {"code": 200, "data": {**self.state.scopes[scope_id], "scope_id": scope_id}}
+        )
+
+    def _add_scope_domains(self, body):
+        scope = self.state.scopes.get(body.get("scope_id"))
+        if scope is None:
+            return self._error("没有找到资产组")
+        domains = [domain for domain in body.get("scope", "").split(",") if domain]
+        invalid_domain = invalid_scope_domain(domains)
+        if invalid_domain:
+            return self._error("范围无效", {"scope": invalid_domain})
+        existing = set(scope["scope_array"])
+        scope["scope_array"].extend(
+            domain for domain in dict.fromkeys(domains) if domain not in existing
+        )
+        scope["scope"] = ",".join(scope["scope_array"])
+        self._send({"code": 200, "data": {"scope_id": scope["_id"]}})
+
+    def _add_policy(self, body):
+        policy_id = str(ObjectId())
+        self.state.policies[policy_id] = {
+            "_id": policy_id,
+            "name": body.get("name"),
+            "desc": body.get("desc", ""),
+            "policy": body.get("policy", {}),
+        }
+        self._send({"code": 200, "data": {"policy_id": policy_id}})
+
+    def _delete_policies(self, body):
+        for policy_id in body.get("policy_id", []):
+            self.state.policies.pop(policy_id, None)
+        self._send({"code": 200, "data": {}})
+
+    def _add_scheduler(self, body):
+        if body.get("scope_id") not in self.state.scopes:
+            return self._error("没有找到资产组")
+        job_id = str(ObjectId())
+        self.state.schedulers[job_id] = {
+            "_id": job_id,
+            "scope_id": body["scope_id"],
+            "domain": body.get("domain", ""),
+            "interval": body.get("interval"),
+            "policy_id": body.get("policy_id"),
+            "name": body.get("name", ""),
+            "scope_type": "domain",
+        }
+        self._send({"code": 200, "data": {"job_id": job_id}})
+
+    def _add_site_monitor(self, body):
+        if body.get("scope_id") not in self.state.scopes:
+            return self._error("没有找到资产组")
+        job_id = str(ObjectId())
+        self.state.schedulers[job_id] = {
+            "_id": job_id,
+            "scope_id": body["scope_id"],
+            "interval": body.get("interval"),
+            "scope_type": "site_update_monitor",
+        }
+        self._send({"code": 200, "data": {"job_id": job_id}})
+
+    def _delete_schedulers(self, body):
+        for job_id in body.get("job_id", []):
+            self.state.schedulers.pop(job_id, None)
+        self._send({"code": 200, "data": {}})
+
+
+def start_mock_arl(state, host="127.0.0.1", port=0):
+    """在后台线程启动替身服务，返回 (server, base_url)，用完调用 server.shutdown()"""
+    handler = type("BoundMockArlHandler", (MockArlHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def generate_dataset(
+    total_domains,
+    name_prefix="国内-雷神众测-bench-",
+    domains_per_business=1000,
+    overlap=0.8,
+    seed=0,
+):
+    """
+    生成压测数据，返回 (bbdb 数据, MockArlState)
+
+    每个 business 两个根域名，子域名平均分到各根域名下；overlap 比例的子域名两边都有，
+    其余一半只在 bbdb、一半只在 ARL。另外各有约 1% 的分组只存在于一侧，
+    ARL 中 10% 的域名带站点、带解析 IP
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+    update_date = (now - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+    business_count = max(2, total_domains // domains_per_business)
+    side_only_count = max(1, business_count // 100)
+
+    bbdb = {"business": [], "root_domain": [], "sub_domain": []}
+    state = MockArlState()
+    for index in range(business_count):
+        name = f"{name_prefix}{index}"
+        bbdb_side = index >= side_only_count  # 前 1% 只在 ARL
+        arl_side = index < business_count - side_only_count  # 后 1% 只在 bbdb
+        business_id = ObjectId()
+        root_domains = [f"b{index}r{j}.com" for j in range(2)]
+        if bbdb_side:
+            bbdb["business"].append(
+                {
+                    "_id": business_id,
+                    "name": name,
+                    "notes": "bench",
+                    "url": "",
+                    "create_time": now,
+                    "update_time": now,
+                }
+            )
+        root_domain_ids = {}
+        for root_domain in root_domains:
+            root_domain_ids[root_domain] = ObjectId()
+            if bbdb_side:
+                bbdb["root_domain"].append(
+                    {
+                        "_id": root_domain_ids[root_domain],
+                        "name": root_domain,
+                        "icpregnum": "",
+                        "business_id": str(business_id),
+                        "notes": "bench",
+                        "create_time": now,
+                        "update_time": now,
+                    }
+                )
+        if arl_side:
+            state.add_scope(name, root_domains)
+
+        for number in range(domains_per_business):
+            root_domain = root_domains[number % len(root_domains)]
+            domain = f"s{number}.{root_domain}"
+            # roll 落在 [0, overlap) 两边都有，之后的前一半只在 bbdb，后一半只在 ARL
+            roll = rng.random()
+            bbdb_only_end = overlap + (1 - overlap) / 2
+            in_bbdb = bbdb_side and roll < bbdb_only_end
+            in_arl = arl_side and (roll < overlap or roll >= bbdb_only_end)
+            if in_bbdb:
+                bbdb["sub_domain"].append(
+                    {
+                        "name": domain,
+                        "icpregnum": "",
+                        "business_id": str(business_id),
+                        "root_domain_id": str(root_domain_ids[root_domain]),
+                        "notes": "bench",
+                        "create_time": now,
+                        "update_time": now,
+                    }
+                )
+            if in_arl:
+                with_extras = rng.random() < 0.1
+                ips = [f"10.{index % 256}.{number // 256 % 256}.{number % 256}"]
+                state.assets["domain"].append(
+                    {
+                        "_id": str(ObjectId()),
+                        "domain": domain,
+                        "type": "A",
+                        "record": ips,
+                        "ips": ips if with_extras else [],
+                        "update_date": update_date,
+                    }
+                )
+                if with_extras:
+                    state.assets["site"].append(
+                        {"site": f"https://{domain}", "update_date": update_date}
+                    )
+                    state.assets["ip"].append(
+                        {"ip": ips[0], "domain": [domain], "update_date": update_date}
+                    )
+    return bbdb, state
+
+
+def seed_bbdb(db, bbdb, batch_size=10000):
+    """清空并写入压测数据，只应该对压测专用的数据库调用"""
+    for collection in (
+        "business",
+        "root_domain",
+        "sub_domain",
+        "site",
+        "ip",
+        "blacklist",
+        "sync_state",
+    ):
+        db[collection].drop()
+    for collection, documents in bbdb.items():
+        for start in range(0, len(documents), batch_size):
+            db[collection].insert_many(documents[start : start + batch_size])
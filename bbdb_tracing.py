@@ -0,0 +1,278 @@
+"""
+文件名: bbdb_tracing.py
+作者: soapffz
+创建日期: 2026年10月18日
+最后修改日期: 2026年10月18日
+
+运行耗时追踪模块，供各个脚本共用，本身不是定时任务
+
+1. span 为一段带名字的计时区间，记录耗时、请求数、收发字节数和读写文档数，
+   子 span 结束时把计数累加到父 span；编号步骤用 begin_stage/end_stage 标记
+2. 线程池中的工作线程拿不到调用方的上下文，此时以当前正在运行的步骤作为父 span
+3. MongoCommandTracer 通过 pymongo 的命令监听为每条 Mongo 命令记录一个 span，
+   创建 MongoClient 时传入 event_listeners 即可，不需要改动每个调用点
+4. 设置 BBDB_TRACE_JSONL 时每个 span 结束后写一行 JSON；
+   设置 BBDB_TRACE_PROM 时运行结束写出 Prometheus textfile（按 span 名称汇总），供 node_exporter 采集
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+COUNTERS = (
+    "requests",
+    "bytes_sent",
+    "bytes_received",
+    "docs_read",
+    "docs_written",
+    "errors",
+)
+
+_current_span = contextvars.ContextVar("bbdb_current_span", default=None)
+
+
+class Span:
+    def __init__(self, tracer, name, parent, stage, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.stage = stage
+        self.attrs = attrs
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.status = "ok"
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self.duration = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, **counters):
+        with self._lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def finish(self, duration=None):
+        self.duration = (
+            time.perf_counter() - self._started if duration is None else duration
+        )
+        if self.parent is not None:
+            self.parent.add(**self.counters)
+        self.tracer._finish(self)
+
+    def to_dict(self):
+        return {
+            "run": self.tracer.run_name,
+            "span": self.name,
+            "parent": self.parent.name if self.parent is not None else None,
+            "stage": self.stage,
+            "start": self.start,
+            "duration": round(self.duration, 6),
+            "status": self.status,
+            **self.counters,
+            **({"attrs": self.attrs} if self.attrs else {}),
+        }
+
+
+class Tracer:
+    def __init__(self, run_name, jsonl_path=None, prom_path=None):
+        self.run_name = run_name
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.started = time.time()
+        self.active_stage = None
+        # 按 span 名称汇总：调用次数、总耗时和各项计数
+        self.totals = {}
+        self.stages = []
+        self._lock = threading.Lock()
+        self._jsonl = open(jsonl_path, "a", encoding="utf-8") if jsonl_path else None
+
+    def _parent(self):
+        return _current_span.get() or self.active_stage
+
+    @contextmanager
+    def span(self, name, **attrs):
+        span = Span(self, name, self._parent(), False, attrs)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException:
+            span.status = "error"
+            span.add(errors=1)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.finish()
+
+    def begin_stage(self, name, **attrs):
+        # 开始一个编号步骤，上一个步骤自动结束；步骤按顺序执行，不需要缩进整段代码
+        self.end_stage()
+        self.active_stage = Span(self, name, None, True, attrs)
+        return self.active_stage
+
+    def end_stage(self):
+        stage, self.active_stage = self.active_stage, None
+        if stage is not None:
+            stage.finish()
+
+    def record(self, name, duration, status="ok", **counters):
+        # 记录一个已经结束的 span，用于只在事后拿到耗时的场景（例如 Mongo 命令监听）
+        span = Span(self, name, self._parent(), False, {})
+        span.status = status
+        span.add(**counters)
+        span.finish(duration)
+
+    def add(self, **counters):
+        # 把计数记到当前 span 上
+        span = self._parent()
+        if span is not None:
+            span.add(**counters)
+
+    def _finish(self, span):
+        with self._lock:
+            total = self.totals.setdefault(
+                span.name, {"calls": 0, "duration": 0.0, **dict.fromkeys(COUNTERS, 0)}
+            )
+            total["calls"] += 1
+            total["duration"] += span.duration
+            for key in COUNTERS:
+                total[key] += span.counters[key]
+            if span.stage:
+                self.stages.append(span)
+            if self._jsonl is not None:
+                self._jsonl.write(json.dumps(span.to_dict(), ensure_ascii=False) + "\n")
+
+    def summary_lines(self):
+        return [
+            f"{span.name}: {span.duration:.2f}s, 请求 {span.counters['requests']} 次, "
+            f"发送 {span.counters['bytes_sent'] / 1024:.1f} KB, "
+            f"接收 {span.counters['bytes_received'] / 1024:.1f} KB, "
+            f"读取文档 {span.counters['docs_read']}, 写入文档 {span.counters['docs_written']}"
+            for span in self.stages
+        ]
+
+    def write_prometheus(self, path):
+        lines = []
+        metrics = [("duration", "duration_seconds_total"), ("calls", "calls_total")] + [
+            (key, f"{key}_total") for key in COUNTERS
+        ]
+        for key, suffix in metrics:
+            metric = f"bbdb_span_{suffix}"
+            lines.append(f"# TYPE {metric} counter")
+            for name, total in sorted(self.totals.items()):
+                lines.append(
+                    f'{metric}{{job="{_escape_label(self.run_name)}",'
+                    f'span="{_escape_label(name)}"}} {total[key]}'
+                )
+        lines.append("# TYPE bbdb_run_duration_seconds gauge")
+        lines.append(
+            f'bbdb_run_duration_seconds{{job="{_escape_label(self.run_name)}"}} '
+            f"{time.time() - self.started}"
+        )
+        lines.append("# TYPE bbdb_run_last_finished_timestamp_seconds gauge")
+        lines.append(
+            f'bbdb_run_last_finished_timestamp_seconds{{job="{_escape_label(self.run_name)}"}} '
+            f"{time.time()}"
+        )
+        # 先写临时文件再替换，避免 node_exporter 读到写了一半的文件
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    def close(self):
+        self.end_stage()
+        if self.prom_path:
+            self.write_prometheus(self.prom_path)
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """把每条 Mongo 命令记录为 mongo.<命令名> span，统计返回和写入的文档数"""
+
+    # 这些命令不属于业务读写，不记录
+    IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "ping", "endSessions"}
+
+    def __init__(self, tracer=None):
+        # 不传 tracer 时使用 configure 之后的默认 tracer
+        self._tracer = tracer
+
+    @property
+    def tracer(self):
+        return self._tracer or _tracer
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if event.command_name in self.IGNORED_COMMANDS:
+            return
+        reply = event.reply or {}
+        cursor = reply.get("cursor") or {}
+        docs_read = len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+        if event.command_name == "distinct":
+            docs_read = len(reply.get("values") or [])
+        docs_written = 0
+        if event.command_name in ("insert", "update", "delete"):
+            docs_written = reply.get("n", 0)
+        self.tracer.record(
+            f"mongo.{event.command_name}",
+            event.duration_micros / 1e6,
+            requests=1,
+            docs_read=docs_read,
+            docs_written=docs_written,
+        )
+
+    def failed(self, event):
+        if event.command_name in self.IGNORED_COMMANDS:
+            return
+        self.tracer.record(
+            f"mongo.{event.command_name}",
+            event.duration_micros / 1e6,
+            status="error",
+            requests=1,
+            errors=1,
+        )
+
+
+_tracer = Tracer("bbdb")
+
+
+def configure(run_name, jsonl_path=None, prom_path=None):
+    """替换默认的 tracer，路径为空时从 BBDB_TRACE_JSONL / BBDB_TRACE_PROM 环境变量读取"""
+    global _tracer
+    _tracer = Tracer(
+        run_name,
+        jsonl_path or os.environ.get("BBDB_TRACE_JSONL") or None,
+        prom_path or os.environ.get("BBDB_TRACE_PROM") or None,
+    )
+    return _tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def span(name, **attrs):
+    return _tracer.span(name, **attrs)
+
+
+def begin_stage(name, **attrs):
+    return _tracer.begin_stage(name, **attrs)
+
+
+def end_stage():
+    _tracer.end_stage()
+
+
+def add(**counters):
+    _tracer.add(**counters)
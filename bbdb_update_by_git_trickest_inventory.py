@@ -5,43 +5,41 @@ new Env('trickest_inventory');
 文件名: bbdb_update_by_git_trickest_inventory.py
 作者: soapffz
 创建日期: 2024年3月19日
-最后修改日期: 2024年3月20日
+最后修改日期: 2026年10月18日
 
 1. 在脚本运行之前先在/ql目录git clone https://github.com/trickest/inventory.git git_trickest_inventory
 2. 本脚本处理所有子文件夹中的hostnames.txt和servers.txt文件，将新发现内容写入对应表中
 3. 在处理 hostnames.txt 时，对于每个域名需要满足以下条件才能作为新子域名保存:
 (1) 域名不在 blacklist_sub_domains 中
 (2) 域名的根域名与当前处理的 root_domain_name 相同
-(3) 域名不在 existing_sub_domains 中
+(3) 域名在 sub_domain 表中不存在（按 name 批量 upsert，已存在的不会被修改）
 4. 在处理 servers.txt 时，对于每个 URL，需要满足以下条件才能作为新站点保存:
 (1) URL 不在 blacklist_urls 中
 (2) 提取出的主机名 hostname 要么在 existing_sub_domains 中，要么与当前 root_domain_name 相同
-(3) 该 URL 在站点表 site 中不存在
+(3) 该 URL 在站点表 site 中不存在（按 name 批量 upsert，已存在的不会被修改）
 5. business_id、root_domain_id、sub_domain_id均为string类型，分别对应business表、root_domain表、sub_domain表对应文档的类型为ObjectID类型的_id，请注意转化
 """
 import os
 from datetime import datetime, timezone, timedelta
 from pymongo import MongoClient
 from urllib.parse import urlparse
+from bbdb_domain_resolver import get_root_domain, normalize_hostname
+from bbdb_indexes import bulk_upsert, ensure_indexes
+from bbdb_lease import acquire_run_lease
 
 def log_message(message, is_positive=True):
     """打印日志信息"""
     prefix = "[ + ]" if is_positive else "[ - ]"
     print(f"{datetime.now(timezone(timedelta(hours=8))).strftime('%Y-%m-%d %H:%M:%S')} {prefix} {message}")
 
-def extract_domain(hostname, current_root_domain=None):
-    """从hostname中提取根域名，并可选地验证是否与当前处理的根域名匹配"""
-    parts = hostname.split('.')
-    if len(parts) > 1:
-        potential_domain = '.'.join(parts[-2:])
-        if current_root_domain and potential_domain == current_root_domain:
-            return potential_domain
-        return potential_domain
-    return None
+def extract_domain(hostname):
+    """从hostname中提取根域名，按公共后缀列表处理 .com.cn 等多级后缀"""
+    return get_root_domain(hostname)
 
 def load_db_data(db):
     """从数据库加载所有需要的数据到内存中"""
-    root_domain_names = {domain['name'] for domain in db.root_domain.find()}
+    # 根域名按 punycode 形式作为键，与 get_root_domain 的结果一致
+    root_domain_names = {normalize_hostname(domain['name']): domain for domain in db.root_domain.find({}, {"name": 1, "business_id": 1})}
     blacklist_sub_domains = {item['name'] for item in db.blacklist.find({"type": "sub_domain"})}
     blacklist_urls = {item['name'] for item in db.blacklist.find({"type": "url"})}
     existing_sub_domains = {sub_domain['name']: str(sub_domain['root_domain_id']) for sub_domain in db.sub_domain.find({}, {"name": 1, "root_domain_id": 1})}
@@ -66,28 +64,28 @@ def process_files_and_write_to_db(domain_to_folder, db, git_folder, root_domain_
             log_message(f"根域名 {root_domain_name} 未在数据库中找到，跳过。", False)
             continue
         log_message(f"正在处理根域名: {root_domain_name}")
-        root_domain = db.root_domain.find_one({"name": root_domain_name})
+        root_domain = root_domain_names[root_domain_name]
         root_domain_id_str = str(root_domain['_id'])
         business_id_str = str(root_domain['business_id'])
 
         # 处理 hostnames.txt
         hostnames_file_path = os.path.join(git_folder, folder, "hostnames.txt")
         if os.path.exists(hostnames_file_path) and os.path.getsize(hostnames_file_path) > 0:
-            if hostname not in existing_sub_domains.keys():
-                new_subdomains.append({
-                    "name": hostname,
-                    "icpregnum": "",
-                    "company": "",
-                    "company_type": "",
-                    "root_domain_id": root_domain_id_str,
-                    "business_id": business_id_str,
-                    "notes": "set by script with ql",
-                    "create_time": datetime.now(timezone(timedelta(hours=8))),
-                    "update_time": datetime.now(timezone(timedelta(hours=8)))
-                })
-        if new_subdomains:
-            db.sub_domain.insert_many(new_subdomains)
-            log_message(f"根域名 {root_domain_name} 插入了 {len(new_subdomains)} 个新的子域名。")
+            # 是否已存在由 sub_domain 表 name 唯一索引判断，upsert 时跳过已有文档
+            new_subdomains.append({
+                "name": hostname,
+                "icpregnum": "",
+                "company": "",
+                "company_type": "",
+                "root_domain_id": root_domain_id_str,
+                "business_id": business_id_str,
+                "notes": "set by script with ql",
+                "create_time": datetime.now(timezone(timedelta(hours=8))),
+                "update_time": datetime.now(timezone(timedelta(hours=8)))
+            })
+        upserted = bulk_upsert(db.sub_domain, new_subdomains, ("name",)) if new_subdomains else {}
+        if upserted:
+            log_message(f"根域名 {root_domain_name} 插入了 {len(upserted)} 个新的子域名。")
         else:
             log_message(f"根域名 {root_domain_name} 没有新的子域名需要添加。")
         new_subdomains = []  # 清空列表,准备处理下一个根域名
@@ -103,34 +101,32 @@ def process_files_and_write_to_db(domain_to_folder, db, git_folder, root_domain_
                         hostname = url.netloc
                         if hostname in existing_sub_domains.keys() or hostname == root_domain_name:
                             sub_domain_id_str = existing_sub_domains.get(hostname, None)
-                            existing_site = db.site.find_one({"name": server, "root_domain_id": root_domain_id_str})
-                            if not existing_site:
-                                new_sites.append({
-                                    "name": server,
-                                    "status": "",
-                                    "title": "",
-                                    "hostname": "",
-                                    "ip": "",
-                                    "http_server": "",
-                                    "body_length": "",
-                                    "headers": "",
-                                    "keywords": [],
-                                    "applications": [],
-                                    "applications_categories": [],
-                                    "applications_types": [],
-                                    "applications_levels": [],
-                                    "application_manufacturer": [],
-                                    "fingerprint": [],
-                                    "root_domain_id": root_domain_id_str,
-                                    "sub_domain_id": sub_domain_id_str,
-                                    "business_id": business_id_str,
-                                    "notes": "set by script with ql",
-                                    "create_time": datetime.now(timezone(timedelta(hours=8))),
-                                    "update_time": datetime.now(timezone(timedelta(hours=8)))
-                                })
-        if new_sites:
-            db.site.insert_many(new_sites)
-            log_message(f"根域名 {root_domain_name} 插入了 {len(new_sites)} 个新的站点。")
+                            new_sites.append({
+                                "name": server,
+                                "status": "",
+                                "title": "",
+                                "hostname": "",
+                                "ip": "",
+                                "http_server": "",
+                                "body_length": "",
+                                "headers": "",
+                                "keywords": [],
+                                "applications": [],
+                                "applications_categories": [],
+                                "applications_types": [],
+                                "applications_levels": [],
+                                "application_manufacturer": [],
+                                "fingerprint": [],
+                                "root_domain_id": root_domain_id_str,
+                                "sub_domain_id": sub_domain_id_str,
+                                "business_id": business_id_str,
+                                "notes": "set by script with ql",
+                                "create_time": datetime.now(timezone(timedelta(hours=8))),
+                                "update_time": datetime.now(timezone(timedelta(hours=8)))
+                            })
+        upserted = bulk_upsert(db.site, new_sites, ("name",)) if new_sites else {}
+        if upserted:
+            log_message(f"根域名 {root_domain_name} 插入了 {len(upserted)} 个新的站点。")
         else:
             log_message(f"根域名 {root_domain_name} 没有新站点需要添加。")
         new_sites = []  # 清空列表,准备处理下一个根域名
@@ -141,6 +137,12 @@ def main():
     client = MongoClient(BBDB_MONGOURI)
     db = client.bbdb
     log_message("数据库连接成功")
+    ensure_indexes(db, lambda message: log_message(message, False))
+    # 上一次导入还没结束时直接退出
+    lease = acquire_run_lease(db, "trickest_inventory", lambda message: log_message(message, False))
+    if lease is None:
+        client.close()
+        return
 
     root_domain_names, blacklist_sub_domains, blacklist_urls, existing_sub_domains = load_db_data(db)
     domain_to_folder = {}
@@ -153,6 +155,7 @@ def main():
     log_message(f"域名与文件夹的关联关系处理完毕，共有 {len(domain_to_folder)} 对关联关系")
     process_files_and_write_to_db(domain_to_folder, db, git_folder, root_domain_names, blacklist_sub_domains, blacklist_urls, existing_sub_domains)
 
+    lease.release()
     client.close()
 
 if __name__ == "__main__":
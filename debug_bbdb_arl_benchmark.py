@@ -0,0 +1,163 @@
+"""
+文件名: debug_bbdb_arl_benchmark.py
+作者: soapffz
+创建日期: 2026年10月18日
+最后修改日期: 2026年10月18日
+
+脚本功能：不依赖真实 ARL，对 bbdb_arl.py 做不同数据量的压测，手动执行，不要加入定时任务
+
+1. 每个数据量用 bbdb_mock_arl.generate_dataset 生成数据，写入压测专用数据库（默认 bbdb_bench，会被清空，禁止使用 bbdb）
+2. 启动本地 ARL 替身服务，在子进程中运行 bbdb_arl.main()，每次运行的峰值内存互不影响
+3. 统计墙钟时间、子进程峰值 RSS 和替身服务收到的各接口请求数，结果写入 JSON 文件
+4. 指定基线文件时与基线对比，任一指标超出容忍比例则以非零状态退出，用于上线前发现性能回退
+
+环境变量：
+BBDB_BENCH_MONGOURI  压测用的 MongoDB 地址，必填
+BBDB_BENCH_DB        压测数据库名，默认 bbdb_bench
+BBDB_BENCH_SCALES    逗号分隔的域名数量，默认 10000,100000,1000000
+BBDB_BENCH_OUTPUT    结果文件，默认 bbdb_arl_benchmark.json
+BBDB_BENCH_BASELINE  基线结果文件，可选
+BBDB_BENCH_TOLERANCE 允许超出基线的比例，默认 0.2
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone, timedelta
+
+from pymongo import MongoClient
+
+from bbdb_mock_arl import generate_dataset, seed_bbdb, start_mock_arl
+
+
+def log_message(message, is_positive=True):
+    """打印日志信息"""
+    prefix = "[ + ]" if is_positive else "[ - ]"
+    print(
+        f"{datetime.now(timezone(timedelta(hours=8))).strftime('%Y-%m-%d %H:%M:%S')} {prefix} {message}"
+    )
+
+
+def run_child():
+    # 子进程：运行一次完整同步，同步日志改为输出到 stderr 直接显示，stdout 只输出一行结果
+    import bbdb_arl
+
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    started = time.perf_counter()
+    bbdb_arl.main()
+    wall_time = time.perf_counter() - started
+    sys.stdout = stdout
+    # 分片模式下同步在孙进程中运行，取本进程和已结束子进程中较大的峰值；Linux 下 ru_maxrss 的单位是 KB
+    peak_rss_mb = (
+        max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+        / 1024
+    )
+    print(json.dumps({"wall_time": wall_time, "peak_rss_mb": peak_rss_mb}))
+
+
+def run_scale(db, mongodb_uri, db_name, total_domains):
+    log_message(f"生成 {total_domains} 个域名的压测数据")
+    bbdb, state = generate_dataset(total_domains)
+    seed_bbdb(db, bbdb)
+    server, arl_url = start_mock_arl(state)
+    try:
+        env = {
+            **os.environ,
+            "BBDB_ARL_URL": arl_url,
+            "BBDB_ARL_USERNAME": "bench",
+            "BBDB_ARL_PASSWORD": "bench",
+            "BBDB_MONGOURI": mongodb_uri,
+            "BBDB_MONGO_DB": db_name,
+            # 每个数据量都是新的替身服务，不使用上一次运行留下的列表缓存
+            "BBDB_ARL_CACHE_TTL": "0",
+        }
+        log_message(f"开始运行 {total_domains} 个域名的同步")
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child"],
+            env=env,
+            stdout=subprocess.PIPE,
+            text=True,
+            check=True,
+        )
+    finally:
+        server.shutdown()
+
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["requests"] = sum(state.request_counts.values())
+    result["requests_by_endpoint"] = dict(state.request_counts.most_common())
+    result["domains_in_bbdb"] = db.sub_domain.estimated_document_count()
+    return result
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    # 返回超出基线容忍范围的指标描述
+    regressions = []
+    for scale, result in results.items():
+        base = baseline.get(scale)
+        if base is None:
+            continue
+        for metric in ("wall_time", "peak_rss_mb", "requests"):
+            if base.get(metric) and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{scale} 个域名的 {metric} 从 {base[metric]:.1f} 升高到 {result[metric]:.1f}"
+                )
+    return regressions
+
+
+def main():
+    mongodb_uri = os.environ.get("BBDB_BENCH_MONGOURI")
+    db_name = os.environ.get("BBDB_BENCH_DB") or "bbdb_bench"
+    scales = [
+        int(scale)
+        for scale in (
+            os.environ.get("BBDB_BENCH_SCALES") or "10000,100000,1000000"
+        ).split(",")
+    ]
+    output_file = os.environ.get("BBDB_BENCH_OUTPUT") or "bbdb_arl_benchmark.json"
+    baseline_file = os.environ.get("BBDB_BENCH_BASELINE")
+    tolerance = float(os.environ.get("BBDB_BENCH_TOLERANCE") or 0.2)
+
+    if not mongodb_uri:
+        log_message("BBDB_BENCH_MONGOURI 环境变量为空, 退出程序", False)
+        sys.exit(1)
+    if db_name == "bbdb":
+        log_message("压测会清空数据库，不能使用 bbdb", False)
+        sys.exit(1)
+
+    db = MongoClient(mongodb_uri)[db_name]
+    results = {}
+    for total_domains in scales:
+        result = run_scale(db, mongodb_uri, db_name, total_domains)
+        results[str(total_domains)] = result
+        log_message(
+            f"{total_domains} 个域名：耗时 {result['wall_time']:.1f}s，"
+            f"峰值内存 {result['peak_rss_mb']:.0f} MB，请求 {result['requests']} 次"
+        )
+
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    log_message(f"压测结果已写入 {output_file}")
+
+    if baseline_file:
+        with open(baseline_file, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, tolerance)
+        for regression in regressions:
+            log_message(regression, False)
+        if regressions:
+            sys.exit(1)
+        log_message("与基线相比没有性能回退")
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        run_child()
+    else:
+        main()
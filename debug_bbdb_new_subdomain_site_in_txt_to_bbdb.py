@@ -5,7 +5,7 @@ new Env('根据bbdb已有根域名导入文本内容');
 文件名: debug_bbdb_new_subdomain_site_in_txt_to_bbdb.py
 作者: soapffz
 创建日期: 2024年3月26日
-最后修改日期: 2024年3月28日
+最后修改日期: 2026年10月18日
 
 在已有根域名的情况下，从文本文件解析尝试插入子域名和站点，支持ip格式的URL，注意一定要处理好文本文件
 
@@ -15,6 +15,12 @@ import re
 from pymongo import MongoClient
 from datetime import datetime, timezone, timedelta
 from urllib.parse import urlparse
+from bbdb_domain_resolver import (
+    get_root_domains,
+    normalize_hostname,
+    normalize_hostnames,
+)
+from bbdb_indexes import bulk_upsert, ensure_indexes
 
 # MongoDB连接信息
 mongo_uri = "mongodb://192.168.2.188:27017/"
@@ -85,7 +91,8 @@ def parse_and_process(lines, business_name=""):
     root_domains_dict = {
         str(root_domain["_id"]): root_domain for root_domain in root_domains
     }
-    root_domains_set = {doc["name"] for doc in root_domains}
+    # 根域名按 punycode 形式作为键，与 get_root_domains 解析出的根域名一致
+    root_domains_set = {normalize_hostname(doc["name"]): doc for doc in root_domains}
     ips = list(db.ip.find(business_id_filter))
     ips_dict = {ip["address"]: ip for ip in ips}
     sub_domains_to_insert = []
@@ -101,43 +108,30 @@ def parse_and_process(lines, business_name=""):
     blacklist_ips = set(
         doc["name"] for doc in db.blacklist.find({"type": "ip", **business_id_filter})
     )
-    existing_root_domains = set(
-        doc["name"] for doc in db.root_domain.find(business_id_filter)
-    )
-    existing_sub_domains = set(
-        doc["name"] for doc in db.sub_domain.find(business_id_filter)
-    )
-    existing_sites = set(doc["name"] for doc in db.site.find(business_id_filter))
     log_message("加载数据库完成")
 
     lines = preprocess_lines(lines)
     log_message("文本文件读取完成")
     # log_message(lines)
 
-    # 解析根域名
-    for line in lines:
-        if line.startswith("http"):
-            continue
-        root_domain_match = re.search(r"^(.*?\.\w+)\.\w+$", line)
-        if root_domain_match:
-            root_domain = root_domain_match.group()
+    # 解析根域名，非 URL 的行先批量规范化，只保留其中的域名
+    domain_lines = normalize_hostnames(
+        line for line in lines if not line.startswith("http")
+    ).domains
+    for sub_domain, root_domain in zip(domain_lines, get_root_domains(domain_lines)):
+        if root_domain:
             if (
                 root_domain in root_domains_set
                 and root_domain not in blacklist_sub_domains
             ):
-                root_domain_obj = next(
-                    (doc for doc in root_domains if doc["name"] == root_domain), None
-                )
+                root_domain_obj = root_domains_set[root_domain]
                 root_domain_id = str(root_domain_obj["_id"])
                 business_id = str(root_domain_obj["business_id"])
 
                 # 解析子域名
-                sub_domain = line.split(root_domain)[0].rstrip(".")
                 if (
                     sub_domain != root_domain
                     and sub_domain not in blacklist_sub_domains
-                    and sub_domain not in existing_sub_domains
-                    and sub_domain != ""
                 ):
                     sub_domain_data = {
                         "name": sub_domain,
@@ -183,10 +177,7 @@ def parse_and_process(lines, business_name=""):
                                     else ""
                                 )
                             )
-                            if (
-                                processed_url not in blacklist_urls
-                                and processed_url not in existing_sites
-                            ):
+                            if processed_url not in blacklist_urls:
                                 site_data = {
                                     "name": processed_url,
                                     "status": "",
@@ -237,10 +228,7 @@ def parse_and_process(lines, business_name=""):
                         )
                         business_id = domain_info["business_id"]
 
-                        if (
-                            processed_url not in blacklist_urls
-                            and processed_url not in existing_sites
-                        ):
+                        if processed_url not in blacklist_urls:
                             site_data = {
                                 "name": processed_url,
                                 "status": "",
@@ -271,18 +259,17 @@ def parse_and_process(lines, business_name=""):
                                 site_data["sub_domain_id"] = sub_domain_id
                             sites_to_insert.append(site_data)
 
-    # 批量插入数据
+    # 批量 upsert，子域名和站点是否已存在由 name 唯一索引判断，已有文档不会被修改
     if sub_domains_to_insert:
-        db.sub_domain.insert_many(sub_domains_to_insert)
-        # log_message(sub_domains_to_insert)
-        log_message(f"Inserted {len(sub_domains_to_insert)} sub domains.")
+        upserted = bulk_upsert(db.sub_domain, sub_domains_to_insert, ("name",))
+        log_message(f"Inserted {len(upserted)} sub domains.")
     if sites_to_insert:
-        db.site.insert_many(sites_to_insert)
-        # log_message(sites_to_insert)
-        log_message(f"Inserted {len(sites_to_insert)} sites.")
+        upserted = bulk_upsert(db.site, sites_to_insert, ("name",))
+        log_message(f"Inserted {len(upserted)} sites.")
 
 
 def main():
+    ensure_indexes(db, lambda message: log_message(message, False))
     log_message("开始解析文件...")
     with open("domain.txt", "r") as file:
         lines = file.readlines()
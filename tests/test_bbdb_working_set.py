@@ -0,0 +1,68 @@
+"""
+BbdbWorkingSet.record_inserts 的测试，不连接 MongoDB：
+工作集直接构造，upsert_documents 调用的 bulk_upsert 替换为返回固定 _id 的函数
+"""
+
+import threading
+
+from bson import ObjectId
+
+import bbdb_arl
+
+
+def make_working_set(business_id):
+    working_set = bbdb_arl.BbdbWorkingSet.__new__(bbdb_arl.BbdbWorkingSet)
+    working_set.db = None
+    working_set.name_keyword = "国内-"
+    working_set.business_filter = None
+    working_set._lock = threading.Lock()
+    working_set.businesses = [{"_id": ObjectId(business_id), "name": "国内-测试"}]
+    working_set.root_domains = []
+    working_set.sub_domains = []
+    working_set.sites = []
+    working_set.ips = []
+    working_set.blacklists = []
+    working_set.business_ids = {business_id}
+    working_set.pending_businesses = {}
+    working_set.expected = {
+        collection: (0, None) for collection in bbdb_arl.BbdbWorkingSet.COLLECTIONS
+    }
+    return working_set
+
+
+def test_upserted_site_is_added_to_working_set(monkeypatch):
+    business_id = str(ObjectId())
+    working_set = make_working_set(business_id)
+    site_id = ObjectId()
+    monkeypatch.setattr(
+        bbdb_arl, "bulk_upsert", lambda collection, documents, *args: {0: site_id}
+    )
+
+    inserted = bbdb_arl.upsert_documents(
+        {"site": None},
+        "site",
+        [{"name": "https://a.example.com", "business_id": business_id}],
+        working_set,
+    )
+
+    assert inserted == 1
+    # 与 get_bbdb_data 读取的结果一致，只保留投影中的字段
+    assert working_set.sites == [{"name": "https://a.example.com", "_id": site_id}]
+    assert working_set.expected["site"] == (1, site_id)
+
+
+def test_site_of_other_business_is_not_added(monkeypatch):
+    working_set = make_working_set(str(ObjectId()))
+    monkeypatch.setattr(
+        bbdb_arl, "bulk_upsert", lambda collection, documents, *args: {0: ObjectId()}
+    )
+
+    bbdb_arl.upsert_documents(
+        {"site": None},
+        "site",
+        [{"name": "https://b.example.com", "business_id": str(ObjectId())}],
+        working_set,
+    )
+
+    assert working_set.sites == []
+    assert working_set.expected["site"][0] == 1